@@ -1,7 +1,7 @@
 # pytype: disable=attribute-error
 from django.apps import apps
 from django.apps.config import AppConfig
-from django.db.models import F
+from django.db.models import F, Q
 from django.db import models
 
 import logging
@@ -537,8 +537,9 @@ class Equality_checker(Abstract_exclude_checker):
 	"""
 
 	default_limit = 5
-	# Exceptions is the list of primary IDs of the model to ignore
-	def __init__(self, main_model, value1, value2, value2_is_field_name=True, exceptions: Optional[Set]=None):  # main_model may be a model class or a model name
+	# Exceptions is the list of primary IDs of the model to ignore. If condition is given, only the rows satisfying it are checked.
+	def __init__(self, main_model, value1, value2, value2_is_field_name=True, exceptions: Optional[Set]=None,
+			condition: Optional[Q]=None):  # main_model may be a model class or a model name
 		# TODO Check working with russian text in value2
 		#	(self.get_python_code does not work).
 		main_model = get_model_by_name(main_model)
@@ -549,6 +550,8 @@ class Equality_checker(Abstract_exclude_checker):
 		self.qs = main_model.objects.exclude(**self.exclude_dict)
 		if exceptions:
 			self.qs = self.qs.exclude(pk__in=exceptions)
+		if condition is not None:
+			self.qs = self.qs.filter(condition)
 		self.main_model = main_model
 		self.value1 = value1
 		self.value2 = value2
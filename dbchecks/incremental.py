@@ -0,0 +1,186 @@
+# Incremental consistency checks for the nightly robot.
+# Each check stores its state in results.models.Db_check_state, and the next run looks only at the rows changed since then:
+# by their last_update or added_time fields or by Table_update records. In tables without any of these, each run checks
+# the next ROWS_PER_RUN_WITHOUT_TRACKING ids. The checks run in parallel threads, each thread with its own DB connection.
+# The full mode checks all rows, like check_all_relationships2 and check_equality_by_list do. It should be run weekly:
+# only it finds the rows that refer to deleted objects.
+import concurrent.futures
+import datetime
+import functools
+import logging
+import operator
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection, models
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from results import models as results_models
+from tools.other import log_if_logger
+from .dbchecks import Equality_checker, Queryset_empty_checker
+
+N_WORKERS = 4
+ROWS_PER_RUN_WITHOUT_TRACKING = 200000
+CHANGE_TIME_FIELDS = ('last_update', 'added_time')
+
+class Relationship_incremental_check(object):
+	def __init__(self, model, field):
+		self.model = model
+		self.field = field
+		self.name = '{}.{}.{}'.format(model._meta.app_label, model.__name__, field.name)
+		self.related_paths = []
+
+	# Returns the number of bad rows and, if there are any, the same data as check_all_relationships2 returns.
+	def run(self, condition: Q) -> Tuple[int, Any]:
+		rows = self.model._base_manager.filter(condition)
+		related_values = self.field.related_model._base_manager.values(self.field.target_field.attname)
+		checker = Queryset_empty_checker(
+			rows.exclude(**{self.field.attname: None}).exclude(**{self.field.attname + '__in': related_values}), self.name).run()
+		failed = [] if checker.is_ok else [checker]
+		count_0 = -1
+		if not self.field.null:
+			null_checker = Queryset_empty_checker(rows.filter(**{self.field.attname: None}), self.name).run()
+			count_0 = null_checker.count
+			if not null_checker.is_ok:
+				failed.append(null_checker)
+		if not failed:
+			return 0, None
+		return max(count_0, 0) + checker.count, ((count_0, checker.count), ' UNION '.join(c.sql_listing_command() for c in failed))
+
+class Equality_incremental_check(object):
+	def __init__(self, model, value1: str, value2: str, exceptions: Optional[Set]):
+		self.model = model
+		self.value1 = value1
+		self.value2 = value2
+		self.exceptions = exceptions
+		self.name = Equality_checker(model, value1, value2, True, exceptions=exceptions).check_subject
+		# The values also change when the related rows they come from change.
+		self.related_paths = get_related_paths(model, value1) + get_related_paths(model, value2)
+
+	# Returns the number of bad rows and, if there are any, the same data as check_equality_by_list returns.
+	def run(self, condition: Q) -> Tuple[int, Any]:
+		checker = Equality_checker(self.model, self.value1, self.value2, True, exceptions=self.exceptions, condition=condition).run()
+		if checker.is_ok:
+			return 0, None
+		return checker.count, (checker.count, checker.get_result2(), checker.sql_listing_command(), checker.get_python_code())
+
+# E.g. for Klb_result and 'klb_person__runner__id' returns [('klb_person__', Klb_person), ('klb_person__runner__', Runner)].
+def get_related_paths(model, value: str) -> List[Tuple[str, Any]]:
+	res = []
+	prefix = ''
+	for part in value.split('__')[:-1]:
+		field = model._meta.get_field(part)
+		if not field.is_relation:
+			break
+		model = field.related_model
+		prefix += part + '__'
+		res.append((prefix, model))
+	return res
+
+def get_relationship_checks() -> List[Relationship_incremental_check]:
+	return [Relationship_incremental_check(model, field)
+		for app_config in apps.get_app_configs()
+		for model in app_config.get_models()
+		for field in model._meta.get_fields()
+		if field.concrete and not field.auto_created and (field.many_to_one or field.one_to_one)
+	]
+
+# check_list has the same format as the joblist of check_equality_by_list.
+def get_equality_checks(check_list) -> List[Equality_incremental_check]:
+	return [Equality_incremental_check(apps.get_model(model) if isinstance(model, str) else model, value1, value2, exceptions)
+		for model, value1, value2, exceptions in check_list]
+
+# Returns the condition for the rows of model changed since the given time, or None if we cannot find them.
+# prefix is the path to model from the model being checked.
+def get_changed_rows_condition(model, since: datetime.datetime, prefix: str='') -> Optional[Q]:
+	conditions = []
+	for field_name in CHANGE_TIME_FIELDS:
+		try:
+			field = model._meta.get_field(field_name)
+		except FieldDoesNotExist:
+			continue
+		if isinstance(field, models.DateTimeField):
+			conditions.append(Q(**{prefix + field_name + '__gte': since}))
+	row_ids = set(results_models.Table_update.objects.filter(model_name=model.__name__, added_time__gte=since).values_list(
+		'row_id', flat=True))
+	if row_ids:
+		conditions.append(Q(**{prefix + 'pk__in': row_ids}))
+	if not conditions:
+		return None
+	return functools.reduce(operator.or_, conditions)
+
+class Check_runner(object):
+	def __init__(self, full: bool, logger=None, log_level_info=logging.INFO):
+		self.full = full
+		self.logger = logger
+		self.log_level_info = log_level_info
+		self._changed_rows_conditions = {} # Many checks share the same tables; we look for their changes only once.
+
+	def changed_rows_condition(self, model, since: datetime.datetime, prefix: str='') -> Optional[Q]:
+		key = (model, since, prefix)
+		if key not in self._changed_rows_conditions:
+			self._changed_rows_conditions[key] = get_changed_rows_condition(model, since, prefix)
+		return self._changed_rows_conditions[key]
+
+	# Returns the condition for the rows to check in this run and the new value of state.next_pk.
+	def get_rows_condition(self, check, state: results_models.Db_check_state) -> Tuple[Q, int]:
+		if self.full or (state.watermark is None):
+			return Q(), state.next_pk
+		condition = self.changed_rows_condition(check.model, state.watermark)
+		if condition is not None:
+			for prefix, related_model in check.related_paths:
+				related_condition = self.changed_rows_condition(related_model, state.watermark, prefix)
+				if related_condition is not None:
+					condition |= related_condition
+			return condition, state.next_pk
+		if not isinstance(check.model._meta.pk, models.IntegerField):
+			return Q(), state.next_pk
+		max_pk = check.model._base_manager.aggregate(Max('pk'))['pk__max'] or 0
+		next_pk = state.next_pk if (state.next_pk <= max_pk) else 0
+		return Q(pk__gte=next_pk, pk__lt=next_pk + ROWS_PER_RUN_WITHOUT_TRACKING), next_pk + ROWS_PER_RUN_WITHOUT_TRACKING
+
+	def run_check(self, check, state: results_models.Db_check_state) -> Tuple[datetime.datetime, float, Q, int, int, Any]:
+		started_at = timezone.now()
+		start = time.monotonic()
+		try:
+			condition, next_pk = self.get_rows_condition(check, state)
+			n_errors, data = check.run(condition)
+		finally:
+			connection.close() # Each thread has its own connection, so we close it after each check.
+		return started_at, time.monotonic() - start, condition, next_pk, n_errors, data
+
+	# Runs the checks in n_workers threads and returns the data about failed ones in the order of checks.
+	def run(self, checks, n_workers: int=N_WORKERS) -> Dict[str, Any]:
+		states = {state.name: state for state in results_models.Db_check_state.objects.filter(name__in=[check.name for check in checks])}
+		for check in checks:
+			if check.name not in states:
+				states[check.name] = results_models.Db_check_state(name=check.name)
+		results = {}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+			futures = {executor.submit(self.run_check, check, states[check.name]): check for check in checks}
+			for future in concurrent.futures.as_completed(futures):
+				check = futures[future]
+				started_at, duration, condition, next_pk, n_errors, data = future.result()
+				state = states[check.name]
+				# While there are errors, we check the same rows again, so that they are reported until they are fixed.
+				if n_errors == 0:
+					state.watermark = started_at
+				if condition == Q():
+					state.last_full_run = started_at
+				state.next_pk = next_pk
+				state.duration = duration
+				state.n_errors = n_errors
+				state.save()
+				if data is not None:
+					results[check.name] = data
+				log_if_logger(self.logger, self.log_level_info, '{}: {} errors, {:.1f} s'.format(check.name, n_errors, duration))
+		return {check.name: results[check.name] for check in checks if check.name in results}
+
+def check_all_relationships(full: bool=False, logger=None, log_level_info=logging.INFO) -> Dict[str, Any]:
+	return Check_runner(full, logger, log_level_info).run(get_relationship_checks())
+
+def check_equality_by_list(check_list, full: bool=False, logger=None, log_level_info=logging.INFO) -> Dict[str, Any]:
+	return Check_runner(full, logger, log_level_info).run(get_equality_checks(check_list))
@@ -0,0 +1,88 @@
+# In-process lookup tables for KLBMatch scores: sport classes, age coefficients and average top world results.
+# They change only when admins edit them, so bulk recalculations like update_match or check_bonuses shouldn't query them again and again.
+# Any change of these models calls invalidate(), and other processes notice it in at most VERSION_CHECK_INTERVAL seconds.
+import bisect
+import time
+from typing import Dict, Optional, Tuple
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+from results import models
+
+VERSION_CACHE_KEY = 'klb_score_tables_version'
+VERSION_CHECK_INTERVAL = 60 # In seconds
+
+# (year, gender) -> (lengths, master values, third class values); lengths are sorted
+_sport_classes: Optional[Dict[Tuple[int, int], Tuple[tuple, tuple, tuple]]] = None
+# (year, gender, age, length) -> coefficient
+_klb_coefficients = {}
+# (year, gender, distance_id) -> centiseconds
+_average_results = {}
+_version = None
+_version_checked_at = 0.
+
+def clear():
+	global _sport_classes, _version, _version_checked_at
+	_sport_classes = None
+	_klb_coefficients.clear()
+	_average_results.clear()
+	_version = cache.get(VERSION_CACHE_KEY, 0)
+	_version_checked_at = time.monotonic()
+
+# Makes all processes reload the tables. Is called on any change of the models the tables are built from.
+def invalidate(*args, **kwargs):
+	try:
+		cache.incr(VERSION_CACHE_KEY)
+	except ValueError: # There is no such key yet
+		cache.set(VERSION_CACHE_KEY, 1, timeout=None)
+	clear()
+
+def _check_version():
+	global _version_checked_at
+	now = time.monotonic()
+	if (_version is not None) and (now - _version_checked_at < VERSION_CHECK_INTERVAL):
+		return
+	_version_checked_at = now
+	if cache.get(VERSION_CACHE_KEY, 0) != _version:
+		clear()
+
+def _load_sport_classes() -> Dict[Tuple[int, int], Tuple[tuple, tuple, tuple]]:
+	rows = {}
+	for year, gender, length, master_value, third_class_value in models.Sport_class.objects.order_by('year', 'gender', 'length').values_list(
+			'year', 'gender', 'length', 'master_value', 'third_class_value'):
+		rows.setdefault((year, gender), []).append((length, master_value, third_class_value))
+	return {key: tuple(zip(*values)) for key, values in rows.items()}
+
+# Returns master value and third class value of the sport class with the biggest length not exceeding given one,
+# or None if there is no such class.
+def get_sport_class(year: int, gender: int, length: int) -> Optional[Tuple[int, int]]:
+	global _sport_classes
+	_check_version()
+	if _sport_classes is None:
+		_sport_classes = _load_sport_classes()
+	if (year, gender) not in _sport_classes:
+		return None
+	lengths, master_values, third_class_values = _sport_classes[(year, gender)]
+	index = bisect.bisect_right(lengths, length) - 1
+	if index < 0:
+		return None
+	return master_values[index], third_class_values[index]
+
+def get_klb_coefficient(year: int, gender: int, age: int, length: int):
+	_check_version()
+	key = (year, gender, age, length)
+	if key not in _klb_coefficients:
+		_klb_coefficients[key] = models.Coefficient.get_klb_coefficient(year, gender, age, length)
+	return _klb_coefficients[key]
+
+def get_average_result(year: int, gender: int, distance_id: int):
+	_check_version()
+	key = (year, gender, distance_id)
+	if key not in _average_results:
+		_average_results[key] = models.Top_world_result.get_average_result(year, gender, distance_id)
+	return _average_results[key]
+
+for model in (models.Sport_class, models.Coefficient, models.Top_world_result):
+	post_save.connect(invalidate, sender=model, dispatch_uid=f'klb_score_tables_{model.__name__}_save')
+	post_delete.connect(invalidate, sender=model, dispatch_uid=f'klb_score_tables_{model.__name__}_delete')
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import pathlib
+
+from editor.scrape import standard_form, util
+
+class Command(BaseCommand):
+	help = 'Converts scraped events stored as one event.json to the per-race standard form'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--platform_id', type=str, default=None, help='Convert only the events of this platform')
+		parser.add_argument('--debug', action='store_true', help='Print each converted event')
+
+	def handle(self, *args, **options):
+		root = pathlib.Path(settings.INTERNAL_FILES_ROOT) / util.DIR_FOR_FILE_TYPE[util.FILE_TYPE_STANDARD_FORM]
+		if options['platform_id']:
+			root /= options['platform_id']
+		n_converted, n_failed = standard_form.ConvertAllLegacy(root, debug=options['debug'])
+		print(f'Converted {n_converted} events, failed to convert {n_failed}')
@@ -3,7 +3,7 @@ from django.utils import timezone
 import datetime
 
 from results import models, results_util
-from editor import generators, monitoring, parse_weekly_events, regions_visited, runner_stat, series_strike, stat
+from editor import generators, monitoring, parse_weekly_events, rating_tables, regions_visited, runner_stat, series_strike, stat
 from editor.scrape import athlinks_series, nyrr, parkrun_series
 from editor.views import views_stat, views_klb_stat, views_user, views_age_group_record, views_klb_report
 
@@ -35,6 +35,8 @@ class Command(BaseCommand):
 		# try_call_function('Обновление календаря забегов на ближайшие месяц и год', generators.generate_default_calendars)
 		try_call_function('Обновление числа забегов в прошлом и будущем', stat.update_events_count)
 		try_call_function('Обновление числа результатов в базе', stat.update_results_count)
+		try_call_function('Пересчёт рейтингов забегов, в которых что-то изменилось', rating_tables.update_dirty_rating_tables)
+		try_call_function('Обновление лидеров по числу регионов с финишами', regions_visited.update_all_leaderboards)
 
 		today = datetime.date.today()
 		if today.weekday() in (0, 3):
@@ -47,10 +49,10 @@ class Command(BaseCommand):
 
 		if (today.month == 2) and (today.day == 1):
 			try_call_function(f'Обновление статистики всех бегунов для перехода на текущий {results_util.CUR_YEAR_FOR_RUNNER_STATS} год',
-				runner_stat.update_runners_stat, reset_cur_year_stat=True)
+				runner_stat.update_runners_stat_parallel, reset_cur_year_stat=True)
 
-		# if models.Strike_queue.objects.exists():
-		# 	try_call_function('Обновление страйков у серий, где были привязаны к людям результаты', series_strike.calc_strikes_from_queue)
+		if models.Strike_queue.objects.exists():
+			try_call_function('Обновление страйков у серий, где были привязаны к людям результаты', series_strike.calc_strikes_from_queue)
 
 		# try_call_function('Присоединение результатов, создание бегунов, письмо от Робота Присоединителя', views_stat.make_connections)
 
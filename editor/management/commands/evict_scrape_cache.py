@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import datetime
+import pathlib
+
+from editor.scrape import http_cache, util
+
+class Command(BaseCommand):
+	help = 'Deletes cached responses of scraped sites that were not used for long or take too much space'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--max_age_days', type=int, default=None, help='Delete files not used for that many days')
+		parser.add_argument('--max_gb', type=float, default=None, help='Then delete least recently used files until the rest take that many GB')
+
+	def handle(self, *args, **options):
+		root = pathlib.Path(settings.INTERNAL_FILES_ROOT) / util.DIR_FOR_FILE_TYPE[util.FILE_TYPE_DOWNLOADED]
+		n_deleted, freed_bytes = http_cache.Evict(root,
+			max_age=datetime.timedelta(days=options['max_age_days']) if options['max_age_days'] else None,
+			max_total_bytes=int(options['max_gb'] * 2**30) if options['max_gb'] else None,
+		)
+		print(f'Deleted {n_deleted} files, freed {freed_bytes / 2**20:.1f} MB')
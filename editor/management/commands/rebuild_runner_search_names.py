@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from results import models
+
+class Command(BaseCommand):
+	help = 'Recreates the normalized names of all runners used for search by name'
+
+	def handle(self, *args, **options):
+		n_rows = models.Runner_search_name.rebuild(debug=options['verbosity'] > 1)
+		print(f'Done! {n_rows} search names are created')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from editor.scrape import main, util
+
+class Command(BaseCommand):
+	help = 'Processes the protocol queues of all active platforms in parallel'
+
+	def add_arguments(self, parser):
+		parser.add_argument('-p', '--platform', action='append', help='Platform to process; may be repeated. By default, all active platforms')
+		parser.add_argument('-w', '--workers', type=int, default=0, help='Number of workers for each platform instead of default ones')
+		parser.add_argument('--exit_when_empty', action='store_true', help='Stop each worker when its queue is empty instead of waiting for new elements')
+
+	def handle(self, *args, **options):
+		platform_ids = options['platform'] or None
+		n_workers_by_platform = {}
+		if options['workers'] > 0:
+			n_workers_by_platform = {platform_id: options['workers'] for platform_id in (platform_ids or util.ACTIVE_PLATFORM_IDS)}
+		main.run_queue_workers(platform_ids=platform_ids, n_workers_by_platform=n_workers_by_platform, exit_when_empty=options['exit_when_empty'])
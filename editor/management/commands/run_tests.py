@@ -17,12 +17,48 @@ class Command(BaseCommand):
 		# suite = unittest.TestLoader().loadTestsFromTestCase(tests.KLBScoreTest)
 		# unittest.TextTestRunner(verbosity=2).run(suite)
 
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.KLBMatchTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.KeysetPaginationTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.RatingTableTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.PageCacheTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.IncrementalDbChecksTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.AuditLogBufferTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.StrikeBitmapTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.RegionsVisitedTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
 		suite = unittest.TestLoader().loadTestsFromTestCase(tests.TrackerURLTest)
 		unittest.TextTestRunner(verbosity=2).run(suite)
 
 		suite = unittest.TestLoader().loadTestsFromTestCase(tests.EddingtonTest)
 		unittest.TextTestRunner(verbosity=2).run(suite)
 
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.PlacesTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.NameBirthdayIndexTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.RunnerSearchNameTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
+		suite = unittest.TestLoader().loadTestsFromTestCase(tests.AgeGroupRecordTest)
+		unittest.TextTestRunner(verbosity=2).run(suite)
+
 		# suite = unittest.TestLoader().loadTestsFromTestCase(runsignup_test.RunsignupTestCase)
 		# unittest.TextTestRunner(verbosity=2).run(suite)
 
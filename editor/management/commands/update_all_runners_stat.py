@@ -7,6 +7,17 @@ class Command(BaseCommand):
 
 	def add_arguments(self, parser):
 		parser.add_argument('-f', '--from', type=int, default=0, help='First runner_id to work with')
+		parser.add_argument('-w', '--workers', type=int, default=0,
+			help='If positive, update runners in that many processes and continue the previous killed run, if any')
+		parser.add_argument('--aggregates', action='store_true',
+			help='Only recalculate the numbers of starts, total lengths and times and Eddington numbers in a vectorized way')
+		parser.add_argument('--restart', action='store_true', help='With --workers: start from the first runner even if the previous run was killed')
 
 	def handle(self, *args, **options):
-		runner_stat.update_runners_stat(id_from=options['from'], debug=1)
+		if options['aggregates']:
+			n_changed = runner_stat.update_runners_aggregates(id_from=options['from'], debug=1)
+			print(f'Runners changed: {n_changed}')
+		elif options['workers'] > 0:
+			runner_stat.update_runners_stat_parallel(n_workers=options['workers'], restart=options['restart'], debug=1)
+		else:
+			runner_stat.update_runners_stat(id_from=options['from'], debug=1)
@@ -4,8 +4,6 @@ from django.contrib.auth.models import Group
 
 from collections import Counter, defaultdict
 import datetime
-import io
-import json
 import os
 import re
 import urllib.parse
@@ -191,8 +189,8 @@ def FillNyrrClubs():
 			raise Exception(f'Race {race.id}: wrong platform {race.event.platform_id}')
 		platform_event_id = race.event.id_on_platform
 		scraper = nyrr.NyrrScraper(url=f'https://results.nyrr.org/event/{platform_event_id}/finishers', platform_series_id=platform_event_id, platform_event_id=platform_event_id)
-		with io.open(scraper.StandardFormPath(), encoding="utf8") as json_in:
-			standard_form_dict = json.load(json_in)
+		scraper.ReadStandardForm()
+		standard_form_dict = scraper.standard_form_dict
 
 		print(f'Event {platform_event_id}: {len(standard_form_dict["races"][0]["results"])} results')
 
@@ -250,8 +248,7 @@ def FixNyrrRunnerIDs():
 			raise Exception(f'Race {race.id}: wrong platform {race.event.platform_id}')
 		platform_event_id = race.event.id_on_platform
 		scraper = nyrr.NyrrScraper(url=f'https://results.nyrr.org/event/{platform_event_id}/finishers', platform_series_id=platform_event_id, platform_event_id=platform_event_id)
-		with io.open(scraper.StandardFormPath(), encoding="utf8") as json_in:
-			scraper.standard_form_dict = json.load(json_in)
+		scraper.ReadStandardForm()
 
 		for result_dict in scraper.standard_form_dict["races"][0]["results"]:
 			if 'runner_id_on_platform' not in result_dict:
@@ -0,0 +1,62 @@
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from results import forms, models, results_util
+from results.views import views_race
+
+POSITIONS_PER_BATCH = 5000
+TABLE_COUNTRY_IDS = ('', forms.RATING_COUNTRY_DEFAULT) # '' means all countries
+
+# The ratings that we keep precalculated. Other combinations are calculated on each view, as before.
+# Tables are created only here, not on views, so that crawlers can't make us rebuild lots of them each night.
+def get_table_keys() -> list[tuple[str, int, int, int]]:
+	res = []
+	for country_id in TABLE_COUNTRY_IDS:
+		for distance_id in results_util.DISTANCES_FOR_RATING + (results_util.DISTANCE_ANY, results_util.DISTANCE_WHOLE_EVENTS):
+			for year in forms.RATING_YEARS:
+				for rating_type, _ in forms.RATING_TYPES:
+					if (distance_id in (results_util.DISTANCE_ANY, results_util.DISTANCE_WHOLE_EVENTS)) \
+							and (rating_type not in forms.RATING_TYPES_BY_FINISHERS):
+						continue
+					res.append((country_id, distance_id, year, rating_type))
+	return res
+
+# Creates the tables for new years. They are dirty, so they are built right after that.
+def create_missing_rating_tables() -> int:
+	existing = set(models.Rating_table.objects.values_list('country_id', 'distance_id', 'year', 'rating_type'))
+	tables = [models.Rating_table(country_id=country_id, distance_id=distance_id, year=year, rating_type=rating_type)
+		for country_id, distance_id, year, rating_type in get_table_keys() if (country_id, distance_id, year, rating_type) not in existing]
+	models.Rating_table.objects.bulk_create(tables)
+	return len(tables)
+
+# Recalculates the rating and stores the ids of its events, races or results in their order.
+def rebuild_rating_table(table: models.Rating_table) -> int:
+	# If the table is marked as dirty again while we are working, it will be rebuilt next time.
+	models.Rating_table.objects.filter(pk=table.pk).update(is_dirty=False)
+	country = models.Country.objects.filter(pk=table.country_id).first() if table.country_id else None
+	country_ids = [country.id] if country else forms.RATING_COUNTRY_IDS
+	distance = models.Distance.objects.filter(pk=table.distance_id).first()
+	queryset, value_field = views_race.get_rating_queryset(country_ids, distance, table.distance_id, table.year or None, table.rating_type)
+	rows = list(queryset.prefetch_related(None).values_list('id', value_field))
+	with transaction.atomic():
+		table.rating_position_set.all().delete()
+		models.Rating_position.objects.bulk_create([models.Rating_position(table=table, position=i, object_id=object_id, value=value or 0)
+			for i, (object_id, value) in enumerate(rows, start=1)], batch_size=POSITIONS_PER_BATCH)
+		table.n_entries = len(rows)
+		table.last_update = timezone.now()
+		table.save(update_fields=['n_entries', 'last_update'])
+	return len(rows)
+
+# Rebuilds all tables affected by changes of races since the last run.
+def update_dirty_rating_tables(debug: bool=False) -> str:
+	n_tables = n_positions = 0
+	create_missing_rating_tables()
+	for table in list(models.Rating_table.objects.filter(is_dirty=True).order_by('id')):
+		n_positions += rebuild_rating_table(table)
+		n_tables += 1
+		if debug:
+			print(f'{datetime.datetime.now()} Table {table.id} ({table.country_id}, {table.distance_id}, {table.year}, {table.rating_type}):'
+				+ f' {table.n_entries} positions')
+	return f'Пересчитано рейтингов: {n_tables}, строк в них: {n_positions}'
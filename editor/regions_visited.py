@@ -1,31 +1,113 @@
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Max, Q
 
 from results import models, results_util
 
-from collections import Counter, defaultdict
-from typing import Optional
+import array
+from collections import Counter
+import heapq
+import itertools
+from typing import Dict, Iterable, List, Optional, Tuple
 
 N_TO_STORE = 100
-def fill_regions_visited(country: models.Country, distance: Optional[models.Distance]):
-	country.regions_visited_set.filter(distance=distance).delete()
-	results = models.Result.objects.filter(
-		Q(race__event__city__region__country=country) | Q(race__event__city=None, race__event__series__city__region__country=country),
+COUNTRY_IDS = ('RU', 'BY')
+DISTANCE_IDS = (results_util.DIST_MARATHON_ID, None) # None means all distances
+MAX_COUNT = 2**16 - 1 # Counts are stored as unsigned shorts
+ROWS_PER_QUERY = 1000
+RUNNERS_PER_QUERY = 20000 # When reading all results, we take the results of that many consecutive runner ids at a time
+
+# region_id -> (country_id, index_in_country) for all regions of COUNTRY_IDS.
+_region_indexes: Dict[int, Tuple[str, int]] = {}
+
+# Gives indexes to new regions: the next free number in their country.
+def assign_region_indexes():
+	with transaction.atomic():
+		regions = list(models.Region.objects.select_for_update().filter(country_id__in=COUNTRY_IDS, index_in_country=None).order_by('id'))
+		if not regions:
+			return
+		next_index = {}
+		for country_id in COUNTRY_IDS:
+			max_index = models.Region.objects.filter(country_id=country_id).aggregate(Max('index_in_country'))['index_in_country__max']
+			next_index[country_id] = (max_index + 1) if (max_index is not None) else 0
+		for region in regions:
+			region.index_in_country = next_index[region.country_id]
+			next_index[region.country_id] += 1
+			region.save(update_fields=['index_in_country'])
+
+def get_region_indexes(region_ids: Iterable[int]=()) -> Dict[int, Tuple[str, int]]:
+	if (not _region_indexes) or any(region_id not in _region_indexes for region_id in region_ids):
+		assign_region_indexes()
+		_region_indexes.clear()
+		for region_id, country_id, index in models.Region.objects.filter(country_id__in=COUNTRY_IDS).values_list(
+				'id', 'country_id', 'index_in_country'):
+			_region_indexes[region_id] = (country_id, index)
+	return _region_indexes
+
+def counts_to_bytes(counts: List[int]) -> bytes:
+	while counts and (counts[-1] == 0):
+		counts = counts[:-1]
+	return array.array('H', [min(count, MAX_COUNT) for count in counts]).tobytes() # Little-endian on all our servers
+
+def counts_from_bytes(value) -> List[int]:
+	res = array.array('H')
+	res.frombytes(bytes(value))
+	return res.tolist()
+
+def bits_to_bytes(bits: int) -> bytes:
+	return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+# Creates the row for given counts by region index, or returns None if the runner has no finishes there.
+def make_runner_regions(country_id: str, distance_id: Optional[int], runner_id: int, counts: List[int]) -> Optional[models.Runner_regions]:
+	bits = 0
+	for index, count in enumerate(counts):
+		if count:
+			bits |= 1 << index
+	if bits == 0:
+		return None
+	return models.Runner_regions(
+		country_id=country_id,
+		distance_id=distance_id,
+		runner_id=runner_id,
+		regions=bits_to_bytes(bits),
+		counts=counts_to_bytes(counts),
+		n_finishes=sum(counts),
+		value=bin(bits).count('1'),
+	)
+
+def finished_in_countries(results, country_ids: Iterable[str]):
+	return results.filter(
+		Q(race__event__city__region__country_id__in=country_ids) | Q(race__event__city=None, race__event__series__city__region__country_id__in=country_ids),
 		status=models.STATUS_FINISHED,
-	).exclude(runner=None)
-	if distance:
-		results = results.filter(race__distance=distance)
-	runners = defaultdict(set)
-	runners_total_finishes = Counter()
-	for runner_id, event_region, series_region in results.values_list('runner_id', 'race__event__city__region_id', 'race__event__series__city__region_id'):
-		region_id = event_region if event_region else series_region
-		runners[runner_id].add(region_id)
-		runners_total_finishes[runner_id] += 1
-	runners_count = sorted([(len(regions), runner_id) for runner_id, regions in runners.items()], reverse=True)
-	min_len_to_store = runners_count[N_TO_STORE][0]
+	)
+
+# Recalculates all rows of the runner in Runner_regions from their results. Is called when the runner's results change.
+def update_runner_regions(runner_id: int):
+	rows = list(finished_in_countries(models.Result.objects.filter(runner_id=runner_id), COUNTRY_IDS).values_list(
+		'race__distance_id', 'race__event__city__region_id', 'race__event__series__city__region_id'))
+	region_indexes = get_region_indexes(event_region if event_region else series_region for _, event_region, series_region in rows)
+	counts = {}
+	for distance_id, event_region, series_region in rows:
+		country_id, index = region_indexes[event_region if event_region else series_region]
+		for key in ((country_id, None), (country_id, distance_id)):
+			if key[1] not in DISTANCE_IDS:
+				continue
+			if key not in counts:
+				counts[key] = []
+			if len(counts[key]) <= index:
+				counts[key] += [0] * (index + 1 - len(counts[key]))
+			counts[key][index] += 1
+	with transaction.atomic():
+		models.Runner_regions.objects.filter(runner_id=runner_id).delete()
+		models.Runner_regions.objects.bulk_create([make_runner_regions(country_id, distance_id, runner_id, runner_counts)
+			for (country_id, distance_id), runner_counts in counts.items()])
 
+# Rebuilds the top of Regions_visited from Runner_regions.
+# We store N_TO_STORE runners with most regions, all runners with the same value as the last of them, but not more than 5 * N_TO_STORE.
+def save_leaderboard(country: models.Country, distance: Optional[models.Distance], top: List[Tuple[int, int, int]]):
+	min_len_to_store = top[N_TO_STORE][0] if (len(top) > N_TO_STORE) else 0
 	objs = []
 	last_place = last_value = index = 0
-	for value, runner_id in runners_count[:5 * N_TO_STORE]:
+	for value, runner_id, n_finishes in top:
 		if value < min_len_to_store:
 			break
 		index += 1
@@ -35,34 +117,76 @@ def fill_regions_visited(country: models.Country, distance: Optional[models.Dist
 			distance=distance,
 			runner_id=runner_id,
 			place=place,
-			n_finishes=runners_total_finishes[runner_id],
+			n_finishes=n_finishes,
 			value=value,
 		))
 		last_place = place
 		last_value = value
-	models.Regions_visited.objects.bulk_create(objs)
+	with transaction.atomic():
+		country.regions_visited_set.filter(distance=distance).delete()
+		models.Regions_visited.objects.bulk_create(objs)
 
-def generate_all():
-	country = models.Country.objects.get(pk='RU')
-	marathon = models.Distance.objects.get(pk=results_util.DIST_MARATHON_ID)
-	fill_regions_visited(country, marathon)
-	fill_regions_visited(country, distance=None)
-	country = models.Country.objects.get(pk='BY')
-	fill_regions_visited(country, marathon)
-	fill_regions_visited(country, distance=None)
-
-def regions_for_runner(runner: models.Runner, country: models.Country, distance: Optional[models.Distance]):
-	regions = Counter()
-	results = runner.result_set.filter(
-		Q(race__event__city__region__country=country) | Q(race__event__city=None, race__event__series__city__region__country=country),
-		status=models.STATUS_FINISHED,
-	)
+def update_leaderboard(country: models.Country, distance: Optional[models.Distance]):
+	top = list(models.Runner_regions.objects.filter(country=country, distance=distance).order_by('-value', '-runner_id').values_list(
+		'value', 'runner_id', 'n_finishes')[:5 * N_TO_STORE])
+	save_leaderboard(country, distance, top)
+
+def update_all_leaderboards():
+	distances = {distance.id: distance for distance in models.Distance.objects.filter(pk__in=[distance_id for distance_id in DISTANCE_IDS if distance_id])}
+	for country in models.Country.objects.filter(pk__in=COUNTRY_IDS):
+		for distance_id in DISTANCE_IDS:
+			update_leaderboard(country, distances.get(distance_id))
+
+# Yields the rows of the queryset for runner ids in [0, max runner id] in the order of runner_id.
+# We read them by ranges of runner ids: mysqlclient loads the whole result of a query to memory, even with iterator().
+def rows_by_runner_ranges(results, *fields):
+	max_runner_id = models.Runner.objects.aggregate(Max('id'))['id__max'] or 0
+	for id_from in range(0, max_runner_id + 1, RUNNERS_PER_QUERY):
+		yield from results.filter(runner_id__gte=id_from, runner_id__lt=id_from + RUNNERS_PER_QUERY).order_by('runner_id').values_list(
+			'runner_id', *fields)
+
+# Rebuilds Runner_regions and Regions_visited for the country from all results, without keeping all runners in memory:
+# the results are read in the order of runners, and only the top is kept in a bounded heap.
+def fill_regions_visited(country: models.Country, distance: Optional[models.Distance]):
+	region_indexes = get_region_indexes()
+	results = finished_in_countries(models.Result.objects.exclude(runner=None), [country.id])
 	if distance:
 		results = results.filter(race__distance=distance)
-	for result in results.select_related('race__event__city__region', 'race__event__series__city__region'):
-		region = result.race.event.city.region if result.race.event.city else result.race.event.series.city.region
-		regions[region] += 1
-	i = 0
-	for region, value in regions.most_common(100):
-		i += 1
-		print(f'{i}. {value} - {region}')
+	rows = rows_by_runner_ranges(results, 'race__event__city__region_id', 'race__event__series__city__region_id')
+	country.runner_regions_set.filter(distance=distance).delete()
+	top = [] # A min-heap of (value, runner_id, n_finishes) with at most 5 * N_TO_STORE elements
+	objs = []
+	for runner_id, runner_rows in itertools.groupby(rows, key=lambda row: row[0]):
+		regions = Counter(event_region if event_region else series_region for _, event_region, series_region in runner_rows)
+		counts = []
+		for region_id, count in regions.items():
+			index = region_indexes[region_id][1] if (region_id in region_indexes) else get_region_indexes([region_id])[region_id][1]
+			if len(counts) <= index:
+				counts += [0] * (index + 1 - len(counts))
+			counts[index] = count
+		obj = make_runner_regions(country.id, distance.id if distance else None, runner_id, counts)
+		objs.append(obj)
+		if len(top) < 5 * N_TO_STORE:
+			heapq.heappush(top, (obj.value, runner_id, obj.n_finishes))
+		else:
+			heapq.heappushpop(top, (obj.value, runner_id, obj.n_finishes))
+		if len(objs) >= ROWS_PER_QUERY:
+			models.Runner_regions.objects.bulk_create(objs)
+			objs = []
+	models.Runner_regions.objects.bulk_create(objs)
+	save_leaderboard(country, distance, sorted(top, reverse=True))
+
+def generate_all():
+	marathon = models.Distance.objects.get(pk=results_util.DIST_MARATHON_ID)
+	for country in models.Country.objects.filter(pk__in=COUNTRY_IDS):
+		fill_regions_visited(country, marathon)
+		fill_regions_visited(country, distance=None)
+
+# Returns the list of pairs (region, number of finishes there) sorted by region name.
+def regions_for_runner(runner: models.Runner, country: models.Country, distance: Optional[models.Distance]) -> List[Tuple[models.Region, int]]:
+	runner_regions = models.Runner_regions.objects.filter(runner=runner, country=country, distance=distance).first()
+	if runner_regions is None:
+		return []
+	regions_by_index = {region.index_in_country: region for region in country.region_set.exclude(index_in_country=None)}
+	return sorted(((regions_by_index[index], count) for index, count in enumerate(counts_from_bytes(runner_regions.counts)) if count),
+		key=lambda x: x[0].name)
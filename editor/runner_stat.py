@@ -1,9 +1,18 @@
+from collections import defaultdict
+import concurrent.futures
 import datetime
-from typing import Iterable, List, Optional, Tuple
+import multiprocessing
+import pandas as pd
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
 
 from results import models, results_util
+from editor import klb_score_tables, regions_visited
 
 # Returns the real length in meters and real time in centiseconds covered by the runner.
 def length_time(result: models.Result) -> Tuple[int, int]:
@@ -29,46 +38,61 @@ def eddington(lengths: List[int]) -> Tuple[int, int]:
 			return i, needed_for_next_step(i + 1, lengths_desc[:i])
 	return len(lengths), needed_for_next_step(len(lengths) + 1, lengths)
 
-# Returns two values:
-# * list of lengths of all completed distances,
-# * total time to complete them (when known) in deciseconds.
-def update_distance_stat(
-			distance: models.Distance,
-			runner: Optional[models.Runner]=None,
-			user: Optional[User]=None,
-			club_member: Optional[models.Club_member]=None,
-			year: Optional[int]=None,
-		) -> Tuple[List[int], int]:
-	if runner:
-		result_set = runner.result_set
-		person = runner
-	elif user:
-		result_set = user.result_set
-		person = user.user_profile if hasattr(user, 'user_profile') else models.User_profile(user=user)
-	elif club_member:
-		result_set = club_member.runner.result_set
-		person = club_member.runner
-	else:
-		raise Exception('Exactly one of runner, user, club_member must be not None.')
+# The fields of User_stat that calc_distance_stat fills.
+STAT_FIELDS = ('n_starts', 'is_popular', 'value_best', 'pace_best', 'best_result_id', 'value_best_age_coef', 'best_result_age_coef_id',
+	'value_mean', 'value_mean_age_coef', 'pace_mean')
 
-	to_calc_age_coef_data = club_member and (distance.distance_type not in models.TYPES_MINUTES) \
-		and (person.gender != models.GENDER_UNKNOWN) and person.birthday
-
-	result_set = result_set.filter(
-		race__distance=distance,
-		race__exclude_from_stat=False,
-		do_not_count_in_stat=False,
+# Loads with one query all results from result_set that may be counted in statistics.
+def load_results_for_stat(result_set) -> List[models.Result]:
+	return list(result_set.filter(
 		status__in=(models.STATUS_FINISHED, models.STATUS_COMPLETED),
-	)
-	if year:
-		result_set = result_set.filter(race__event__start_date__year=year)
-	if club_member:
-		if club_member.date_registered:
-			result_set = result_set.filter(race__event__start_date__gte=club_member.date_registered)
-		if club_member.date_removed:
-			result_set = result_set.filter(race__event__start_date__lte=club_member.date_removed)
-	results = result_set.select_related('race__event', 'race__distance', 'race__distance_real').order_by(
-		'-result' if (distance.distance_type in models.TYPES_MINUTES) else 'result')
+		race__distance__distance_type__in=models.TYPES_FOR_RUNNER_STAT,
+	).select_related('race__event', 'race__distance', 'race__distance_real'))
+
+# Returns the dict <distance_id> -> <list of results at this distance from best to worst>.
+def group_by_distance(results: Iterable[models.Result]) -> Dict[int, List[models.Result]]:
+	res = defaultdict(list)
+	for result in results:
+		res[result.race.distance_id].append(result)
+	for distance_results in res.values():
+		distance_results.sort(key=lambda result: result.result,
+			reverse=(distance_results[0].race.distance.distance_type in models.TYPES_MINUTES))
+	return res
+
+# Returns the results that count in statistics for given year (if any) and while the runner was in given club (if any).
+def filter_results_for_stat(
+			results: Iterable[models.Result],
+			year: Optional[int]=None,
+			club_member: Optional[models.Club_member]=None,
+		) -> List[models.Result]:
+	res = []
+	for result in results:
+		if result.race.exclude_from_stat or result.do_not_count_in_stat:
+			continue
+		start_date = result.race.event.start_date
+		if year and (start_date.year != year):
+			continue
+		if club_member:
+			if club_member.date_registered and (start_date < club_member.date_registered):
+				continue
+			if club_member.date_removed and (start_date > club_member.date_removed):
+				continue
+		res.append(result)
+	return res
+
+# Receives the results at one distance that count in statistics, from best to worst.
+# If age_coef_person is provided, also calculates the values with age coefficients for them.
+# Returns three values:
+# * dict with the values of STAT_FIELDS, or None if there are no results,
+# * list of lengths of all completed distances,
+# * total time to complete them (when known) in centiseconds.
+def calc_distance_stat(
+			distance: models.Distance,
+			results: List[models.Result],
+			age_coef_person: Optional[models.Runner]=None,
+		) -> Tuple[Optional[Dict[str, Any]], List[int], int]:
+	to_calc_age_coef_data = age_coef_person and (distance.distance_type not in models.TYPES_MINUTES) \
+		and (age_coef_person.gender != results_util.GENDER_UNKNOWN) and age_coef_person.birthday
 
 	lengths = []
 	results_with_time = []
@@ -80,11 +104,11 @@ def update_distance_stat(
 			results_with_time.append(result)
 			total_time += time
 	if not lengths:
-		return [], 0
+		return None, [], 0
 
-	stat = models.User_stat(runner=runner, user=user, club_member=club_member, distance=distance, year=year)
-	stat.n_starts = len(lengths)
-	results_sum = 0
+	stat = dict.fromkeys(STAT_FIELDS)
+	stat['n_starts'] = len(lengths)
+	stat['is_popular'] = False
 	# Let's find best race with real distance not less than official distance.
 	if results_with_time: # Or maybe we have only result with status=models.STATUS_COMPLETED.
 		value_best = None
@@ -101,8 +125,8 @@ def update_distance_stat(
 
 			if to_calc_age_coef_data: # So the distance is measured in meters
 				result_year = result.race.event.start_date.year
-				result_age_coef = result.result * models.Coefficient.get_klb_coefficient(result_year, person.gender,
-					result_year - person.birthday.year, distance.length)
+				result_age_coef = result.result * klb_score_tables.get_klb_coefficient(result_year, age_coef_person.gender,
+					result_year - age_coef_person.birthday.year, distance.length)
 				results_age_coef_sum += result_age_coef
 				if (
 						( (value_best_age_coef is None) or (time_age_coef_best > result_age_coef) )
@@ -117,136 +141,157 @@ def update_distance_stat(
 			value_best_age_coef = results_with_time[0]
 			time_age_coef_best = results_with_time[0].result # Not exact but let it be...
 
-		race_best = value_best.race
-		stat.best_result = value_best
-		stat.value_best = value_best.result
-		stat.pace_best = race_best.get_pace(stat.value_best)
+		stat['best_result_id'] = value_best.id
+		stat['value_best'] = value_best.result
+		stat['pace_best'] = value_best.race.get_pace(stat['value_best'])
 
-		stat.value_mean = int(round(results_sum / len(results_with_time)))
-		stat.pace_mean = distance.get_pace(stat.value_mean)
-		if (distance.distance_type not in models.TYPES_MINUTES) and (stat.value_mean > 6000):
-			stat.value_mean = int(round(stat.value_mean, -2))
+		stat['value_mean'] = int(round(results_sum / len(results_with_time)))
+		stat['pace_mean'] = distance.get_pace(stat['value_mean'])
+		if (distance.distance_type not in models.TYPES_MINUTES) and (stat['value_mean'] > 6000):
+			stat['value_mean'] = int(round(stat['value_mean'], -2))
 
 		if to_calc_age_coef_data:
-			race_age_coef_best = value_best_age_coef.race # pytype: disable=attribute-error
-			stat.best_result_age_coef = value_best_age_coef
-			stat.value_best_age_coef = time_age_coef_best
-			stat.value_mean_age_coef = int(round(results_age_coef_sum / len(results_with_time)))
-
-	try:
-		stat.save()
-	except Exception as e:
-		# Sometimes it causes Duplicate entry errors.
-		pass
-		# fields = []
-		# if runner:
-		# 	fields.append(f'runner {runner.id}')
-		# if user:
-		# 	fields.append(f'user {user.id}')
-		# if club_member:
-		# 	fields.append(f'club_member {club_member}')
-		# if distance:
-		# 	fields.append(f'distance {distance}')
-		# if year:
-		# 	fields.append(f'year {year}')
-		# if stat.pace_best:
-		# 	fields.append(f'pace_best {stat.pace_best}')
-		# models.send_panic_email('Problem when saving stat', f'For {", ".join(fields)}: {repr(e)}')
-	return lengths, total_time
-
-def update_club_member_stat(club_member, distance, year):
+			stat['best_result_age_coef_id'] = value_best_age_coef.id # pytype: disable=attribute-error
+			stat['value_best_age_coef'] = int(time_age_coef_best) # The DB stores it as an integer anyway.
+			stat['value_mean_age_coef'] = int(round(results_age_coef_sum / len(results_with_time)))
+	return stat, lengths, total_time
+
+# Makes the rows of User_stat from existing_stats equal to new_stats: {(distance_id, year): <values of STAT_FIELDS>}.
+# Writes only the rows that changed. owner is one of runner=..., user=..., club_member=...
+def save_stats(existing_stats, new_stats: Dict[Tuple[int, Optional[int]], Dict[str, Any]], **owner):
+	existing = {(stat.distance_id, stat.year): stat for stat in existing_stats}
+	stats_to_create = []
+	stats_to_update = []
+	now = timezone.now()
+	for (distance_id, year), values in new_stats.items():
+		stat = existing.pop((distance_id, year), None)
+		if stat is None:
+			stats_to_create.append(models.User_stat(distance_id=distance_id, year=year, **owner, **values))
+		elif any(getattr(stat, field) != value for field, value in values.items()):
+			for field, value in values.items():
+				setattr(stat, field, value)
+			stat.last_update = now
+			stats_to_update.append(stat)
+	if existing:
+		models.User_stat.objects.filter(pk__in=[stat.id for stat in existing.values()]).delete()
+	# Sometimes concurrent updates cause Duplicate entry errors. Then the other process has just created the same row.
+	models.User_stat.objects.bulk_create(stats_to_create, ignore_conflicts=True)
+	models.User_stat.objects.bulk_update(stats_to_update, STAT_FIELDS + ('last_update', ))
+
+# Returns the years for which we need the statistics of club_member. None means "for all years".
+def club_member_years(club_member: models.Club_member, year: Optional[int]=None) -> List[Optional[int]]:
 	if year:
-		years = [year]
-	else: # We have to update all years when member was in club
-		min_year = models.FIRST_YEAR_FOR_STAT_UPDATE
-		if club_member.date_registered and club_member.date_registered.year > min_year:
-			min_year = club_member.date_registered.year
-		max_year = datetime.date.today().year
-		if club_member.date_removed and club_member.date_removed.year < max_year:
-			max_year = club_member.date_removed.year
-		years = [None] + list(range(min_year, max_year + 1))
-	for member_year in years:
-		update_distance_stat(distance, club_member=club_member, year=member_year)
+		return [year]
+	# We have to update all years when member was in club
+	min_year = models.FIRST_YEAR_FOR_STAT_UPDATE
+	if club_member.date_registered and club_member.date_registered.year > min_year:
+		min_year = club_member.date_registered.year
+	max_year = datetime.date.today().year
+	if club_member.date_removed and club_member.date_removed.year < max_year:
+		max_year = club_member.date_removed.year
+	return [None] + list(range(min_year, max_year + 1))
 
 DISTANCE_LIMIT = 5
-# Exactly one of runner, user, club_member must be not None
+# Exactly one of runner, user, club_member must be not None.
+# Loads all their results with one query, calculates all statistics in memory
+# and writes only the User_stat rows that changed.
 def update_runner_stat(runner=None, user=None, club_member=None, year=None, update_club_members=True):
 	person = None
 	person_for_stat = None
 	club_members = []
+	club_result_set = None # Club members' statistics are based on the results of their runners.
 	if runner:
 		result_set = runner.result_set
 		person = runner
 		person_for_stat = runner
 		if update_club_members:
-			club_members = runner.club_member_set.all()
+			club_members = list(runner.club_member_set.all())
+			club_result_set = result_set
 	elif user:
 		result_set = user.result_set
 		person = user
 		if hasattr(user, 'user_profile'):
 			person_for_stat = user.user_profile
 		if update_club_members and hasattr(user, 'runner'):
-			club_members = user.runner.club_member_set.all()
+			club_members = list(user.runner.club_member_set.all())
+			club_result_set = user.runner.result_set
 	elif club_member:
 		result_set = club_member.runner.result_set
 		person = club_member
 		club_members = [club_member]
+		club_result_set = result_set
 
 	if person is None:
 		return
 
-	all_lengths = []
-	total_time = 0
-	all_lengths_cur_year = []
-	total_time_cur_year = 0
 	cur_year = results_util.CUR_YEAR_FOR_RUNNER_STATS
+	results_by_distance = group_by_distance(load_results_for_stat(result_set))
 
 	if runner or user:
-		person.user_stat_set.all().delete()
-	if update_club_members:
-		for m in club_members:
-			if year:
-				m.user_stat_set.filter(year=year).delete()
-			else:
-				m.user_stat_set.all().delete()
-
-	distance_ids = result_set.filter(
-			status__in=(models.STATUS_FINISHED, models.STATUS_COMPLETED),
-			race__distance__distance_type__in=models.TYPES_FOR_RUNNER_STAT,
-		).order_by(
-		'race__distance_id').values_list('race__distance_id', flat=True).distinct()
-	for distance_id in distance_ids:
-		distance = models.Distance.objects.get(pk=distance_id)
+		all_lengths = []
+		total_time = 0
+		all_lengths_cur_year = []
+		total_time_cur_year = 0
+		new_stats = {}
 		if person_for_stat:
-			lengths, sum_time = update_distance_stat(distance, runner=runner, user=user, club_member=club_member)
-			all_lengths += lengths
-			total_time += sum_time
-			if runner:
-				lengths, sum_time = update_distance_stat(distance, runner=runner, user=user, club_member=club_member, year=cur_year)
-				all_lengths_cur_year += lengths
-				total_time_cur_year += sum_time
-		if update_club_members and (distance_id in results_util.DISTANCES_FOR_CLUB_STATISTICS):
-			for m in club_members:
-				update_club_member_stat(m, distance, year)
+			for distance_id, results in results_by_distance.items():
+				distance = results[0].race.distance
+				stat, lengths, sum_time = calc_distance_stat(distance, filter_results_for_stat(results))
+				if stat:
+					new_stats[(distance_id, None)] = stat
+				all_lengths += lengths
+				total_time += sum_time
+				if runner:
+					stat, lengths, sum_time = calc_distance_stat(distance, filter_results_for_stat(results, year=cur_year))
+					if stat:
+						new_stats[(distance_id, cur_year)] = stat
+					all_lengths_cur_year += lengths
+					total_time_cur_year += sum_time
+			has_many_distances = len(results_by_distance) > DISTANCE_LIMIT
+			if has_many_distances:
+				distance_lengths = {distance_id: results[0].race.distance.length for distance_id, results in results_by_distance.items()}
+				keys_all_years = sorted((key for key in new_stats if key[1] is None),
+					key=lambda key: (-new_stats[key]['n_starts'], -distance_lengths[key[0]]))
+				for key in keys_all_years[:DISTANCE_LIMIT]:
+					new_stats[key]['is_popular'] = True
+		save_stats(person.user_stat_set.all(), new_stats, **({'runner': runner} if runner else {'user': user}))
+
+	if update_club_members and club_members:
+		if club_result_set is result_set:
+			club_results_by_distance = results_by_distance
+		else:
+			club_results_by_distance = group_by_distance(load_results_for_stat(club_result_set))
+		for m in club_members:
+			new_stats = {}
+			for distance_id, results in club_results_by_distance.items():
+				if distance_id not in results_util.DISTANCES_FOR_CLUB_STATISTICS:
+					continue
+				distance = results[0].race.distance
+				for member_year in club_member_years(m, year):
+					stat, _, _ = calc_distance_stat(distance, filter_results_for_stat(results, year=member_year, club_member=m),
+						age_coef_person=m.runner)
+					if stat:
+						new_stats[(distance_id, member_year)] = stat
+			save_stats(m.user_stat_set.filter(year=year) if year else m.user_stat_set.all(), new_stats, club_member=m)
 
 	if person_for_stat:
 		person_for_stat.n_starts = len(all_lengths)
 		person_for_stat.total_length = sum(all_lengths)
 		person_for_stat.total_time = total_time
+		person_for_stat.has_many_distances = has_many_distances
+		fields = ['n_starts', 'total_length', 'total_time', 'has_many_distances']
 		if runner:
 			person_for_stat.n_starts_cur_year = len(all_lengths_cur_year)
 			person_for_stat.total_length_cur_year = sum(all_lengths_cur_year)
 			person_for_stat.total_time_cur_year = total_time_cur_year
 			person_for_stat.eddington, person_for_stat.eddington_for_next_level = eddington(all_lengths)
 			person_for_stat.eddington_cur_year, person_for_stat.eddington_for_next_level_cur_year = eddington(all_lengths_cur_year)
-		if distance_ids.count() > DISTANCE_LIMIT:
-			for user_stat in person.user_stat_set.filter(year=None).order_by('-n_starts', '-distance__length')[:DISTANCE_LIMIT]:
-				user_stat.is_popular = True
-				user_stat.save()
-			person_for_stat.has_many_distances = True
-		else:
-			person_for_stat.has_many_distances = False
-		person_for_stat.save()
+			fields += ['n_starts_cur_year', 'total_length_cur_year', 'total_time_cur_year',
+				'eddington', 'eddington_for_next_level', 'eddington_cur_year', 'eddington_for_next_level_cur_year']
+		person_for_stat.save(update_fields=fields)
+	if runner:
+		regions_visited.update_runner_regions(runner.id)
+		models.invalidate_public_pages(runner)
 
 def update_runner_and_user_stat(runner: models.Runner, update_club_members: bool=False):
 	update_runner_stat(runner=runner)
@@ -289,6 +334,137 @@ def update_runners_stat(id_from=0, reset_cur_year_stat=False, debug=0):
 		print(f'{datetime.datetime.now()} update_runners_stat finished. Number of updated runners: {n_runners}')
 	return n_runners
 
+RUNNERS_PER_TASK = 100
+
+# Updates statistics of runners with id_from <= id < id_to. Runs in worker processes of update_runners_stat_parallel.
+def update_runners_stat_range(id_from: int, id_to: int) -> int:
+	n_runners = 0
+	for runner in models.Runner.objects.filter(id__gte=id_from, id__lt=id_to).order_by('id'):
+		update_runner_stat(runner=runner, update_club_members=False)
+		n_runners += 1
+	return n_runners
+
+# Updates statistics of all runners in n_workers processes, each with its own DB connection.
+# The progress is stored in Runners_stat_job after each finished range of runners. So if the previous run was killed,
+# we continue from the first range it didn't finish (unless restart=True).
+# Returns the description of the work done with the throughput.
+def update_runners_stat_parallel(n_workers: int=0, reset_cur_year_stat: bool=False, restart: bool=False, debug: int=0) -> str:
+	if n_workers <= 0:
+		n_workers = settings.RUNNER_STAT_WORKERS
+	job = None if restart else models.Runners_stat_job.objects.filter(
+		finish_time=None, reset_cur_year_stat=reset_cur_year_stat).order_by('-id').first()
+	if job:
+		if debug:
+			print(f'{datetime.datetime.now()} Resuming {job} started at {job.start_time}')
+	else:
+		job = models.Runners_stat_job.objects.create(reset_cur_year_stat=reset_cur_year_stat)
+		if reset_cur_year_stat:
+			models.Runner.objects.update(n_starts_cur_year=None, total_length_cur_year=None, total_time_cur_year=None)
+	max_id = models.Runner.objects.aggregate(Max('id'))['id__max'] or 0
+	start_time = timezone.now()
+	n_runners = 0
+	finished_ranges = set() # Starts of the finished ranges that are not yet below job.id_done
+	# Forked processes must not share the connection of this process. Each of them opens its own one.
+	connections.close_all()
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork'))
+	try:
+		futures = {executor.submit(update_runners_stat_range, id_from, id_from + RUNNERS_PER_TASK): id_from
+			for id_from in range(job.id_done, max_id + 1, RUNNERS_PER_TASK)}
+		for future in concurrent.futures.as_completed(futures):
+			n_runners_in_range = future.result()
+			n_runners += n_runners_in_range
+			finished_ranges.add(futures[future])
+			while job.id_done in finished_ranges:
+				finished_ranges.remove(job.id_done)
+				job.id_done += RUNNERS_PER_TASK
+			job.n_runners += n_runners_in_range
+			job.save()
+			if debug >= 2:
+				print(f'{datetime.datetime.now()} Runners with id from {futures[future]} were updated. Done up to id {job.id_done}')
+	except:
+		executor.shutdown(wait=False, cancel_futures=True)
+		raise
+	executor.shutdown()
+	job.finish_time = timezone.now()
+	job.save()
+
+	seconds = max((job.finish_time - start_time).total_seconds(), 1)
+	res = f'Updated {n_runners} runners in {int(seconds)} s with {n_workers} processes, {n_runners / seconds:.1f} runners/s'
+	if debug:
+		print(f'{datetime.datetime.now()} update_runners_stat_parallel finished. {res}')
+	return res
+
+RUNNERS_PER_BATCH = 100000
+RUNNER_AGGREGATE_FIELDS = ('n_starts', 'total_length', 'total_time', 'eddington', 'eddington_for_next_level')
+
+# Receives a DataFrame with columns runner_id, length: one row per result.
+# Returns a DataFrame indexed by runner_id with the columns eddington, eddington_for_next_level:
+# the same values as eddington() returns for the lengths of each runner.
+def eddington_by_runner(df: pd.DataFrame) -> pd.DataFrame:
+	df = df.sort_values(['runner_id', 'length'], ascending=[True, False])
+	rank = df.groupby('runner_id').cumcount() + 1
+	# Lengths of each runner go in descending order, so the condition holds exactly for the first <Eddington number> of them.
+	res = (df['length'] >= rank * 1000).groupby(df['runner_id']).sum().rename('eddington').to_frame()
+	next_level = df['runner_id'].map(res['eddington']) + 1
+	res['eddington_for_next_level'] = next_level.groupby(df['runner_id']).first() \
+		- ((rank < next_level) & (df['length'] >= next_level * 1000)).groupby(df['runner_id']).sum()
+	return res
+
+# Receives a DataFrame with columns runner_id, length, time: one row per result.
+# Returns a DataFrame indexed by runner_id with the columns RUNNER_AGGREGATE_FIELDS.
+def aggregates_by_runner(df: pd.DataFrame) -> pd.DataFrame:
+	if df.empty:
+		return pd.DataFrame(columns=RUNNER_AGGREGATE_FIELDS, index=pd.Index([], name='runner_id'))
+	res = df.groupby('runner_id').agg(n_starts=('length', 'size'), total_length=('length', 'sum'), total_time=('time', 'sum'))
+	return res.join(eddington_by_runner(df))[list(RUNNER_AGGREGATE_FIELDS)]
+
+# Loads the results of runners with id_from <= id < id_to that count in statistics, with the same lengths and times as length_time() gives.
+# Returns a DataFrame with columns runner_id, year, length, time.
+def load_lengths_and_times(id_from: int, id_to: int) -> pd.DataFrame:
+	columns = ['runner_id', 'result', 'status', 'distance_type', 'distance_length', 'distance_real_length', 'year']
+	df = pd.DataFrame.from_records(models.Result.objects.filter(
+			runner_id__gte=id_from,
+			runner_id__lt=id_to,
+			status__in=(models.STATUS_FINISHED, models.STATUS_COMPLETED),
+			race__distance__distance_type__in=models.TYPES_FOR_RUNNER_STAT,
+			race__exclude_from_stat=False,
+			do_not_count_in_stat=False,
+		).values_list('runner_id', 'result', 'status', 'race__distance__distance_type', 'race__distance__length',
+			'race__distance_real__length', 'race__event__start_date__year'), columns=columns)
+	is_minutes = df['distance_type'].isin(models.TYPES_MINUTES)
+	df['length'] = df['result'].where(is_minutes, df['distance_real_length'].fillna(df['distance_length'])).astype('int64')
+	# 1 minute = 6000 centiseconds
+	df['time'] = (df['distance_length'] * 6000).where(is_minutes, df['result'].where(df['status'] != models.STATUS_COMPLETED, 0)).astype('int64')
+	return df[['runner_id', 'year', 'length', 'time']]
+
+# Updates n_starts, total_length, total_time, Eddington numbers and their current year versions for all runners
+# with vectorized calculations over RUNNERS_PER_BATCH runners at once. Unlike update_runners_stat, doesn't touch User_stat.
+# Writes only changed runners. Returns the number of such runners.
+def update_runners_aggregates(id_from: int=0, debug: int=0) -> int:
+	cur_year = results_util.CUR_YEAR_FOR_RUNNER_STATS
+	fields = list(RUNNER_AGGREGATE_FIELDS) + [f'{field}_cur_year' for field in RUNNER_AGGREGATE_FIELDS]
+	empty_values = {field: 0 for field in fields}
+	empty_values['eddington_for_next_level'] = empty_values['eddington_for_next_level_cur_year'] = 1 # As eddington([]) returns
+	max_id = models.Runner.objects.aggregate(Max('id'))['id__max'] or 0
+	n_runners_changed = 0
+	for batch_from in range(id_from, max_id + 1, RUNNERS_PER_BATCH):
+		batch_to = batch_from + RUNNERS_PER_BATCH
+		df = load_lengths_and_times(batch_from, batch_to)
+		aggregates = aggregates_by_runner(df).join(
+			aggregates_by_runner(df[df['year'] == cur_year]).add_suffix('_cur_year'), how='left')
+		new_values = aggregates.to_dict('index')
+		runners_to_update = []
+		for runner_id, *old_values in models.Runner.objects.filter(id__gte=batch_from, id__lt=batch_to).values_list('id', *fields):
+			values = {field: (empty_values[field] if pd.isna(value) else int(value))
+				for field, value in new_values.get(runner_id, empty_values).items()}
+			if [values[field] for field in fields] != old_values:
+				runners_to_update.append(models.Runner(id=runner_id, **values))
+		models.Runner.objects.bulk_update(runners_to_update, fields, batch_size=1000)
+		n_runners_changed += len(runners_to_update)
+		if debug:
+			print(f'{datetime.datetime.now()} Runners with ids {batch_from}-{batch_to - 1}: {len(runners_to_update)} changed')
+	return n_runners_changed
+
 def update_users_stat():
 	for user in User.objects.filter(user_profile__isnull=False):
 		update_runner_stat(user=user)
@@ -1,7 +1,5 @@
 from collections import Counter, defaultdict, OrderedDict
 import datetime
-import io
-import json
 import os
 import re
 import time
@@ -18,7 +16,7 @@ from django.db.models import Q
 from results import links, models, results_util
 from editor import parse_protocols, parse_strings, runner_stat
 from editor.views import views_result
-from . import util, athlinks_xlsx
+from . import http_cache, util, athlinks_xlsx
 
 ATHLINKS_TEMP_DIR = os.path.join(settings.INTERNAL_FILES_ROOT, 'athlinks')
 
@@ -268,7 +266,7 @@ def FetchResult(platform_event_id: int, platform_race_id: int, bib: str, entryId
 	else:
 		raise ResultDetailsAbsentError()
 		# raise util.NonRetryableError(f'Event {platform_event_id}, course {platform_race_id}: both bib and entryId are empty')
-	return TryGetJson(results_util.session.get(url, params=params), **kwargs)
+	return TryGetJson(http_cache.Fetch(results_util.session, 'GET', url, params=params), **kwargs)
 
 # Among splits, there is also the final result: the one with intervalFull=true.
 def FullInterval(intervals: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
@@ -281,6 +279,7 @@ def FullInterval(intervals: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
 class AthlinksScraper(util.Scraper):
 	PLATFORM_ID = 'athlinks'
 	PAGE_SIZE = 100
+	DETAILED_RESULTS_PER_CHUNK = 100
 
 	def __post_init__(self):
 		self.RACES_WITH_REPEATING_SPLIT_DISTANCES = frozenset([
@@ -447,7 +446,7 @@ class AthlinksScraper(util.Scraper):
 			return
 		if not self.platform_event_id:
 			raise util.NonRetryableError('FetchCoursesAndBibs needs to know platform_event_id to read metadata')
-		event_metadata = util.LoadAndStore(self.DownloadedFilesDir(), self.EventMetadataURL())
+		event_metadata = util.LoadAndStore(self.DownloadedFilesDir(), self.EventMetadataURL(), ttl=util.MUTABLE_PAGE_TTL)
 		if event_metadata.get('message', '').lower() == 'metadata not found!':
 			self.reason_to_ignore = f'No metadata for event at {self.EventMetadataURL()}'
 			return
@@ -508,11 +507,12 @@ class AthlinksScraper(util.Scraper):
 
 			total_athletes = first_page[0]['totalAthletes']
 			results = first_page[0]['interval']['intervalResults']
-			for start in range(self.PAGE_SIZE, total_athletes, self.PAGE_SIZE):
-				params['from'] = start
-				page = util.LoadAndStore(self.DownloadedFilesDir(), self.BriefResultsURL(), params=params)
+			params_list = [OrderedDict(params, **{'from': start}) for start in range(self.PAGE_SIZE, total_athletes, self.PAGE_SIZE)]
+			pages = util.LoadManyAndStore([{'mydir': self.DownloadedFilesDir(), 'url': self.BriefResultsURL(), 'params': page_params}
+				for page_params in params_list])
+			for page_params, page in zip(params_list, pages):
 				if not (type(page) is list):
-					raise util.JsonParsingError(f'{self.BriefResultsURL()} with params {params} returns not a list: {page}')
+					raise util.JsonParsingError(f'{self.BriefResultsURL()} with params {page_params} returns not a list: {page}')
 				results += page[0]['interval']['intervalResults']
 
 			race_dict['results'] = []
@@ -643,47 +643,69 @@ class AthlinksScraper(util.Scraper):
 			n_loaded_total = n_loaded_now = 0
 			start = datetime.datetime.now()
 			already_loaded = 0
-			for result_num, result_dict in enumerate(race_dict['results']):
-				if result_dict.get('results_detailed_loaded'):
-					n_loaded_total += 1
-					continue
-				try:
-					result_detailed_json, url = FetchResult(
+			# Detailed results are fetched concurrently in chunks and then processed in their order.
+			# If some result of the chunk fails, we still process the other fetched ones and only then raise the first error,
+			# so that the next attempt doesn't fetch them again.
+			for chunk_start in range(0, len(race_dict['results']), self.DETAILED_RESULTS_PER_CHUNK):
+				chunk = race_dict['results'][chunk_start:chunk_start + self.DETAILED_RESULTS_PER_CHUNK]
+				fetched_results = iter(util.MapConcurrently(
+					lambda result_dict: FetchResult(
 						platform_event_id=self.platform_event_id,
 						platform_race_id=race_dict['id_on_platform'],
 						bib=result_dict['bib_raw'],
 						entryId=result_dict['id_on_platform'],
-					)
-				except ResultDetailsAbsentError:
-					continue
-				except IncorrectBibError as e:
-					self.DumpStandardForm()
-					print(f'Loaded {len(race_dict["results"])} results')
-					raise IncorrectBibError(f'{e}. Loaded {len(race_dict["results"])} results for course {race_dict["id_on_platform"]}') from e
-				except InternalAthlinksError as e:
-					if (race_dict["id_on_platform"], result_dict['bib_raw']) in self.KNOWN_BAD_BIBS or race_dict["id_on_platform"] in self.RACES_WITH_BAD_BIBS:
+					),
+					[(result_dict, ) for result_dict in chunk if not result_dict.get('results_detailed_loaded')],
+				))
+				first_error = None
+				for result_num, result_dict in enumerate(chunk, start=chunk_start):
+					if result_dict.get('results_detailed_loaded'):
+						n_loaded_total += 1
 						continue
-					if result_dict['id_on_platform'] in self.KNOWN_BAD_PLATFORM_IDS:
+					fetched, exception = next(fetched_results)
+					if first_error:
+						if exception is None:
+							result_detailed_json, url = fetched
+							if not ((len(result_detailed_json) == 1) and ('message' in result_detailed_json)):
+								self._AddDetailedFields(result_dict, result_detailed_json, race_dict)
+						continue
+					try:
+						if exception:
+							raise exception
+						result_detailed_json, url = fetched
+					except ResultDetailsAbsentError:
+						continue
+					except IncorrectBibError as e:
+						first_error = IncorrectBibError(f'{e}. Loaded {len(race_dict["results"])} results for course {race_dict["id_on_platform"]}')
+						first_error.__cause__ = e
+						continue
+					except InternalAthlinksError as e:
+						if (race_dict["id_on_platform"], result_dict['bib_raw']) in self.KNOWN_BAD_BIBS or race_dict["id_on_platform"] in self.RACES_WITH_BAD_BIBS:
+							continue
+						if result_dict['id_on_platform'] in self.KNOWN_BAD_PLATFORM_IDS:
+							continue
+						first_error = InternalAthlinksError(f'{e}. Loaded {len(race_dict['results'])} results for course {race_dict["id_on_platform"]}')
+						first_error.__cause__ = e
 						continue
-					self.DumpStandardForm()
-					print(f'Loaded {len(race_dict['results'])} results')
-					raise InternalAthlinksError(f'{e}. Loaded {len(race_dict['results'])} results for course {race_dict["id_on_platform"]}') from e
-
-				if (len(result_detailed_json) == 1) and ('message' in result_detailed_json):
-					self.DumpStandardForm()
-					print(f'Loaded {len(race_dict['results'])} results')
-					raise util.NonRetryableError(f'{url} returned error: {result_json["message"]}')
-				self._AddDetailedFields(result_dict, result_detailed_json, race_dict)
 
-				n_loaded_total += 1
-				n_loaded_now += 1
+					if (len(result_detailed_json) == 1) and ('message' in result_detailed_json):
+						first_error = util.NonRetryableError(f'{url} returned error: {result_detailed_json["message"]}')
+						continue
+					self._AddDetailedFields(result_dict, result_detailed_json, race_dict)
 
-				if (n_loaded_total % 1000) == 0:
-					self.attempt.UpdateStatus(f'FetchResults: Loading {race_num+1} race out of {len(self.standard_form_dict["races"])}. '
-						+ f'Loaded {result_num+1} detailed results out of {len(race_dict["results"])}')
+					n_loaded_total += 1
+					n_loaded_now += 1
+
+					if (n_loaded_total % 1000) == 0:
+						self.attempt.UpdateStatus(f'FetchResults: Loading {race_num+1} race out of {len(self.standard_form_dict["races"])}. '
+							+ f'Loaded {result_num+1} detailed results out of {len(race_dict["results"])}')
+						self.DumpStandardForm()
+						if self.ToStopNow():
+							raise util.TimeoutError(f'Time out. Loaded {n_loaded_total} out of {len(race_dict["results"])} detailed results')
+				if first_error:
 					self.DumpStandardForm()
-					if self.ToStopNow():
-						raise util.TimeoutError(f'Time out. Loaded {n_loaded_total} out of {len(race_dict["results"])} detailed results')
+					print(f'Loaded {len(race_dict["results"])} results')
+					raise first_error
 			print(f'Course {race_dict["id_on_platform"]}: loaded {len(race_dict["results"])} results in {datetime.datetime.now() - start}')
 			race_dict['results_detailed_loaded'] = True
 			self.DumpStandardForm()
@@ -743,10 +765,9 @@ class AthlinksScraper(util.Scraper):
 
 	def SaveEventDetailsInStandardForm(self):
 		self._ParseUrlIfNeeded()
-		if os.path.isfile(self.StandardFormPath()):
-			print(f'Reading all event data from {self.StandardFormPath()}')
-			with io.open(self.StandardFormPath(), encoding="utf8") as json_in:
-				self.standard_form_dict = json.load(json_in)
+		if self.HasStandardForm():
+			print(f'Reading all event data from {self.StandardFormDir()}')
+			self.ReadStandardForm()
 		else:
 			self.InitStandardFormDict()
 			if self.reason_to_ignore:
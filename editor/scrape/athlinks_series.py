@@ -1,11 +1,10 @@
 import requests
-import time
 
 from django.utils import timezone
 
 from results import models, results_util
 from editor import stat
-from editor.scrape import athlinks, util
+from editor.scrape import athlinks, http_cache, util
 
 N_SERIES_TO_PROCESS = 2000
 
@@ -39,8 +38,8 @@ def ProcessSeriesWithOriginalResults(id_from: int, id_to: int) -> tuple[int, int
 	disappeared_series = []
 	existing_series = set(models.Athlinks_series.objects.filter(id__range=(id_from, id_to), is_deleted=False).values_list('id', flat=True))
 	for platform_series_id in range(id_from, id_to + 1):
-		time.sleep(1)
 		url = athlinks.SeriesMetadataURL(platform_series_id)
+		http_cache.rate_limiter.Wait(url)
 		series_metadata, url = util.TryGetJson(requests.get(url, headers=results_util.HEADERS))
 		if not series_metadata.get('success'):
 			if series_metadata.get('ErrorMessage', '').endswith('not found'):
@@ -1,8 +1,5 @@
 import bs4
 from collections import OrderedDict
-import io
-import json
-import os
 import requests
 import time
 import urllib.parse
@@ -313,10 +310,9 @@ class BaaScraper(util.Scraper):
 		self.race_num = {'': 0} # race_type -> index in self.standard_form_dict['races']
 		
 	def SaveEventDetailsInStandardForm(self):
-		if os.path.isfile(self.StandardFormPath()):
-			print(f'Reading all event data from {self.StandardFormPath()}')
-			with io.open(self.StandardFormPath(), encoding="utf8") as json_in:
-				self.standard_form_dict = json.load(json_in)
+		if self.HasStandardForm():
+			print(f'Reading all event data from {self.StandardFormDir()}')
+			self.ReadStandardForm()
 		else:
 			self.InitStandardFormDict()
 			self.LoadResults()
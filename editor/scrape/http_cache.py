@@ -0,0 +1,177 @@
+# A persistent on-disk cache of HTTP responses used by util.LoadAndStore, and per-host rate limiting for scrapers.
+# Each response is stored as a gzipped JSON file with the content, the fetch time and the validators (ETag, Last-Modified),
+# so that stale entries are revalidated with conditional GET requests instead of being downloaded again.
+import datetime
+import email.utils
+import gzip
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Any, Optional
+import urllib.parse
+
+import requests
+
+COMPRESSED_SUFFIX = '.json.gz'
+
+# Minimal intervals between two requests to the same host, in seconds. Other hosts get DEFAULT_MIN_INTERVAL.
+MIN_INTERVAL_FOR_HOST = {
+	'www.athlinks.com': 0.5,
+	'results.athlinks.com': 0.1, # Detailed results are fetched from there in several threads.
+	'alaska.athlinks.com': 0.5,
+	'results.nyrr.org': 1,
+	'rmsprodapi.nyrr.org': 1,
+	'runsignup.com': 0.5,
+	's95.ru': 1,
+	's95.by': 1,
+}
+DEFAULT_MIN_INTERVAL = 1.
+# Each 429 Too Many Requests response doubles the interval for the host, but not above this value.
+MAX_INTERVAL = 30.
+# If a host answers 429 without a Retry-After header, we pause requests to it for this many seconds.
+DEFAULT_RETRY_AFTER = 30.
+MAX_ATTEMPTS_ON_TOO_MANY_REQUESTS = 5
+
+def Host(url: str) -> str:
+	return urllib.parse.urlsplit(url).netloc.lower()
+
+# Makes requests to each host no more frequent than MIN_INTERVAL_FOR_HOST allows. Is safe to use from several threads.
+class HostRateLimiter:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._interval = dict(MIN_INTERVAL_FOR_HOST)
+		self._next_request_time = {}
+
+	# Blocks until a request to the host of the url is allowed.
+	def Wait(self, url: str):
+		host = Host(url)
+		with self._lock:
+			now = time.monotonic()
+			request_time = max(now, self._next_request_time.get(host, now))
+			self._next_request_time[host] = request_time + self._interval.get(host, DEFAULT_MIN_INTERVAL)
+		if request_time > now:
+			time.sleep(request_time - now)
+
+	# Lets scrapers allow more frequent requests to hosts that are not in MIN_INTERVAL_FOR_HOST, e.g. to sites of mikatiming.
+	def SetMinInterval(self, url: str, seconds: float):
+		with self._lock:
+			self._interval[Host(url)] = seconds
+
+	# Called when the host answered 429: pauses requests to it for retry_after seconds and makes them twice as rare after that.
+	def SlowDown(self, url: str, retry_after: float):
+		host = Host(url)
+		with self._lock:
+			self._interval[host] = min(2 * self._interval.get(host, DEFAULT_MIN_INTERVAL), MAX_INTERVAL)
+			self._next_request_time[host] = max(self._next_request_time.get(host, 0), time.monotonic() + retry_after)
+
+rate_limiter = HostRateLimiter()
+
+# Returns the number of seconds from the Retry-After header that may contain either seconds or an HTTP date.
+def RetryAfterSeconds(response: requests.Response) -> float:
+	value = response.headers.get('Retry-After')
+	if not value:
+		return DEFAULT_RETRY_AFTER
+	if value.isdigit():
+		return float(value)
+	try:
+		return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
+
+# Makes a request with session respecting the rate limit of the host. Retries if the host answers 429.
+def Fetch(session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+	for _ in range(MAX_ATTEMPTS_ON_TOO_MANY_REQUESTS):
+		rate_limiter.Wait(url)
+		response = session.request(method, url, **kwargs)
+		if response.status_code != 429:
+			return response
+		print(f'{datetime.datetime.now()} {url}: too many requests, slowing down')
+		rate_limiter.SlowDown(url, RetryAfterSeconds(response))
+	return response
+
+# Reads the cache entry at path. Returns None if there is no such file or it is broken, e.g. after a crash while writing.
+def ReadEntry(path: pathlib.Path) -> Optional[dict[str, Any]]:
+	try:
+		with gzip.open(path, 'rt', encoding='utf8') as file_in:
+			return json.load(file_in)
+	except (OSError, EOFError, ValueError):
+		return None
+
+# Writes the entry to a temporary file first, so that readers never see a half-written entry.
+def WriteEntry(path: pathlib.Path, entry: dict[str, Any]):
+	with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as file_out:
+		with gzip.open(file_out, 'wt', encoding='utf8') as gzip_out:
+			json.dump(entry, gzip_out, ensure_ascii=False)
+	os.chmod(file_out.name, 0o664) # Temporary files are only readable by the owner by default.
+	os.replace(file_out.name, path)
+
+def MakeEntry(response: requests.Response, content: Any) -> dict[str, Any]:
+	return {
+		'url': response.url,
+		'etag': response.headers.get('ETag'),
+		'last_modified': response.headers.get('Last-Modified'),
+		'fetched_at': time.time(),
+		'content': content,
+	}
+
+# Converts an uncompressed file written by the old versions of LoadAndStore to a compressed entry and deletes the old file.
+def ConvertLegacyFile(legacy_path: pathlib.Path, path: pathlib.Path, is_json: bool) -> dict[str, Any]:
+	with open(legacy_path, encoding='utf8') as file_in:
+		content = json.load(file_in) if is_json else file_in.read()
+	entry = {
+		'url': None,
+		'etag': None,
+		'last_modified': None,
+		'fetched_at': os.path.getmtime(legacy_path),
+		'content': content,
+	}
+	WriteEntry(path, entry)
+	os.remove(legacy_path)
+	return entry
+
+# Entries without ttl never expire: results of past events don't change.
+def IsFresh(entry: dict[str, Any], ttl: Optional[datetime.timedelta]) -> bool:
+	return (ttl is None) or (time.time() - entry['fetched_at'] < ttl.total_seconds())
+
+def ConditionalHeaders(entry: Optional[dict[str, Any]]) -> dict[str, str]:
+	headers = {}
+	if entry:
+		if entry.get('etag'):
+			headers['If-None-Match'] = entry['etag']
+		if entry.get('last_modified'):
+			headers['If-Modified-Since'] = entry['last_modified']
+	return headers
+
+# Marks the file as recently used; Evict deletes least recently used files first.
+def Touch(path: pathlib.Path):
+	try:
+		os.utime(path)
+	except OSError:
+		pass
+
+# Deletes cache files under root that weren't used for more than max_age and then, if the remaining ones
+# take more than max_total_bytes, the least recently used of them. Returns the number of deleted files and freed bytes.
+def Evict(root: pathlib.Path, max_age: Optional[datetime.timedelta]=None, max_total_bytes: Optional[int]=None) -> tuple[int, int]:
+	files = []
+	for dirpath, _, filenames in os.walk(root):
+		for name in filenames:
+			if name.endswith(COMPRESSED_SUFFIX):
+				path = os.path.join(dirpath, name)
+				stat = os.stat(path)
+				files.append((stat.st_mtime, stat.st_size, path))
+	files.sort()
+	total_bytes = sum(size for _, size, _ in files)
+	min_mtime = (time.time() - max_age.total_seconds()) if max_age else None
+	n_deleted = freed_bytes = 0
+	for mtime, size, path in files:
+		too_old = (min_mtime is not None) and (mtime < min_mtime)
+		too_big = (max_total_bytes is not None) and (total_bytes - freed_bytes > max_total_bytes)
+		if not (too_old or too_big):
+			break
+		os.remove(path)
+		n_deleted += 1
+		freed_bytes += size
+	return n_deleted, freed_bytes
@@ -1,7 +1,12 @@
 import datetime
+import multiprocessing
+import threading
+import time
 import traceback
+from typing import Optional
 
-from django.db.models import Q
+from django.db import connection, connections, transaction
+from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 
 from results import models
@@ -28,8 +33,41 @@ def Scraper(row: models.Scraped_event, attempt: models.Download_attempt) -> util
 		return trackshackresults.TrackShackResultsScraper(**kwargs)
 	raise util.NonRetryableError(f'There is no scraper yet for platform {row.platform_id}')
 
-def process_queue_element(row: models.Scraped_event) -> str:
-	new_attempt = models.Download_attempt.objects.create(scraped_event=row)
+# How often a queue worker reports that it is alive, and after how long without reports we consider it dead.
+HEARTBEAT_INTERVAL = datetime.timedelta(minutes=1)
+HEARTBEAT_TIMEOUT = datetime.timedelta(minutes=10)
+# How many queue workers run_queue_workers starts for each platform by default.
+QUEUE_WORKERS_PER_PLATFORM = {
+	'athlinks': 2,
+}
+# How long an idle queue worker waits before looking at the queue again.
+IDLE_WORKER_PAUSE = datetime.timedelta(minutes=5)
+
+# Updates Download_attempt.last_heartbeat in a separate thread until stop() is called.
+class Heartbeat:
+	def __init__(self, attempt_id: int):
+		self.attempt_id = attempt_id
+		self._stop_event = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		try:
+			while not self._stop_event.wait(HEARTBEAT_INTERVAL.total_seconds()):
+				models.Download_attempt.objects.filter(pk=self.attempt_id, finish_time=None).update(last_heartbeat=timezone.now())
+		finally:
+			connection.close() # The thread has its own DB connection.
+
+	def stop(self):
+		self._stop_event.set()
+		self._thread.join()
+
+# If with_heartbeat, the attempt is considered alive while the process sends heartbeats, however long it runs.
+# attempt is the one created by claim_queue_element, if any.
+def process_queue_element(row: models.Scraped_event, with_heartbeat: bool=False, attempt: Optional[models.Download_attempt]=None) -> str:
+	new_attempt = attempt if attempt else models.Download_attempt.objects.create(scraped_event=row,
+		last_heartbeat=timezone.now() if with_heartbeat else None)
+	heartbeat = Heartbeat(new_attempt.id) if with_heartbeat else None
 	try:
 		row.result = models.DOWNLOAD_IN_PROGRESS
 		row.save()
@@ -81,6 +119,9 @@ def process_queue_element(row: models.Scraped_event) -> str:
 		return f'{datetime.datetime.now()} Attempt {new_attempt.id}: Protocol {row.url_site} for event {row.protocol.event_id if row.protocol else None} {res}'
 	except Exception as e:
 		return f'{datetime.datetime.now()} Failed attempt {new_attempt.id}: {e}'
+	finally:
+		if heartbeat:
+			heartbeat.stop()
 
 def mark_long_running_as_failed_by_platform(attempts, timeout):
 	n_marked = 0
@@ -99,10 +140,43 @@ def mark_long_running_as_failed_by_platform(attempts, timeout):
 	if n_marked:
 		print(f'Marked {n_marked} attempts as failed because running too long')
 
+# Attempts of queue workers that stopped sending heartbeats, e.g. were killed.
+def mark_dead_workers_attempts_as_failed():
+	n_marked = 0
+	dead_attempts = models.Download_attempt.objects.filter(finish_time=None, last_heartbeat__lt=timezone.now() - HEARTBEAT_TIMEOUT)
+	for attempt in dead_attempts.select_related('scraped_event'):
+		elem = attempt.scraped_event
+		if elem and (elem.result == models.DOWNLOAD_IN_PROGRESS) and not elem.download_attempt_set.filter(
+				finish_time=None, last_heartbeat__gte=timezone.now() - HEARTBEAT_TIMEOUT).exists():
+			elem.result = models.DOWNLOAD_NOT_STARTED
+			elem.save()
+		n_marked += models.Download_attempt.objects.filter(pk=attempt.id, finish_time=None).update(finish_time=timezone.now(),
+			result=models.DOWNLOAD_ERROR, error=f'Killed as sending no heartbeats since {attempt.last_heartbeat}')
+	if n_marked:
+		print(f'Marked {n_marked} attempts as failed because their workers are dead')
+	# Both claim_queue_element and process_queue_element create the attempt before marking the element as in progress,
+	# so such elements were left by workers that died before we started creating attempts in the same transaction.
+	unfinished_attempts = models.Download_attempt.objects.filter(scraped_event_id=OuterRef('pk'), finish_time=None)
+	n_orphaned = models.Scraped_event.objects.filter(result=models.DOWNLOAD_IN_PROGRESS).exclude(Exists(unfinished_attempts)).update(
+		result=models.DOWNLOAD_NOT_STARTED)
+	if n_orphaned:
+		print(f'Returned to the queue {n_orphaned} elements in progress without unfinished attempts')
+
 def mark_long_running_as_failed():
-	attempts = models.Download_attempt.objects.filter(finish_time=None)
+	attempts = models.Download_attempt.objects.filter(finish_time=None, last_heartbeat=None)
 	mark_long_running_as_failed_by_platform(attempts.exclude(scraped_event__platform_id='mikatiming'), timeout=util.ATTEMPT_TIMEOUT)
 	mark_long_running_as_failed_by_platform(attempts.filter(scraped_event__platform_id='mikatiming'), timeout=util.datetime.timedelta(hours=2))
+	mark_dead_workers_attempts_as_failed()
+
+# Returns whether the row can be processed. Fills its url_site if needed.
+def prepare_queue_element(row: models.Scraped_event) -> bool:
+	if (not row.url_site) and (not row.protocol):
+		print(f'Scraped_event {row.id} has neither URL nor document')
+		return False
+	if not row.url_site:
+		row.url_site = row.protocol.url_source
+		row.save()
+	return True
 
 def process_queue() -> str:
 	mark_long_running_as_failed()
@@ -116,12 +190,8 @@ def process_queue() -> str:
 		if not row:
 			print(f'{datetime.datetime.now()} All protocols on platform {platform_id} are loaded or have errors, nothing to do')
 			continue
-		if (not row.url_site) and (not row.protocol):
-			print(f'Scraped_event {row.id} has neither URL nor document')
+		if not prepare_queue_element(row):
 			continue
-		if not row.url_site:
-			row.url_site = row.protocol.url_source
-			row.save()
 		last_attempt = row.download_attempt_set.order_by('-start_time').first()
 		if last_attempt and (last_attempt.result == models.DOWNLOAD_IN_PROGRESS):
 			print(f'{datetime.datetime.now()} Protocol {row.url_site} for event {row.protocol.event_id if row.protocol else None} '
@@ -129,3 +199,78 @@ def process_queue() -> str:
 			continue
 		return process_queue_element(row)
 	return 'We do not launch any new processings now.'
+
+# Takes the first element of the platform queue and marks it as in progress, so that no other worker takes it.
+# The attempt is created in the same transaction: if the worker dies right after that, the attempt stops getting heartbeats,
+# and mark_dead_workers_attempts_as_failed returns the element to the queue.
+# Returns (None, None) if the queue is empty.
+def claim_queue_element(platform_id: str) -> tuple[Optional[models.Scraped_event], Optional[models.Download_attempt]]:
+	with transaction.atomic():
+		row = util.EventQueue(platform_id).select_for_update(skip_locked=True).first()
+		if row is None:
+			return None, None
+		row.result = models.DOWNLOAD_IN_PROGRESS
+		row.save(update_fields=['result'])
+		attempt = models.Download_attempt.objects.create(scraped_event=row, last_heartbeat=timezone.now())
+	return row, attempt
+
+# Processes the queue of the platform until it is empty (if exit_when_empty) or forever.
+def run_queue_worker(platform_id: str, worker_num: int, exit_when_empty: bool):
+	name = f'Worker {worker_num} for {platform_id} (pid {multiprocessing.current_process().pid})'
+	n_processed = 0
+	while True:
+		row, attempt = claim_queue_element(platform_id)
+		if row is None:
+			if exit_when_empty:
+				break
+			time.sleep(IDLE_WORKER_PAUSE.total_seconds())
+			continue
+		if not prepare_queue_element(row):
+			row.result = models.DOWNLOAD_ERROR
+			row.save(update_fields=['result'])
+			attempt.result = models.DOWNLOAD_ERROR
+			attempt.error = 'Neither URL nor document'
+			attempt.finish_time = timezone.now()
+			attempt.save()
+			continue
+		print(f'{name}: {process_queue_element(row, with_heartbeat=True, attempt=attempt)}')
+		n_processed += 1
+	print(f'{datetime.datetime.now()} {name}: the queue is empty. Processed {n_processed} elements')
+
+def start_queue_worker(context, platform_id: str, worker_num: int, exit_when_empty: bool):
+	connections.close_all() # Each worker must open its own connection.
+	worker = context.Process(target=run_queue_worker, args=(platform_id, worker_num, exit_when_empty))
+	worker.start()
+	return worker
+
+# Runs in parallel n_workers_by_platform[platform_id] (by default, QUEUE_WORKERS_PER_PLATFORM or 1) workers
+# for each platform in platform_ids. Meanwhile, marks the attempts of dead workers as failed and restarts the workers that crashed.
+def run_queue_workers(platform_ids: Optional[list[str]]=None, n_workers_by_platform: dict[str, int]={}, exit_when_empty: bool=False):
+	if not platform_ids:
+		platform_ids = util.ACTIVE_PLATFORM_IDS
+	mark_long_running_as_failed()
+	context = multiprocessing.get_context('fork')
+	workers = {} # (platform_id, worker_num) -> process
+	start_times = {} # (platform_id, worker_num) -> time.monotonic() of the last start
+	for platform_id in platform_ids:
+		for worker_num in range(n_workers_by_platform.get(platform_id, QUEUE_WORKERS_PER_PLATFORM.get(platform_id, 1))):
+			workers[(platform_id, worker_num)] = start_queue_worker(context, platform_id, worker_num, exit_when_empty)
+			start_times[(platform_id, worker_num)] = time.monotonic()
+	while workers:
+		for worker in workers.values():
+			worker.join(timeout=HEARTBEAT_INTERVAL.total_seconds() / len(workers))
+		if not any(worker.is_alive() for worker in workers.values()):
+			time.sleep(HEARTBEAT_INTERVAL.total_seconds())
+		mark_dead_workers_attempts_as_failed()
+		for (platform_id, worker_num), worker in list(workers.items()):
+			if worker.is_alive():
+				continue
+			# A worker that found the queue empty exits with code 0; any other exit is a crash.
+			if exit_when_empty and (worker.exitcode == 0):
+				del workers[(platform_id, worker_num)]
+			# We don't restart a worker that crashes right after the start more often than once per HEARTBEAT_INTERVAL.
+			elif time.monotonic() - start_times[(platform_id, worker_num)] >= HEARTBEAT_INTERVAL.total_seconds():
+				print(f'{datetime.datetime.now()} Worker {worker_num} for {platform_id} (pid {worker.pid}) exited with code {worker.exitcode}.'
+					+ ' Restarting it')
+				workers[(platform_id, worker_num)] = start_queue_worker(context, platform_id, worker_num, exit_when_empty)
+				start_times[(platform_id, worker_num)] = time.monotonic()
@@ -1,15 +1,17 @@
 import bs4
 from collections import OrderedDict
-import io
-import json
-import os
 import re
 from typing import Optional, Union
 from urllib import parse
 
 from results import models, results_util
 from editor import parse_strings
-from . import util
+from . import http_cache, util
+
+# Detailed result pages are fetched in chunks of that size; after each chunk we save the standard form.
+DETAILED_RESULTS_PER_CHUNK = 1000
+# Mikatiming sites are fast enough; we fetch detailed pages from them in several threads.
+MIN_INTERVAL_BETWEEN_REQUESTS = 0.1
 
 # For each field in the standard form for the result, we list all possible column names.
 COLUMN_NAMES = {
@@ -248,7 +250,7 @@ def EventYears(series_url: str) -> list[int]:
 			platform_id='mikatiming',
 			platform_series_id=series_url,
 		)
-	data = util.LoadAndStore(path, url=series_url, params=params)
+	data = util.LoadAndStore(path, url=series_url, params=params, ttl=util.MUTABLE_PAGE_TTL)
 	if 'branches' not in data:
 		raise Exception(f'{url} with params {params} has length {len(data)} and has no `branches`')
 	res = []
@@ -275,7 +277,7 @@ def EventCodesByYear(series_url: str, distance_name: str) -> list[tuple[str, str
 			('func', 'getSearchFields'),
 			('options[b][search][event_main_group]', year),
 		])
-		data = util.LoadAndStore(path, url=series_url, params=params)
+		data = util.LoadAndStore(path, url=series_url, params=params, ttl=util.MUTABLE_PAGE_TTL)
 		res.append((year, EventCodeFromJson(data, distance_name)))
 	return res
 
@@ -547,22 +549,31 @@ class MikaTimingScraper(util.Scraper):
 			# To determine gender e.g. for https://results.tcslondonmarathon.com/2024
 			self.n_males = self.n_females = self.n_nonbinary = 0
 
-			for result_num, result_dict in enumerate(race['results']):
-				if result_dict.get('results_detailed_loaded'):
+			http_cache.rate_limiter.SetMinInterval(self.url, MIN_INTERVAL_BETWEEN_REQUESTS)
+			# Detailed pages are fetched concurrently in chunks and then parsed in their order.
+			for chunk_start in range(0, len(race['results']), DETAILED_RESULTS_PER_CHUNK):
+				chunk = race['results'][chunk_start:chunk_start + DETAILED_RESULTS_PER_CHUNK]
+				contents = iter(util.LoadManyAndStore([
+					{
+						'mydir': self.DownloadedFilesDir(platform_runner_id=result_dict['id_on_platform']),
+						'url': self.DetailedResultURL(result_dict['id_on_platform']),
+						'is_json': False,
+					} for result_dict in chunk if not result_dict.get('results_detailed_loaded')
+				]))
+				for result_dict in chunk:
+					if result_dict.get('results_detailed_loaded'):
+						n_loaded_total += 1
+						self._IncreaseGenderCounters(result_dict)
+						continue
+					url = self.DetailedResultURL(result_dict['id_on_platform'])
+					result_dict.update(self.ParseDetailedResultPage(url=url, content=next(contents), result_dict=result_dict))
+					result_dict.update(self.FillGender(url=url, result_dict=result_dict))
+
 					n_loaded_total += 1
-					self._IncreaseGenderCounters(result_dict)
-					continue
-				params = {'runnerId': result_dict['id_on_platform']}
-				url = self.DetailedResultURL(result_dict['id_on_platform'])
-				res = util.LoadAndStore(self.DownloadedFilesDir(platform_runner_id=result_dict['id_on_platform']), url, is_json=False)
-				result_dict.update(self.ParseDetailedResultPage(url=url, content=res, result_dict=result_dict))
-				result_dict.update(self.FillGender(url=url, result_dict=result_dict))
-
-				n_loaded_total += 1
-				n_loaded_now += 1
-
-				if (result_num % 1000) == 999:
-					self.attempt.UpdateStatus(f'LoadDetailedResults: Loaded {result_num+1} detailed results out of {len(race["results"])}')
+					n_loaded_now += 1
+
+				if len(chunk) == DETAILED_RESULTS_PER_CHUNK:
+					self.attempt.UpdateStatus(f'LoadDetailedResults: Loaded {chunk_start + len(chunk)} detailed results out of {len(race["results"])}')
 					self.DumpStandardForm()
 					if self.ToStopNow():
 						raise util.TimeoutError(f'Time out. Loaded {n_loaded_total} out of {len(race["results"])} detailed results')
@@ -584,11 +595,11 @@ class MikaTimingScraper(util.Scraper):
 
 	def SaveEventDetailsInStandardForm(self):
 		self._ParseUrlIfNeeded()
-		self.title_page_soup = bs4.BeautifulSoup(util.LoadAndStore(self.DownloadedFilesDir(), self.url, is_json=False), 'html.parser')
-		if os.path.isfile(self.StandardFormPath()):
-			print(f'Reading all event data from {self.StandardFormPath()}')
-			with io.open(self.StandardFormPath(), encoding="utf8") as json_in:
-				self.standard_form_dict = json.load(json_in)
+		self.title_page_soup = bs4.BeautifulSoup(util.LoadAndStore(self.DownloadedFilesDir(), self.url, is_json=False, ttl=util.MUTABLE_PAGE_TTL),
+			'html.parser')
+		if self.HasStandardForm():
+			print(f'Reading all event data from {self.StandardFormDir()}')
+			self.ReadStandardForm()
 		else:
 			self.InitStandardFormDict()
 			if self.reason_to_ignore:
@@ -2,16 +2,14 @@ from django.conf import settings
 
 from results import links, models, results_util
 from editor import parse_strings
-from . import util
+from . import http_cache, util
 
 from collections import Counter, OrderedDict
 import datetime
 import io
 import json
-import os
 from typing import Optional
 import requests
-import time
 
 HEADERS = {
 	# 'User-Agent' : 'YaBrowser/16.2.0.3539 Safari/537.36',
@@ -95,6 +93,7 @@ class NyrrScraper(util.Scraper):
 		cur_year = datetime.date.today().year
 		year_range = range(1970, cur_year + 1) if for_all_years else range(cur_year - 1, cur_year + 1)
 		for year in year_range:
+			http_cache.rate_limiter.Wait(cls.ALL_EVENTS_URL)
 			res = requests.post(cls.ALL_EVENTS_URL, headers=HEADERS, json={
 					'pageIndex': 1,
 					'pageSize': ITEMS_PER_PAGE,
@@ -135,7 +134,6 @@ class NyrrScraper(util.Scraper):
 					print(f'{url} was added')
 				if limit and n_added == limit:
 					return f'Added {n_added} events to queue; {n_already_present} events were already there.'
-			time.sleep(1)
 		if for_all_years:
 			with io.open(settings.INTERNAL_FILES_ROOT + 'misc/nyrr/all_events.json', "w", encoding="utf8") as file_out:
 				json.dump(
@@ -154,7 +152,8 @@ class NyrrScraper(util.Scraper):
 			('pageSize', self.PAGE_SIZE),
 			('sortColumn', 'overallTime'),
 		])
-		res = util.LoadAndStore(mydir, self.EVENT_RESULTS_URL, method='POST', params=params)
+		# The number of results grows while the organizers are adding them.
+		res = util.LoadAndStore(mydir, self.EVENT_RESULTS_URL, method='POST', params=params, ttl=util.MUTABLE_PAGE_TTL)
 		return res['totalItems']
 
 	# Returns the number of just loaded brief results.
@@ -308,10 +307,9 @@ class NyrrScraper(util.Scraper):
 		}
 
 	def SaveEventDetailsInStandardForm(self):
-		if os.path.isfile(self.StandardFormPath()):
-			print(f'Reading all event data from {self.StandardFormPath()}')
-			with io.open(self.StandardFormPath(), encoding="utf8") as json_in:
-				self.standard_form_dict = json.load(json_in)
+		if self.HasStandardForm():
+			print(f'Reading all event data from {self.StandardFormDir()}')
+			self.ReadStandardForm()
 		else:
 			self.InitStandardFormDict()
 			self.DumpStandardForm()
@@ -1,7 +1,7 @@
 from django.conf import settings
 
 from results import models, results_util
-from . import util
+from . import http_cache, util
 
 from bs4 import BeautifulSoup, Tag
 from dataclasses import dataclass, asdict
@@ -10,7 +10,6 @@ import io
 import json
 from typing import List, Optional, Set, Tuple
 import requests
-import time
 import re
 
 RESULTSET_RE = re.compile(r'(https?://runsignup\.com)?(?P<url>/Race/Results/(Simple/)?(?P<series>[0-9]+)/?#?\??(resultSetId(=|-)(?P<resultset>[0-9]+).*)?)')
@@ -138,6 +137,7 @@ class RunsignupScraper(util.Scraper):
         page_str = f'&page={page}' if page is not None else ''
         cur_page: Optional[str] = f'/Races?num={ITEMS_PER_PAGE}{page_str}'
         while cur_page is not None:
+            http_cache.rate_limiter.Wait(BASE_URL)
             res = requests.get(BASE_URL + cur_page, headers=results_util.HEADERS)
 
             if res.status_code != 200:
@@ -179,6 +179,7 @@ class RunsignupScraper(util.Scraper):
                         print(f'{race_url} is already in the queue')
                     continue
 
+                http_cache.rate_limiter.Wait(race_url)
                 race_page = requests.get(race_url, headers=results_util.HEADERS)
                 if race_page.status_code != 200:
                     if debug:
@@ -197,6 +198,7 @@ class RunsignupScraper(util.Scraper):
                     # no resultset ids on race page, we have to parse results page
                     if resultset_id is None:
                         results_url = BASE_URL + url
+                        http_cache.rate_limiter.Wait(results_url)
                         results_page = requests.get(results_url, headers=results_util.HEADERS)
                         if results_page.status_code != 200:
                             if debug:
@@ -232,7 +234,6 @@ class RunsignupScraper(util.Scraper):
                 if limit and n_added >= limit:
                     return True, f'{n_added} protocols were added to the queue! Stopped at {cur_page}'
             cur_page = next_page
-            time.sleep(1)
         if limit is None:
             with io.open(settings.INTERNAL_FILES_ROOT + 'misc/runsignup/all_events.json', "w", encoding="utf8") as file_out:
                 json.dump(
@@ -3,14 +3,14 @@ from django.contrib import messages
 from django.db.models import Q
 from django.shortcuts import get_object_or_404, redirect
 
+import concurrent.futures
 import datetime
 import json
-import time
 from typing import Optional
 
 from results import models, results_util
 from editor import generators, runner_stat, stat
-from editor.scrape import util
+from editor.scrape import http_cache, util
 from editor.views import views_common, views_result
 
 ROOT_JSON_URLS = ('https://s95.ru/pages/index.json', 'https://s95.by/pages/index.json')
@@ -23,11 +23,26 @@ def ParkrunId(url_results: str, athlete_dict: dict[str, any]) -> Optional[int]:
 		raise Exception(f'S95 event {url_results}: parkrun ID {parkrun_id} is too big')
 	return parkrun_id
 
-# Load results for given race from given URL with json.
+# Returns the dict <platform_id> -> <athlete's ID there>.
+def PlatformIds(url_results: str, athlete_dict: dict[str, any]) -> dict[str, int]:
+	if athlete_dict['name'] == 'НЕИЗВЕСТНЫЙ' and ('id' not in athlete_dict):
+		return {}
+	platforms_dict = {}
+	if parkrun_id := ParkrunId(url_results, athlete_dict):
+		platforms_dict['parkrun'] = parkrun_id
+	if s95_id := athlete_dict['id']:
+		platforms_dict['s95'] = s95_id
+	return platforms_dict
+
+# The same as results_util.read_url, but respects the rate limit of the host, so that several pages can be fetched at once.
+def read_url(url: str):
+	http_cache.rate_limiter.Wait(url)
+	return results_util.read_url(url)
+
+# Load results for given race from given URL with json, or from page if it was already fetched with read_url.
 # Returns the number of loaded results and the set of touched runners.
-def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[models.Runner]]:
-	result, html, _, _, error = results_util.read_url(url_results)
-	time.sleep(1)
+def load_race_results(race: models.Race, url_results: str, page: Optional[tuple]=None) -> tuple[int, set[models.Runner]]:
+	result, html, _, _, error = page if page else read_url(url_results)
 	if not result:
 		models.write_log(f'Could not load results for {race.event}, id={race.event.id}, from url {url_results}: {error}')
 		return 0, set()
@@ -37,15 +52,13 @@ def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[mod
 		raise Exception(f'{url_results}: failed decoding content of length {len(html)}, "{html[:100]}": {e}')
 
 	race.result_set.filter(source=models.RESULT_SOURCE_DEFAULT).delete()
-	results_added = 0
-	runners_touched = set()
 	new_results = []
-	messages = []
+	platform_ids = [PlatformIds(url_results, result_dict['athlete']) for result_dict in data['results']]
+	resolver = util.RunnersWithPlatformIDsResolver(platform_ids)
 
-	for result_dict in data['results']:
+	for result_dict, platforms_dict in zip(data['results'], platform_ids):
 		gender = results_util.GENDER_UNKNOWN
 		gender_raw = result_dict['athlete'].get('gender')
-		runner = None
 		s95_id = None
 		if result_dict['athlete']['name'] == 'НЕИЗВЕСТНЫЙ' and ('id' not in result_dict['athlete']):
 			lname = fname = midname = ''
@@ -57,13 +70,7 @@ def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[mod
 					models.send_panic_email(
 						'parse/s95: load_race_results: problem with gender',
 						f'Problem with race id {race.id}, url {url_results} : gender "{result_dict["athlete"]["gender"]}" cannot be parsed')
-			
-			platforms_dict = {}
-			if parkrun_id := ParkrunId(url_results, result_dict['athlete']):
-				platforms_dict['parkrun'] = parkrun_id
 			s95_id = result_dict['athlete']['id']
-			if s95_id:
-				platforms_dict['s95'] = s95_id
 
 			if platforms_dict:
 				fields_to_fill = {'gender': gender}
@@ -74,8 +81,7 @@ def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[mod
 				if midname:
 					fields_to_fill['midname'] = midname
 				result_desc = f'Race {url_results}, {lname} {fname}'
-				runner, messages_ = util.RunnerWithPlatformIDs(platforms_dict, fields_to_fill, result_desc)
-				messages += messages_
+				resolver.Resolve(platforms_dict, fields_to_fill, result_desc)
 
 		centiseconds = models.string2centiseconds(result_dict['total_time'])
 		if centiseconds == 0:
@@ -85,8 +91,6 @@ def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[mod
 
 		new_results.append(models.Result(
 			race=race,
-			runner=runner,
-			user=runner.user if runner else None,
 			runner_id_on_platform=s95_id,
 			name_raw=result_dict['athlete']['name'],
 			result_raw=result_dict['total_time'],
@@ -101,19 +105,25 @@ def load_race_results(race: models.Race, url_results: str) -> tuple[int, set[mod
 			gender=gender,
 			gender_raw=gender,
 		))
-		if runner:
-			runners_touched.add(runner)
 
+	# Now all new runners are saved, and we know the runners after all merges.
+	resolver.Flush()
+	runners_touched = set()
+	for result, platforms_dict in zip(new_results, platform_ids):
+		if platforms_dict:
+			result.runner = resolver.CurrentRunner(platforms_dict)
+			result.user = result.runner.user
+			runners_touched.add(result.runner)
 	models.Result.objects.bulk_create(new_results)
 	views_result.fill_places(race)
 	views_result.fill_race_headers(race)
 	if len(new_results) > 0:
 		race.load_status = models.RESULTS_LOADED
 		race.save()
-	if messages:
+	if resolver.messages:
 		models.send_panic_email(
 			'parse/s95: load_race_results: warnings',
-			f'Problem with race id {race.id}, url {url_results} :\n' + '\n'.join(messages))
+			f'Problem with race id {race.id}, url {url_results} :\n' + '\n'.join(resolver.messages))
 	print(f'{url_results} - {len(new_results)} loaded')
 	return len(new_results), runners_touched
 
@@ -233,10 +243,11 @@ def get_event_url(series: models.Series, global_number: int) -> str:
 	return series.url_site.rstrip('/') + f'/activities/{global_number}'
 
 # Check: Are there any new runs with current series that are not in base? If yes, load them.
-def update_series_results(series: models.Series, user: User, update_runners_stat: bool=True):
+# history is the result of read_url for the series history if it was already fetched.
+def update_series_results(series: models.Series, user: User, update_runners_stat: bool=True, history: Optional[tuple]=None):
 	new_races = []
 	url_history = get_series_history_url(series)
-	result, html, _, _, error = results_util.read_url(url_history)
+	result, html, _, _, error = history if history else read_url(url_history)
 	if not result:
 		models.send_panic_email(
 			'parse/s95: update_series_results: problem with event history',
@@ -245,17 +256,23 @@ def update_series_results(series: models.Series, user: User, update_runners_stat
 	data = json.loads(html)
 	new_races_created = False
 	runners_touched = set()
+	races_to_load = []
 	for item in data['activities']:
 		event_date = datetime.datetime.strptime(item['date'], '%Y-%m-%d').date()
 		url_results = item['url']
 		existed, race = get_or_create_event_and_race(series, url_results, event_date, results_util.DEFAULT_PARKRUN_START_TIME, None, user)
 		if race.load_status != models.RESULTS_LOADED:
-			models.write_log(f'New event found: {url_results}')
-			n_results, new_runners_touched = load_race_results(race, url_results)
-			runners_touched |= new_runners_touched
-			new_races.append((race, n_results, existed))
-			if not existed:
-				new_races_created = True
+			races_to_load.append((race, url_results, existed))
+	pages = util.MapConcurrently(read_url, [(url_results, ) for _, url_results, _ in races_to_load])
+	for (race, url_results, existed), (page, exception) in zip(races_to_load, pages):
+		if exception:
+			raise exception
+		models.write_log(f'New event found: {url_results}')
+		n_results, new_runners_touched = load_race_results(race, url_results, page=page)
+		runners_touched |= new_runners_touched
+		new_races.append((race, n_results, existed))
+		if not existed:
+			new_races_created = True
 	if update_runners_stat:
 		runner_stat.update_runners_and_users_stat(runners_touched)
 	return new_races, runners_touched
@@ -292,7 +309,7 @@ def update_weekly_results() -> tuple[list[models.Series], list[tuple[models.Race
 	future_events_created = 0
 
 	for root_url in ROOT_JSON_URLS:
-		result, html, _, _, error = results_util.read_url(root_url)
+		result, html, _, _, error = read_url(root_url)
 		if not result:
 			return [], [], 0, f'Не получилось загрузить данные о сериях с адреса {root_url}: {error}'
 		data = json.loads(html)
@@ -312,13 +329,16 @@ def update_weekly_results() -> tuple[list[models.Series], list[tuple[models.Race
 				series = create_new_series(item, series_url)
 			series_to_process.append(series)
 
-	for series in series_to_process:
-		races, runners = update_series_results(series, models.USER_ROBOT_CONNECTOR, update_runners_stat=False)
-		new_races += races
-		runners_touched |= runners
-		time.sleep(6)
-		if series.create_weekly:
-			future_events_created += create_future_events(series, models.USER_ROBOT_CONNECTOR)
+	# Series histories are fetched in several threads while we process the ones already fetched.
+	# All DB work is done in this thread, one series after another.
+	with concurrent.futures.ThreadPoolExecutor(max_workers=util.MAX_CONCURRENT_REQUESTS) as executor:
+		histories = [executor.submit(read_url, get_series_history_url(series)) for series in series_to_process]
+		for series, history in zip(series_to_process, histories):
+			races, runners = update_series_results(series, models.USER_ROBOT_CONNECTOR, update_runners_stat=False, history=history.result())
+			new_races += races
+			runners_touched |= runners
+			if series.create_weekly:
+				future_events_created += create_future_events(series, models.USER_ROBOT_CONNECTOR)
 	if runners_touched:
 		runner_stat.update_runners_and_users_stat(runners_touched)
 		stat.update_results_count()
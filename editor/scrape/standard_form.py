@@ -0,0 +1,135 @@
+# Storage of scraped events in the standard form, in the directory of the event:
+# * header.json has all the event data except results, and the list of races;
+# * race_<num>.jsonl.gz has the results of the race with this number, one compact JSON per line.
+# Write() rewrites only the races whose results have changed since the previous call, so scrapers can dump the event
+# after each portion of loaded results. LoadResultsToDB reads the results one race at a time with ReadRaceResults().
+# Older events are stored as one indented event.json; ConvertLegacy() converts such files.
+import gzip
+import io
+import json
+import os
+import pathlib
+import tempfile
+from typing import Any, Iterator, Optional
+import zlib
+
+HEADER_FILE = 'header.json'
+LEGACY_FILE = 'event.json'
+RESULTS_KEY = 'results'
+RESULTS_INFO_KEY = '_results' # Is stored in the header instead of results: the file name and the checksum
+
+def RaceFileName(race_num: int) -> str:
+	return f'race_{race_num:03}.jsonl.gz'
+
+def DumpResults(results: list[dict[str, Any]]) -> bytes:
+	return ''.join(json.dumps(result, ensure_ascii=False, separators=(',', ':')) + '\n' for result in results).encode('utf8')
+
+# Writes content to a temporary file first, so that readers never see a half-written file.
+def WriteAtomically(path: pathlib.Path, content: bytes, compress: bool=False):
+	with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as file_out:
+		if compress:
+			with gzip.GzipFile(fileobj=file_out, mode='wb', mtime=0) as gzip_out:
+				gzip_out.write(content)
+		else:
+			file_out.write(content)
+	os.chmod(file_out.name, 0o664) # Temporary files are only readable by the owner by default.
+	os.replace(file_out.name, path)
+
+def HasStandardForm(event_dir: pathlib.Path) -> bool:
+	return (event_dir / HEADER_FILE).is_file() or (event_dir / LEGACY_FILE).is_file()
+
+# Writes standard_form_dict to event_dir. checksums (race number -> checksum of its results) are the ones returned by the previous
+# call of Write or Read for this event; races with the same checksum are not written again. Races whose results are None
+# (see Scraper.DropResultsFromMemory) are considered unchanged. Returns the new checksums.
+def Write(event_dir: pathlib.Path, standard_form_dict: dict[str, Any], checksums: dict[int, int]) -> dict[int, int]:
+	event_dir.mkdir(parents=True, exist_ok=True)
+	header = {key: value for key, value in standard_form_dict.items() if key != 'races'}
+	header['races'] = []
+	new_checksums = {}
+	for race_num, race_dict in enumerate(standard_form_dict.get('races', [])):
+		race_header = {key: value for key, value in race_dict.items() if key != RESULTS_KEY}
+		results = race_dict.get(RESULTS_KEY)
+		if RESULTS_KEY in race_dict:
+			if results is None:
+				if race_num not in checksums:
+					raise ValueError(f'Results of race {race_num} are neither in memory nor in {event_dir}')
+				race_header[RESULTS_INFO_KEY] = {'file': RaceFileName(race_num), 'checksum': checksums[race_num]}
+			else:
+				content = DumpResults(results)
+				checksum = zlib.crc32(content)
+				path = event_dir / RaceFileName(race_num)
+				if (checksums.get(race_num) != checksum) or not path.is_file():
+					WriteAtomically(path, content, compress=True)
+				race_header[RESULTS_INFO_KEY] = {'file': path.name, 'checksum': checksum}
+			new_checksums[race_num] = race_header[RESULTS_INFO_KEY]['checksum']
+		header['races'].append(race_header)
+	# The header is written last: after a crash in the middle, the old header still refers to consistent race files.
+	WriteAtomically(event_dir / HEADER_FILE, json.dumps(header, ensure_ascii=False, sort_keys=True, indent=1).encode('utf8'))
+	race_files = {race_header[RESULTS_INFO_KEY]['file'] for race_header in header['races'] if RESULTS_INFO_KEY in race_header}
+	for path in event_dir.glob('race_*.jsonl.gz'):
+		if path.name not in race_files:
+			path.unlink()
+	legacy_path = event_dir / LEGACY_FILE
+	if legacy_path.is_file():
+		legacy_path.unlink()
+	return new_checksums
+
+def ReadRaceResults(event_dir: pathlib.Path, race_num: int) -> Iterator[dict[str, Any]]:
+	with gzip.open(event_dir / RaceFileName(race_num), 'rt', encoding='utf8') as file_in:
+		for line in file_in:
+			if line.strip():
+				yield json.loads(line)
+
+# Returns the whole event in the standard form and the checksums of its races, or (None, {}) if there is no event in event_dir.
+# If with_results is False, the results are replaced with None, and ReadRaceResults should be used to get them.
+def Read(event_dir: pathlib.Path, with_results: bool=True) -> tuple[Optional[dict[str, Any]], dict[int, int]]:
+	header_path = event_dir / HEADER_FILE
+	if not header_path.is_file():
+		legacy_path = event_dir / LEGACY_FILE
+		if not legacy_path.is_file():
+			return None, {}
+		with io.open(legacy_path, encoding='utf8') as json_in:
+			return json.load(json_in), {}
+	with io.open(header_path, encoding='utf8') as json_in:
+		standard_form_dict = json.load(json_in)
+	checksums = {}
+	for race_num, race_dict in enumerate(standard_form_dict['races']):
+		results_info = race_dict.pop(RESULTS_INFO_KEY, None)
+		if results_info is None:
+			continue
+		checksums[race_num] = results_info['checksum']
+		race_dict[RESULTS_KEY] = list(ReadRaceResults(event_dir, race_num)) if with_results else None
+	return standard_form_dict, checksums
+
+# Removes the event from event_dir in any format. Returns whether there was anything to remove.
+def Delete(event_dir: pathlib.Path) -> bool:
+	paths = [event_dir / HEADER_FILE, event_dir / LEGACY_FILE] + list(event_dir.glob('race_*.jsonl.gz'))
+	existing = [path for path in paths if path.is_file()]
+	for path in existing:
+		path.unlink()
+	return len(existing) > 0
+
+# Converts event.json in event_dir to the new format and removes it, if the result is read back the same.
+def ConvertLegacy(event_dir: pathlib.Path) -> bool:
+	legacy_path = event_dir / LEGACY_FILE
+	with io.open(legacy_path, encoding='utf8') as json_in:
+		standard_form_dict = json.load(json_in)
+	with tempfile.TemporaryDirectory(dir=event_dir) as tmp_dir:
+		Write(pathlib.Path(tmp_dir), standard_form_dict, {})
+		if Read(pathlib.Path(tmp_dir))[0] != standard_form_dict:
+			return False
+	Write(event_dir, standard_form_dict, {})
+	return True
+
+# Converts all event.json files under root. Returns the numbers of converted and failed events.
+def ConvertAllLegacy(root: pathlib.Path, debug: bool=False) -> tuple[int, int]:
+	n_converted = n_failed = 0
+	for legacy_path in sorted(root.rglob(LEGACY_FILE)):
+		if ConvertLegacy(legacy_path.parent):
+			n_converted += 1
+		else:
+			n_failed += 1
+			print(f'{legacy_path}: the converted event differs from the original one. Leaving it as is')
+		if debug:
+			print(f'{legacy_path}: done')
+	return n_converted, n_failed
@@ -1,8 +1,6 @@
 from typing import List, Tuple, Dict, Optional
 import bs4
 from collections import OrderedDict
-import json
-import os
 import pathlib
 import requests
 from urllib import parse
@@ -23,7 +21,7 @@ def FetchAndFollowLinks(mydir: pathlib.Path, url: str) -> list[tuple[str, str]]:
 	Возвращает:
 		List[Tuple[str, str]]: Список кортежей, содержащих ссылки и текстовые описания.
 	"""  
-	contents = util.LoadAndStore(mydir, url, is_json=False)
+	contents = util.LoadAndStore(mydir, url, is_json=False, ttl=util.MUTABLE_PAGE_TTL)
 	soup = bs4.BeautifulSoup(contents, 'html.parser')
 	urls_h2 = soup.find_all('h2')
 	url_list = [a for h2 in urls_h2 for a in h2.find_all('a')]
@@ -54,7 +52,7 @@ def FetchDropdownOptions(mydir: pathlib.Path, url: str) -> List[Tuple[str, str]]
 	Возвращает:
 		List[Tuple[str, str]]: Список кортежей, содержащих значения и текст опций.
 	"""	
-	contents = util.LoadAndStore(mydir, url, is_json=False)
+	contents = util.LoadAndStore(mydir, url, is_json=False, ttl=util.MUTABLE_PAGE_TTL)
 	print(f'Fetching {url}')
 	soup = bs4.BeautifulSoup(contents, 'html.parser')
 	dropdown = soup.find('select', {'id': 'select1'})
@@ -283,10 +281,9 @@ class TrackShackResultsScraper(util.Scraper):
 		
 	def SaveEventDetailsInStandardForm(self):
 		self._ParseUrlIfNeeded()
-		if os.path.isfile(self.StandardFormPath()):
-			print(f'Reading all event data from {self.StandardFormPath()}')
-			with io.open(self.StandardFormPath(), encoding="utf8") as json_in:
-				self.standard_form_dict = json.load(json_in)
+		if self.HasStandardForm():
+			print(f'Reading all event data from {self.StandardFormDir()}')
+			self.ReadStandardForm()
 		else:
 			self.InitStandardFormDict()
 			self.LoadResults()
@@ -3,19 +3,19 @@ from django.db.models import Q
 from django.utils import timezone
 
 from collections import defaultdict
+import concurrent.futures
 from dataclasses import dataclass, field
 import datetime
-import io
-import json
 import os
 import pathlib
 import requests
 import time
-from typing import Optional
+from typing import Iterable, Optional
 
 from results import models, results_util
 from editor import parse_protocols, runner_stat
 from editor.views import views_result
+from . import http_cache, standard_form
 
 FILE_TYPE_DOWNLOADED = 1
 FILE_TYPE_STANDARD_FORM = 2
@@ -28,6 +28,10 @@ ATTEMPT_TIMEOUT = datetime.timedelta(hours=5)
 
 WAIT_BEFORE_LOADING = datetime.timedelta(days=7)
 
+# For how long LoadAndStore uses cached pages that change over time, like lists of events in a series or event metadata.
+# After that, it revalidates them with a conditional request.
+MUTABLE_PAGE_TTL = datetime.timedelta(days=1)
+
 ACTIVE_PLATFORM_IDS = (
 	'nyrr',
 	'mikatiming',
@@ -41,6 +45,8 @@ EVENTS_WITH_WRONG_DATE = frozenset([
 
 MAX_PARKRUN_ID = 99999999 # To distinguish them from 5verst codes.
 
+BULK_CHUNK_SIZE = 1000 # How many rows we insert with one query when loading results in bulk.
+
 class RetryableError(Exception):
 	pass
 
@@ -148,7 +154,7 @@ def RemoveSuffix(text, suffix):
         return text[:-len(suffix)]
     return text
 
-def url2filename(url: str, method: str = 'GET', params: dict[str, any] = {}) -> str:
+def url2filename(url: str, method: str = 'GET', params: dict[str, any] = {}, max_length: int = 250) -> str:
 	res = RemovePrefix(RemovePrefix(url, 'https://'), 'http://').replace('/', '_').replace('?', '_').replace('=', '_').replace('.', '_').replace('&', '_')
 	delimiter = '_' if (method == 'GET') else '#'
 	params_str = ''
@@ -156,7 +162,7 @@ def url2filename(url: str, method: str = 'GET', params: dict[str, any] = {}) ->
 		if val:
 			params_str += f'{delimiter}{key}{delimiter}{val}'
 	# We want POST params to always be present in the file name.
-	return res[:(250 - len(params_str))] + params_str
+	return res[:(max_length - len(params_str))] + params_str
 
 # Should we load to the DB the results of the event with provided name?
 def ToLoadResults(race_name: str) -> bool:
@@ -199,6 +205,8 @@ def IsJsonWithTransientError(content) -> bool:
 		return True
 	return False
 
+# Returns the content of the url, from the cache in mydir if possible.
+# If ttl is set, cached GET responses older than ttl are revalidated with a conditional request.
 def LoadAndStore(mydir: pathlib.Path,
 		url: str,
 		method: str = 'GET',
@@ -206,45 +214,88 @@ def LoadAndStore(mydir: pathlib.Path,
 		allow_empty_result: bool=False,
 		is_json: bool=True,
 		arg_for_post_data: str='json', # In most cases 'json' works, but baa.com needs 'data', I don't know why.
+		ttl: Optional[datetime.timedelta]=None,
 		debug=0) -> any:
-	path = mydir / url2filename(url, method, params)
-	if os.path.isfile(path) and (os.path.getsize(path) > 0):
+	path = mydir / (url2filename(url, method, params, max_length=250 - len(http_cache.COMPRESSED_SUFFIX)) + http_cache.COMPRESSED_SUFFIX)
+	entry = http_cache.ReadEntry(path)
+	if entry is None:
+		legacy_path = mydir / url2filename(url, method, params)
+		if os.path.isfile(legacy_path) and (os.path.getsize(legacy_path) > 0):
+			entry = http_cache.ConvertLegacyFile(legacy_path, path, is_json=is_json)
+	if entry and http_cache.IsFresh(entry, ttl):
 		if debug > 0:
 			print(f'Reading URL {url}; {method}; {params} (from file)')
-		with io.open(path, encoding="utf8") as file_in:
-			return json.load(file_in) if is_json else file_in.read()
+		http_cache.Touch(path)
+		return entry['content']
 
 	mydir.mkdir(parents=True, exist_ok=True)
 	# os.chmod(mydir, 0o770)
 	if debug > 0:
 		print(f'Reading URL {url}; {method}; {params} (from web)')
 	if method == 'GET':
-		req = results_util.session.get(url, params=params)
+		req = http_cache.Fetch(results_util.session, 'GET', url, params=params, headers=http_cache.ConditionalHeaders(entry))
+		if entry and (req.status_code == 304):
+			entry['fetched_at'] = time.time()
+			http_cache.WriteEntry(path, entry)
+			return entry['content']
 	else:
-		req = results_util.session.post(url, **{arg_for_post_data: params})
+		req = http_cache.Fetch(results_util.session, method, url, **{arg_for_post_data: params})
 	res, _ = TryGetJson(req, is_json=is_json)
 	if not res:
 		if allow_empty_result:
 			return None
 		raise NonRetryableError(f'URL {url} with params {params} returned empty json. Path not found: {path}')
 	if not IsJsonWithTransientError(res): # Otherwise, it may be a transient error. We don't want to cache such results.
-		with io.open(path, "w", encoding="utf8") as json_out:
-			if is_json:
-				json.dump(
-					res,
-					json_out,
-					ensure_ascii=False,
-					sort_keys=True,
-					indent=4
-				)
-			else:
-				json_out.write(res)
-	time.sleep(1)
-	return res	
+		http_cache.WriteEntry(path, http_cache.MakeEntry(req, res))
+	return res
+
+# How many requests MapConcurrently makes at once. The rate limits of hosts in http_cache still apply.
+# Keep it below the connection pool size of results_util.session (10 per host by default).
+MAX_CONCURRENT_REQUESTS = 8
+
+def _CallCatching(func, args: tuple) -> tuple[any, Optional[Exception]]:
+	try:
+		return func(*args), None
+	except Exception as e:
+		return None, e
+
+# Calls func(*args) for each tuple in args_list in at most max_workers threads.
+# Returns the list of pairs (result, exception), one of them None, in the same order as args_list,
+# so the caller can handle the exceptions in the original order, as if the calls were made one by one.
+def MapConcurrently(func, args_list: list[tuple], max_workers: int = MAX_CONCURRENT_REQUESTS) -> list[tuple[any, Optional[Exception]]]:
+	if len(args_list) <= 1:
+		return [_CallCatching(func, args) for args in args_list]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(lambda args: _CallCatching(func, args), args_list))
+
+# Calls LoadAndStore concurrently for each dict of its keyword arguments. Returns the contents in the same order.
+def LoadManyAndStore(calls: list[dict[str, any]]) -> list[any]:
+	res = []
+	for content, exception in MapConcurrently(lambda kwargs: LoadAndStore(**kwargs), [(kwargs, ) for kwargs in calls]):
+		if exception:
+			raise exception
+		res.append(content)
+	return res
 
 def IsVirtual(name: str) -> bool:
 	return 'virtual' in name.lower()
 
+# Sets the fields of the runner that are empty. Adds a warning for each non-empty field with a different value.
+# Returns the list of changed fields.
+def FillRunnerFields(runner: models.Runner, fields_to_fill: dict[str, int], result_desc: str, messages: list[str]) -> list[str]:
+	fields_changed = []
+	for field, new_val in fields_to_fill.items():
+		cur_val = getattr(runner, field)
+		if cur_val == new_val:
+			continue
+		if cur_val:
+			messages.append(
+				f'RunnerWithPlatformIDs: {result_desc}: when updating {field} for runner {runner} (id {runner.id}): old value "{cur_val}", new value "{new_val}"')
+			continue
+		setattr(runner, field, new_val)
+		fields_changed.append(field)
+	return fields_changed
+
 # Receives:
 # * ids - a dict of pairs <platform_id, value>,
 # * fields_to_fill - a dict of Runner model fields with values to fill in a new or existing runner.
@@ -299,17 +350,7 @@ def RunnerWithPlatformIDs(ids: dict[str, int], fields_to_fill: dict[str, int], r
 				messages.append(error)
 
 	# 3. Add new fields to the runner.
-	fields_changed = []
-	for field, new_val in fields_to_fill.items():
-		cur_val = getattr(runner, field)
-		if cur_val == new_val:
-			continue
-		if cur_val:
-			messages.append(
-				f'RunnerWithPlatformIDs: {result_desc}: when updating {field} for runner {runner} (id {runner.id}): old value "{cur_val}", new value "{new_val}"')
-			continue
-		setattr(runner, field, new_val)
-		fields_changed.append(field)
+	fields_changed = FillRunnerFields(runner, fields_to_fill, result_desc, messages)
 	if not runner.id:
 		runner.save()
 		models.log_obj_create(models.USER_ROBOT_CONNECTOR, runner, models.ACTION_CREATE, verified_by=models.USER_ROBOT_CONNECTOR,
@@ -324,6 +365,120 @@ def RunnerWithPlatformIDs(ids: dict[str, int], fields_to_fill: dict[str, int], r
 		models.Runner_platform.objects.create(platform_id=platform_id, runner=runner, value=ids[platform_id])
 	return runner, messages
 
+# Inserts objs to the DB with one query per chunk_size objects and fills their ids.
+def BulkCreateWithIds(model, objs: list, chunk_size: int=BULK_CHUNK_SIZE):
+	models.bulk_create_with_ids(model, objs, chunk_size)
+
+# Returns the dict <lowercased country_raw> -> country_id for all provided raw names that we know.
+# We lowercase the keys since the lookup by country_raw in the DB is case-insensitive.
+def CountryConversionMap(countries_raw: Iterable[str]) -> dict[str, str]:
+	countries_raw = set(countries_raw)
+	if not countries_raw:
+		return {}
+	return {country_raw.lower(): country_id
+		for country_raw, country_id in models.Country_conversion.objects.filter(country_raw__in=countries_raw).values_list('country_raw', 'country_id')}
+
+# Returns the dict <runner ID on platform> -> <runner ID in our DB> for all provided IDs that we know,
+# with one query per chunk_size IDs.
+def RunnerIdsByPlatformIds(platform_id: str, values: Iterable[int], chunk_size: int=BULK_CHUNK_SIZE) -> dict[int, int]:
+	values = sorted(set(values))
+	res = {}
+	for start in range(0, len(values), chunk_size):
+		res.update(models.Runner_platform.objects.filter(
+			platform_id=platform_id, value__in=values[start:start + chunk_size]).values_list('value', 'runner_id'))
+	return res
+
+@dataclass
+class PlatformRunner:
+	runner: models.Runner
+	values: dict[str, set[int]] # All IDs of the runner on platforms that we know
+	is_new: bool = False
+
+# Does the same as RunnerWithPlatformIDs for all athletes of a protocol, but with a few queries in total:
+# all Runner_platform rows for their IDs are loaded with one query per platform, and new runners with their platform IDs
+# are saved in bulk by Flush(), that must be called before saving the results.
+# Athletes whose IDs point to different runners or contradict known IDs of a runner are rare; they are passed to RunnerWithPlatformIDs
+# that merges the runners or raises an exception.
+class RunnersWithPlatformIDsResolver:
+	def __init__(self, ids_list: Iterable[dict[str, int]]):
+		self.runners = {} # (platform_id, value) -> PlatformRunner
+		self.new_runners = [] # PlatformRunner's to create in Flush()
+		self.platforms_to_add = [] # Triples (PlatformRunner, platform_id, value) to create in Flush()
+		self.messages = []
+		values = defaultdict(set)
+		for ids in ids_list:
+			for platform_id, value in ids.items():
+				values[platform_id].add(value)
+		runner_ids = set()
+		for platform_id, platform_values in values.items():
+			runner_ids |= set(RunnerIdsByPlatformIds(platform_id, platform_values).values())
+		self.LoadRunners(runner_ids)
+
+	def LoadRunners(self, runner_ids: Iterable[int]):
+		runner_ids = sorted(runner_ids)
+		for start in range(0, len(runner_ids), BULK_CHUNK_SIZE):
+			chunk = runner_ids[start:start + BULK_CHUNK_SIZE]
+			platform_runners = {runner_id: PlatformRunner(runner, defaultdict(set))
+				for runner_id, runner in models.Runner.objects.select_related('user__user_profile').in_bulk(chunk).items()}
+			for runner_id, platform_id, value in models.Runner_platform.objects.filter(runner_id__in=chunk).values_list('runner_id', 'platform_id', 'value'):
+				platform_runners[runner_id].values[platform_id].add(value)
+				self.runners[(platform_id, value)] = platform_runners[runner_id]
+
+	# Returns the runner with all these IDs; see RunnerWithPlatformIDs. The runner may be not saved to the DB until Flush().
+	def Resolve(self, ids: dict[str, int], fields_to_fill: dict[str, int], result_desc: str) -> models.Runner:
+		if not ids:
+			raise Exception(f'RunnerWithPlatformIDs: {result_desc}: ids cannot be empty')
+		found = []
+		for key in sorted(ids.items()):
+			platform_runner = self.runners.get(key)
+			if platform_runner and all(platform_runner is not other for other in found):
+				found.append(platform_runner)
+		if (len(found) > 1) or (found and any(found[0].values.get(platform_id) and (value not in found[0].values[platform_id])
+				for platform_id, value in ids.items())):
+			return self.ResolveOneByOne(ids, fields_to_fill, result_desc)
+		if found:
+			platform_runner = found[0]
+		else:
+			platform_runner = PlatformRunner(models.Runner(), defaultdict(set), is_new=True)
+			self.new_runners.append(platform_runner)
+		fields_changed = FillRunnerFields(platform_runner.runner, fields_to_fill, result_desc, self.messages)
+		if fields_changed and not platform_runner.is_new:
+			platform_runner.runner.save()
+			models.log_obj_create(models.USER_ROBOT_CONNECTOR, platform_runner.runner, models.ACTION_UPDATE, verified_by=models.USER_ROBOT_CONNECTOR,
+				field_list=fields_changed, comment='from RunnerWithPlatformIDs')
+		for platform_id, value in ids.items():
+			if (platform_id, value) not in self.runners:
+				self.runners[(platform_id, value)] = platform_runner
+				platform_runner.values[platform_id].add(value)
+				self.platforms_to_add.append((platform_runner, platform_id, value))
+		return platform_runner.runner
+
+	def ResolveOneByOne(self, ids: dict[str, int], fields_to_fill: dict[str, int], result_desc: str) -> models.Runner:
+		self.Flush() # RunnerWithPlatformIDs must see all runners and their IDs in the DB.
+		runner, messages = RunnerWithPlatformIDs(ids, fields_to_fill, result_desc)
+		self.messages += messages
+		self.LoadRunners([runner.id]) # It could get the IDs of merged runners.
+		return runner
+
+	# Returns the runner with given IDs after all merges made so far: the runners returned by Resolve earlier could be merged into other ones.
+	def CurrentRunner(self, ids: dict[str, int]) -> models.Runner:
+		return self.runners[sorted(ids.items())[0]].runner
+
+	def Flush(self):
+		if self.new_runners:
+			BulkCreateWithIds(models.Runner, [platform_runner.runner for platform_runner in self.new_runners])
+			models.Runner_search_name.bulk_create_for_runners([platform_runner.runner for platform_runner in self.new_runners])
+			with models.Audit_log_buffer():
+				for platform_runner in self.new_runners:
+					models.log_obj_create(models.USER_ROBOT_CONNECTOR, platform_runner.runner, models.ACTION_CREATE,
+						verified_by=models.USER_ROBOT_CONNECTOR, comment='from RunnerWithPlatformIDs')
+					platform_runner.is_new = False
+		if self.platforms_to_add:
+			models.Runner_platform.objects.bulk_create([models.Runner_platform(platform_id=platform_id, runner=platform_runner.runner, value=value)
+				for platform_runner, platform_id, value in self.platforms_to_add], batch_size=BULK_CHUNK_SIZE)
+		self.new_runners = []
+		self.platforms_to_add = []
+
 @dataclass
 class Scraper:
 	attempt: models.Download_attempt
@@ -336,7 +491,9 @@ class Scraper:
 	races_to_reload: list[int] = field(default_factory=list) # By default, we don't reload results for races that are already loaded.
 	attempt_timeout: datetime.timedelta = ATTEMPT_TIMEOUT
 	standard_form_dict: dict[str, any] = field(default_factory=dict)
+	standard_form_checksums: dict[int, int] = field(default_factory=dict) # See standard_form.Write
 	reason_to_ignore: str = '' # If non-empty, we do nothing with the event and don't raise an exception.
+	load_in_bulk: bool = True # If False, we save results, runners and splits to the DB one by one.
 	debug: int = 0
 
 	RACES_WITH_REPEATING_SPLIT_DISTANCES: set[int] = field(default_factory=set)
@@ -351,7 +508,11 @@ class Scraper:
 	def EventYear(self):
 		return datetime.date.fromisoformat(self.standard_form_dict['start_date']).year
 
-	# The file path to store the whole event in the standard form.
+	# The directory to store the whole event in the standard form; see standard_form.py.
+	def StandardFormDir(self) -> pathlib.Path:
+		return self.StandardFormPath().parent
+
+	# The file path where the whole event was stored in the standard form before we switched to standard_form.py.
 	def StandardFormPath(self) -> pathlib.Path:
 		platform_event_id = self.platform_event_id
 		if self.attempt.scraped_event.extra_data:
@@ -380,16 +541,28 @@ class Scraper:
 		)
 
 	def DumpStandardForm(self):
-		path = self.StandardFormPath()
-		path.parent.mkdir(parents=True, exist_ok=True)
-		with io.open(path, "w", encoding="utf8") as file_out:
-			json.dump(
-				self.standard_form_dict,
-				file_out,
-				ensure_ascii=False,
-				sort_keys=True,
-				indent=1,
-			)
+		self.standard_form_checksums = standard_form.Write(self.StandardFormDir(), self.standard_form_dict, self.standard_form_checksums)
+
+	def HasStandardForm(self) -> bool:
+		return standard_form.HasStandardForm(self.StandardFormDir())
+
+	def ReadStandardForm(self):
+		self.standard_form_dict, self.standard_form_checksums = standard_form.Read(self.StandardFormDir())
+
+	# Returns whether there was anything to delete.
+	def DeleteStandardForm(self) -> bool:
+		return standard_form.Delete(self.StandardFormDir())
+
+	# After the event is dumped, the results are only needed by LoadResultsToDB that reads them from disk one race at a time.
+	def DropResultsFromMemory(self):
+		for race_dict in self.standard_form_dict['races']:
+			if 'results' in race_dict:
+				race_dict['results'] = None
+
+	def RaceResults(self, race_num: int, race_dict: dict[str, any]) -> list[dict[str, any]]:
+		if ('results' in race_dict) and (race_dict['results'] is None):
+			return list(standard_form.ReadRaceResults(self.StandardFormDir(), race_num))
+		return race_dict.get('results', [])
 
 	def SaveEventDetailsInStandardForm(self):
 		raise NotImplementedError
@@ -611,11 +784,289 @@ class Scraper:
 		else:
 			self.CreateRaces()
 
-	def LoadResultsToDB(self):
+	# Creates (but doesn't save) a result from result_dict.
+	# Returns the result (or None if we don't need this result) and its description for error messages.
+	def MakeResult(self,
+			race: models.Race,
+			race_descr: str,
+			result_dict: dict[str, any],
+			category_sizes: dict[str, models.Category_size], # {name.lower(): category_size}
+			country_ids: dict[str, str], # The output of CountryConversionMap
+			) -> tuple[Optional[models.Result], str]:
 		user = models.USER_ROBOT_CONNECTOR
 		DEFAULT_RESULT = 0 if (self.PLATFORM_ID == 'athlinks') else ''
+		bib = result_dict.get('bib_raw', '')[:models.MAX_BIB_LENGTH]
+		result_descr = f'BIB "{bib}", result {result_dict.get("result_raw")}'
+		id_on_platform = str(result_dict.get('id_on_platform', ''))
+		if id_on_platform:
+			result_descr += f', id_on_platform {id_on_platform}'
+		result = models.Result(
+			race=race,
+			loaded_by=user,
+			name_raw=result_dict.get('name_raw', ''),
+			lname_raw=result_dict.get('lname_raw', ''),
+			fname_raw=result_dict.get('fname_raw', ''),
+			gender_raw=(result_dict.get('gender_raw') or '')[:10],
+			bib_raw=bib,
+			bib    =bib,
+			age_raw=result_dict.get('age_raw'),
+			age    =result_dict.get('age_raw'),
+			country_raw =result_dict.get('country_raw', ''),
+			id_on_platform=id_on_platform,
+			runner_id_on_platform=result_dict.get('runner_id_on_platform'),
+			status_raw=results_util.string2status(result_dict.get('status_raw', ''), source=self.PLATFORM_ID),
+			city_raw=result_dict.get('city_raw', ''),
+			region_raw=result_dict.get('region_raw', ''),
+			result_raw=result_dict.get('result_raw', DEFAULT_RESULT),
+			place_raw=result_dict.get('place_raw'),
+			place_gender_raw=result_dict.get('place_gender_raw'),
+			place_category_raw=result_dict.get('place_category_raw'),
+			club_name=result_dict.get('club_raw', ''),
+			)
+		result.lname = result.lname_raw.title().strip()
+		result.fname = result.fname_raw.title().strip()
+		result.gender = results_util.string2gender(result.gender_raw)
+		result.status = result.status_raw
+		if self.PLATFORM_ID == 'athlinks':
+			# There the raw result is already a number of centiseconds
+			result.result = result.result_raw
+		else:
+			result.result = models.string2centiseconds(result.result_raw)
+		if result.lname == '' and result.fname == '':
+			if self.PLATFORM_ID in ('athlinks', 'mikatiming'):
+				pass
+			else:
+				raise JsonParsingError(f'{race_descr}, {result_descr}: no last or first name')
+		if result.gender == results_util.GENDER_UNKNOWN:
+			if (self.PLATFORM_ID == 'nyrr') and (result.fname_raw == 'Anonymous'):
+				pass
+			elif self.PLATFORM_ID in ('athlinks', 'mikatiming'):
+				pass
+			else:
+				raise JsonParsingError(f'{race_descr}, {result_descr}: unknown gender {result.gender_raw}')
+		if result.status == results_util.STATUS_UNKNOWN:
+			raise JsonParsingError(f'{race_descr}, {result_descr}: unknown status {result_dict.get("status_raw")}')
+
+		if result.status == results_util.STATUS_FINISHED and result.result <= 0:
+			if (self.PLATFORM_ID == 'athlinks') and (result.fname.lower() in ('unknown', 'unknown male', 'unknown female')):
+				# Present e.g. in https://www.athlinks.com/event/115192/results/Event/905578/Course/1773173/Results
+				return None, result_descr
+			if (self.PLATFORM_ID == 'athlinks') and (result.result == 0):
+				# Common error like https://www.athlinks.com/event/115192/results/Event/905995/Course/1775375/Entry/419973081
+				result.status = results_util.STATUS_DNF
+			else:
+				raise JsonParsingError(f'{race_descr}, {result_descr}: '
+					+ f'Result is {result.result_raw} while status is "{result_dict.get("entryStatus")}"')
+
+		if result.country_raw:
+			result.country_id = country_ids.get(result.country_raw.lower())
+
+		if 'gun_time_raw' in result_dict:
+			result.gun_time_raw = result_dict['gun_time_raw']
+			if result.gun_time_raw:
+				if self.PLATFORM_ID == 'athlinks':
+					# There the raw result is already a number of centiseconds
+					result.gun_result = result.gun_time_raw
+				else:
+					result.gun_result = models.string2centiseconds(result.gun_time_raw)
+
+		category_raw = result_dict.get('category_raw')
+		if category_raw:
+			category = category_raw.strip()[:models.MAX_CATEGORY_LENGTH]
+			category_lower = category.lower()
+			if category_lower not in category_sizes:
+				# For unknown reason this Category_size sometimes already exists
+				category_sizes[category_lower], _ = models.Category_size.objects.get_or_create(race=race, name=category)
+			result.category_size = category_sizes[category_lower]
+		return result, result_descr
+
+	# Creates (but doesn't save) the splits of the result from result_dict.
+	def MakeSplits(self,
+			result: models.Result,
+			result_dict: dict[str, any],
+			cached_distances: dict[int, models.Distance], # models.Distance objects used for splits
+			race_descr: str,
+			result_descr: str,
+			) -> list[models.Split]:
+		res = []
+		splits_created = set() # Set of distances. They cannot repeat
+		for split_dict in result_dict.get('splits', []):
+			split_length = split_dict['distance']['length']
+			split_distance = cached_distances.get(split_length)
+			if not split_distance:
+				print(f'Looking for distance of length {split_length}')
+				split_distance, created = models.Distance.objects.get_or_create(distance_type=models.TYPE_METERS, length=split_length)
+				if created:
+					split_distance.name = split_distance.nameFromType()
+					split_distance.save()
+				cached_distances[split_length] = split_distance
+			if split_distance in splits_created:
+				if self.PLATFORM_ID == 'athlinks':
+					continue # Too many strange sets of splits, like https://www.athlinks.com/event/2164/results/Event/544721/Course/809433/Bib/36
+				raise JsonParsingError(f'{race_descr}, {result_descr}: split of length {split_length} is already present')
+			splits_created.add(split_distance)
+			res.append(models.Split(
+				result=result,
+				distance=split_distance,
+				value=split_dict['value'],
+			))
+		return res
+
+	# Saves the results of the race one by one.
+	# Returns the number of results for which we recovered links to runners/users deleted before loading.
+	def LoadRaceResultsOneByOne(self,
+			race: models.Race,
+			race_num: int,
+			race_dict: dict[str, any],
+			race_descr: str,
+			n_deleted_links: int,
+			cached_distances: dict[int, models.Distance],
+			runners_touched: set[models.Runner],
+			) -> int:
+		user = models.USER_ROBOT_CONNECTOR
+		n_recovered_links = 0
+		category_sizes = {}
+		country_ids = CountryConversionMap(result_dict.get('country_raw', '') for result_dict in race_dict['results'])
+		for result_num, result_dict in enumerate(race_dict['results']):
+			result, result_descr = self.MakeResult(race, race_descr, result_dict, category_sizes, country_ids)
+			if result is None:
+				continue
+
+			runner_id_on_platform = result_dict.get('runner_id_on_platform')
+			if runner_id_on_platform:
+				runner_platform = models.Runner_platform.objects.filter(platform_id=self.PLATFORM_ID, value=runner_id_on_platform).first()
+				if runner_platform:
+					runner = runner_platform.runner
+				else:
+					runner = models.Runner.objects.create(
+						lname=result.lname,
+						fname=result.fname,
+						gender=result.gender,
+					)
+					models.log_obj_create(user, runner, models.ACTION_CREATE, comment=f'When loading results from {self.url}', verified_by=user)
+					models.Runner_platform.objects.create(
+						platform_id=self.PLATFORM_ID,
+						runner=runner,
+						value=runner_id_on_platform,
+					)
+					self.n_runners_created += 1
+				self.n_runners_connected += 1
+				result.runner = runner
+				result.user_id = runner.user_id
+				runners_touched.add(runner)
+
+			if self.platform_event_id == '23MINI':
+				print(f'{race_descr}{result.lname}, {result_descr}: Saving to DB "{result.lname}" "{result.fname}"')
+			result.save()
+			self.n_results_created += 1
+
+			splits = self.MakeSplits(result, result_dict, cached_distances, race_descr, result_descr)
+			models.Split.objects.bulk_create(splits)
+			self.n_splits_created += len(splits)
+
+			# Now we try to recover killed with links to runners/users.
+			if (n_deleted_links > n_recovered_links) and parse_protocols.try_fix_lost_connection(result):
+				n_recovered_links += 1
+
+			if (result_num % 1000) == 999:
+				self.attempt.UpdateStatus(f'LoadResultsToDB: Loading {race_num+1} race out of {len(self.standard_form_dict["races"])}. '
+					+ f'Loaded {result_num+1} results out of {len(race_dict["results"])}')
+		return n_recovered_links
+
+	# Saves the results of the race with a few queries per BULK_CHUNK_SIZE results:
+	# we find all known runners with one query, create new runners and their Runner_platform's in bulk,
+	# and insert results and splits in chunks.
+	# Returns the number of results for which we recovered links to runners/users deleted before loading.
+	def LoadRaceResultsInBulk(self,
+			race: models.Race,
+			race_num: int,
+			race_dict: dict[str, any],
+			race_descr: str,
+			n_deleted_links: int,
+			cached_distances: dict[int, models.Distance],
+			runners_touched: set[models.Runner],
+			) -> int:
+		user = models.USER_ROBOT_CONNECTOR
+		category_sizes = {}
+		country_ids = CountryConversionMap(result_dict.get('country_raw', '') for result_dict in race_dict['results'])
+		runner_ids = RunnerIdsByPlatformIds(self.PLATFORM_ID,
+			(int(result_dict['runner_id_on_platform']) for result_dict in race_dict['results'] if result_dict.get('runner_id_on_platform')))
+		runners = {}
+		known_runner_ids = sorted(set(runner_ids.values()))
+		for start in range(0, len(known_runner_ids), BULK_CHUNK_SIZE):
+			runners.update(models.Runner.objects.in_bulk(known_runner_ids[start:start + BULK_CHUNK_SIZE]))
+
+		# 1. We create all the objects in memory, so that nothing is written if some result is malformed.
+		results = []
+		splits = []
+		new_runners = {} # {runner_id_on_platform: runner}
+		runner_values = [] # runner_id_on_platform for each element of results, or None
+		for result_dict in race_dict['results']:
+			result, result_descr = self.MakeResult(race, race_descr, result_dict, category_sizes, country_ids)
+			if result is None:
+				continue
+			value = None
+			if result_dict.get('runner_id_on_platform'):
+				value = int(result_dict['runner_id_on_platform'])
+				if (value not in runner_ids) and (value not in new_runners):
+					new_runners[value] = models.Runner(
+						lname=result.lname,
+						fname=result.fname,
+						gender=result.gender,
+					)
+			results.append(result)
+			runner_values.append(value)
+			splits += self.MakeSplits(result, result_dict, cached_distances, race_descr, result_descr)
+
+		# 2. We create new runners and connect them to the platform.
+		if new_runners:
+			BulkCreateWithIds(models.Runner, list(new_runners.values()))
+			models.Runner_search_name.bulk_create_for_runners(list(new_runners.values()))
+			with models.Audit_log_buffer():
+				for runner in new_runners.values():
+					models.log_obj_create(user, runner, models.ACTION_CREATE, comment=f'When loading results from {self.url}', verified_by=user)
+			models.Runner_platform.objects.bulk_create(
+				[models.Runner_platform(platform_id=self.PLATFORM_ID, runner=runner, value=value) for value, runner in new_runners.items()],
+				batch_size=BULK_CHUNK_SIZE)
+			self.n_runners_created += len(new_runners)
+			for value, runner in new_runners.items():
+				runner_ids[value] = runner.id
+				runners[runner.id] = runner
+		for result, value in zip(results, runner_values):
+			if value is None:
+				continue
+			runner = runners[runner_ids[value]]
+			result.runner = runner
+			result.user_id = runner.user_id
+			runners_touched.add(runner)
+			self.n_runners_connected += 1
+
+		# 3. We save results and splits.
+		for start in range(0, len(results), BULK_CHUNK_SIZE):
+			BulkCreateWithIds(models.Result, results[start:start + BULK_CHUNK_SIZE])
+			self.n_results_created += len(results[start:start + BULK_CHUNK_SIZE])
+			self.attempt.UpdateStatus(f'LoadResultsToDB: Loading {race_num+1} race out of {len(self.standard_form_dict["races"])}. '
+				+ f'Loaded {min(start + BULK_CHUNK_SIZE, len(results))} results out of {len(race_dict["results"])}')
+		models.Split.objects.bulk_create(splits, batch_size=BULK_CHUNK_SIZE)
+		self.n_splits_created += len(splits)
+
+		# 4. Now we try to recover killed with links to runners/users.
+		# We only call try_fix_lost_connection for results that look like some lost result.
+		n_recovered_links = 0
+		if n_deleted_links:
+			lost_keys = set((lname.lower(), fname.lower(), status, value)
+				for lname, fname, status, value in race.lost_result_set.values_list('lname', 'fname', 'status', 'result'))
+			for result in results:
+				if n_deleted_links <= n_recovered_links:
+					break
+				if ((result.lname.lower(), result.fname.lower(), result.status, result.result) in lost_keys) \
+						and parse_protocols.try_fix_lost_connection(result):
+					n_recovered_links += 1
+		return n_recovered_links
+
+	def LoadResultsToDB(self):
+		user = models.USER_ROBOT_CONNECTOR
 		d = self.standard_form_dict
-		n_results_loaded = 0
 
 		self.n_courses_touched = self.n_results_created = self.n_splits_created = self.n_runners_created = self.n_runners_connected = 0
 		runners_touched = set()
@@ -646,16 +1097,14 @@ class Scraper:
 				race_changed_fields.append('platform')
 
 			n_deleted_links = parse_protocols.delete_results_and_store_connections(None, user, race, race.result_set.filter(source=models.RESULT_SOURCE_DEFAULT))
-			n_recovered_links = 0
 			race.category_size_set.all().delete()
-			category_sizes = {} # {category_size.name: category_size}
-			category_lower_to_orig = {} # {name.lower(): name}
 
 			if race_id_on_platform and (race_id_on_platform != race.id_on_platform):
 				race.id_on_platform = race_id_on_platform
 				race_changed_fields.append('id_on_platform')
 
-			if len(race_dict.get('results', [])) == 0:
+			race_dict = dict(race_dict, results=self.RaceResults(race_num, race_dict))
+			if len(race_dict['results']) == 0:
 				if not race.has_no_results:
 					race.has_no_results = True
 					race_changed_fields.append('has_no_results')
@@ -664,152 +1113,8 @@ class Scraper:
 					models.log_obj_create(user, self.event, models.ACTION_RACE_UPDATE, child_object=race, field_list=race_changed_fields, verified_by=user)
 				print(f'{race_descr}: skipping as there are no results')
 				continue
-			for result_num, result_dict in enumerate(race_dict['results']):
-				bib = result_dict.get('bib_raw', '')[:models.MAX_BIB_LENGTH]
-				result_descr = f'BIB "{bib}", result {result_dict.get("result_raw")}'
-				id_on_platform = str(result_dict.get('id_on_platform', ''))
-				if id_on_platform:
-					result_descr += f', id_on_platform {id_on_platform}'
-				result = models.Result(
-					race=race,
-					loaded_by=user,
-					name_raw=result_dict.get('name_raw', ''),
-					lname_raw=result_dict.get('lname_raw', ''),
-					fname_raw=result_dict.get('fname_raw', ''),
-					gender_raw=(result_dict.get('gender_raw') or '')[:10],
-					bib_raw=bib,
-					bib    =bib,
-					age_raw=result_dict.get('age_raw'),
-					age    =result_dict.get('age_raw'),
-					country_raw =result_dict.get('country_raw', ''),
-					id_on_platform=id_on_platform,
-					runner_id_on_platform=result_dict.get('runner_id_on_platform'),
-					status_raw=results_util.string2status(result_dict.get('status_raw', ''), source=self.PLATFORM_ID),
-					city_raw=result_dict.get('city_raw', ''),
-					region_raw=result_dict.get('region_raw', ''),
-					result_raw=result_dict.get('result_raw', DEFAULT_RESULT),
-					place_raw=result_dict.get('place_raw'),
-					place_gender_raw=result_dict.get('place_gender_raw'),
-					place_category_raw=result_dict.get('place_category_raw'),
-					club_name=result_dict.get('club_raw', ''),
-					)
-				result.lname = result.lname_raw.title().strip()
-				result.fname = result.fname_raw.title().strip()
-				result.gender = results_util.string2gender(result.gender_raw)
-				result.status = result.status_raw
-				if self.PLATFORM_ID == 'athlinks':
-					# There the raw result is already a number of centiseconds
-					result.result = result.result_raw
-				else:
-					result.result = models.string2centiseconds(result.result_raw)
-				if result.lname == '' and result.fname == '':
-					if self.PLATFORM_ID in ('athlinks', 'mikatiming'):
-						pass
-					else:
-						raise JsonParsingError(f'{race_descr}, {result_descr}: no last or first name')
-				if result.gender == results_util.GENDER_UNKNOWN:
-					if (self.PLATFORM_ID == 'nyrr') and (result.fname_raw == 'Anonymous'):
-						pass
-					elif self.PLATFORM_ID in ('athlinks', 'mikatiming'):
-						pass
-					else:
-						raise JsonParsingError(f'{race_descr}, {result_descr}: unknown gender {result.gender_raw}')
-				if result.status == results_util.STATUS_UNKNOWN:
-					raise JsonParsingError(f'{race_descr}, {result_descr}: unknown status {result_dict.get("status_raw")}')
-
-				if result.status == results_util.STATUS_FINISHED and result.result <= 0:
-					if (self.PLATFORM_ID == 'athlinks') and (result.fname.lower() in ('unknown', 'unknown male', 'unknown female')):
-						# Present e.g. in https://www.athlinks.com/event/115192/results/Event/905578/Course/1773173/Results
-						continue
-					if (self.PLATFORM_ID == 'athlinks') and (result.result == 0):
-						# Common error like https://www.athlinks.com/event/115192/results/Event/905995/Course/1775375/Entry/419973081
-						result.status = results_util.STATUS_DNF
-					else:
-						raise JsonParsingError(f'{race_descr}, {result_descr}: '
-							+ f'Result is {result.result_raw} while status is "{result_dict.get("entryStatus")}"')
-
-				if result.country_raw:
-					maybe_country = models.Country_conversion.objects.filter(country_raw=result.country_raw).first()
-					if maybe_country:
-						result.country = maybe_country.country
-
-				if 'gun_time_raw' in result_dict:
-					result.gun_time_raw = result_dict['gun_time_raw']
-					if result.gun_time_raw:
-						if self.PLATFORM_ID == 'athlinks':
-							# There the raw result is already a number of centiseconds
-							result.gun_result = result.gun_time_raw
-						else:
-							result.gun_result = models.string2centiseconds(result.gun_time_raw)
-
-				category_raw = result_dict.get('category_raw')
-				if category_raw:
-					category = category_raw.strip()[:models.MAX_CATEGORY_LENGTH]
-					category_lower = category.lower()
-					if category_lower not in category_lower_to_orig:
-						# For unknown reason this Category_size sometimes already exists
-						category_sizes[category], created = models.Category_size.objects.get_or_create(race=race, name=category)
-						category_lower_to_orig[category_lower] = category
-					result.category_size = category_sizes[category_lower_to_orig[category_lower]]
-
-				runner_id_on_platform = result_dict.get('runner_id_on_platform')
-				if runner_id_on_platform:
-					runner_platform = models.Runner_platform.objects.filter(platform_id=self.PLATFORM_ID, value=runner_id_on_platform).first()
-					if runner_platform:
-						runner = runner_platform.runner
-					else:
-						runner = models.Runner.objects.create(
-							lname=result.lname,
-							fname=result.fname,
-							gender=result.gender,
-						)
-						models.log_obj_create(user, runner, models.ACTION_CREATE, comment=f'When loading results from {self.url}', verified_by=user)
-						models.Runner_platform.objects.create(
-							platform_id=self.PLATFORM_ID,
-							runner=runner,
-							value=runner_id_on_platform,
-						)
-						self.n_runners_created += 1
-					self.n_runners_connected += 1
-					result.runner = runner
-					result.user_id = runner.user_id
-					runners_touched.add(runner)
-
-				if self.platform_event_id == '23MINI':
-					print(f'{race_descr}{result.lname}, {result_descr}: Saving to DB "{result.lname}" "{result.fname}"')
-				result.save()
-				self.n_results_created += 1
-
-				splits_created = set() # Set of distances. They cannot repeat
-				for split_dict in result_dict.get('splits', []):
-					split_length = split_dict['distance']['length']
-					split_distance = cached_distances.get(split_length)
-					if not split_distance:
-						print(f'Looking for distance of length {split_length}')
-						split_distance, created = models.Distance.objects.get_or_create(distance_type=models.TYPE_METERS, length=split_length)
-						if created:
-							split_distance.name = split_distance.nameFromType()
-							split_distance.save()
-						cached_distances[split_length] = split_distance
-					if split_distance in splits_created:
-						if self.PLATFORM_ID == 'athlinks':
-							continue # Too many strange sets of splits, like https://www.athlinks.com/event/2164/results/Event/544721/Course/809433/Bib/36
-						raise JsonParsingError(f'{race_descr}, {result_descr}: split of length {split_length} is already present')
-					splits_created.add(split_distance)
-					models.Split.objects.create(
-						result=result,
-						distance=split_distance,
-						value=split_dict['value'],
-					)
-					self.n_splits_created += 1
-
-				# Now we try to recover killed with links to runners/users.
-				if (n_deleted_links > n_recovered_links) and parse_protocols.try_fix_lost_connection(result):
-					n_recovered_links += 1
-
-				if (result_num % 1000) == 999:
-					self.attempt.UpdateStatus(f'LoadResultsToDB: Loading {race_num+1} race out of {len(d["races"])}. '
-						+ f'Loaded {result_num+1} results out of {len(race_dict["results"])}')
+			load_race_results = self.LoadRaceResultsInBulk if self.load_in_bulk else self.LoadRaceResultsOneByOne
+			n_recovered_links = load_race_results(race, race_num, race_dict, race_descr, n_deleted_links, cached_distances, runners_touched)
 
 			race.load_status = models.RESULTS_LOADED
 			race.loaded_from = self.url
@@ -836,7 +1141,7 @@ class Scraper:
 			if n_deleted_links:
 				parse_protocols.log_success(None, f'Восстановлено {n_recovered_links} привязок результатов из {n_deleted_links}.')
 			if self.ToStopNow() and (race_num != len(d['races']) - 1):
-				raise util.TimeoutError(f'Time out. Loaded {race_num+1} out of {len(d["races"])} races to the DB.')
+				raise TimeoutError(f'Time out. Loaded {race_num+1} out of {len(d["races"])} races to the DB.')
 
 	def ProcessNewRunners(self): # By default we do nothing.
 		pass
@@ -862,8 +1167,9 @@ class Scraper:
 		# 	print(f'MatchAndCreateRaces: {race["precise_name"]} -> {race["db_race_id"]}')
 		self.DumpStandardForm()
 		self.ProcessNewRunners()
-		self.DumpStandardForm()
+		self.DumpStandardForm() # Only the races changed by ProcessNewRunners are written again.
+		self.DropResultsFromMemory()
 
-		# Step 3: load results to the database.
+		# Step 3: load results to the database, one race at a time.
 		self.LoadResultsToDB()
 		return f'loaded {self.n_results_created} results'
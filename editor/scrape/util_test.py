@@ -1,7 +1,12 @@
 import datetime
+import json
+import os
+import pathlib
+import tempfile
+import time
 from unittest import TestCase
 
-from editor.scrape import util
+from editor.scrape import http_cache, standard_form, util
 
 class UtilTestCase(TestCase):
 	def test_runner_shard(self):
@@ -27,3 +32,54 @@ class UtilTestCase(TestCase):
 		self.assertEqual(datetime.date(2004, 3, 1), util.MinBirthday(today=datetime.date(2020, 2, 29), age_today=15))
 		self.assertEqual(datetime.date(2003, 3, 1), util.MinBirthday(today=datetime.date(2020, 2, 29), age_today=16))
 		self.assertEqual(datetime.date(2004, 3, 2), util.MinBirthday(today=datetime.date(2020, 3, 1), age_today=15))
+
+	def test_http_cache(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			root = pathlib.Path(tmpdir)
+			paths = [root / f'{i}{http_cache.COMPRESSED_SUFFIX}' for i in range(3)]
+			for i, path in enumerate(paths):
+				http_cache.WriteEntry(path, {'fetched_at': time.time(), 'etag': f'"{i}"', 'content': {'x': 'я' * 1000}})
+				os.utime(path, (time.time() - 100 * (3 - i), ) * 2)
+			self.assertEqual({'x': 'я' * 1000}, http_cache.ReadEntry(paths[0])['content'])
+			self.assertEqual({'If-None-Match': '"1"'}, http_cache.ConditionalHeaders(http_cache.ReadEntry(paths[1])))
+			self.assertTrue(http_cache.IsFresh(http_cache.ReadEntry(paths[1]), None))
+			self.assertFalse(http_cache.IsFresh({'fetched_at': time.time() - 7200}, datetime.timedelta(hours=1)))
+			self.assertIsNone(http_cache.ReadEntry(root / 'absent.json.gz'))
+			# The oldest file is too old; then the least recently used one of the rest is deleted to fit the size.
+			self.assertEqual(2, http_cache.Evict(root, max_age=datetime.timedelta(seconds=250), max_total_bytes=os.path.getsize(paths[2]))[0])
+			self.assertEqual([False, False, True], [path.exists() for path in paths])
+
+	def test_MapConcurrently(self):
+		res = util.MapConcurrently(lambda x: 1 / x, [(x, ) for x in [1, 0, 2, 4]])
+		self.assertEqual([1, None, 0.5, 0.25], [value for value, _ in res])
+		self.assertEqual([False, True, False, False], [isinstance(exception, ZeroDivisionError) for _, exception in res])
+
+	def test_standard_form(self):
+		event = {'name': 'Марафон', 'races': [
+			{'distance': 42195, 'results': [{'name_raw': 'Иван', 'result': i} for i in range(3)]},
+			{'distance': 10000, 'results': []},
+			{'distance': 5000},
+		]}
+		with tempfile.TemporaryDirectory() as tmpdir:
+			event_dir = pathlib.Path(tmpdir)
+			with open(event_dir / standard_form.LEGACY_FILE, 'w', encoding='utf8') as json_out:
+				json.dump(event, json_out)
+			self.assertEqual(event, standard_form.Read(event_dir)[0])
+			self.assertTrue(standard_form.ConvertLegacy(event_dir))
+			self.assertFalse((event_dir / standard_form.LEGACY_FILE).exists())
+			read_event, checksums = standard_form.Read(event_dir)
+			self.assertEqual(event, read_event)
+			self.assertEqual({0, 1}, set(checksums))
+			# Unchanged races are not rewritten; results that were dropped from memory are kept on disk.
+			race_path = event_dir / standard_form.RaceFileName(1)
+			os.utime(race_path, (0, 0))
+			read_event['races'][0]['results'] = None
+			read_event['races'][1]['results'] = []
+			self.assertEqual(checksums, standard_form.Write(event_dir, read_event, checksums))
+			self.assertEqual(0, race_path.stat().st_mtime)
+			self.assertEqual(event['races'][0]['results'], list(standard_form.ReadRaceResults(event_dir, 0)))
+			del read_event['races'][1]
+			standard_form.Write(event_dir, read_event, checksums)
+			self.assertFalse(race_path.exists())
+			self.assertTrue(standard_form.Delete(event_dir))
+			self.assertEqual((None, {}), standard_form.Read(event_dir))
@@ -1,90 +1,137 @@
+from django.db import transaction
+from django.utils import timezone
+
 from results import models
 
 from collections import Counter
 import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Series where strikes make no sense.
+SERIES_WITHOUT_STRIKES = (
+	1664, # Wings For Life
+	2057, # Бегущие сердца
+	2273, # Стадионный марафон, Эстония
+	3545, # Забег.рф
+	3615, # Legal Run
+	3735, # Достигая цели
+	4006, # Witunia Weekend Maraton
+	4792, # Iver Swim, плавание во многих городах
+	5962, # первенство Приволжского федерального округа
+	7365, # Зеленый марафон
+	8328, # Легкоатлетический забег «На старт»
+)
+PARTICIPATION_STATUSES = (models.STATUS_FINISHED, models.STATUS_COMPLETED)
+RUNNERS_PER_QUERY = 1000
+BITMAPS_PER_QUERY = 1000
 
-# Returns the ordered list of dates of events in given series with given distance,
+# Returns the list of pairs (event_id, race_id) for events in given series with given distance ordered by date,
 # and checks that it happens not more than once a year.
-# It is OK to have several races of same distance on one event (e.g. semifinals and finals, or handicapped race).
-# But if there are two events with same start date, we raise an exception.
-def race_dates_and_check_annuality(series: models.Series, distance: models.Distance) -> Tuple[List[datetime.date], bool]:
+# It is OK to have several races of same distance on one event (e.g. semifinals and finals, or handicapped race);
+# then we return the race with the smallest id. But if there are two events with same start date, we raise an exception.
+def event_races_and_check_annuality(series: models.Series, distance: models.Distance) -> Tuple[List[Tuple[int, int]], bool]:
 	is_annual_event = True
 	events_by_date = {}
 	events_by_year = {}
-	for race in models.Race.objects.filter(event__series=series, distance=distance, event__cancelled=False, event__invisible=False).select_related('event'):
-		date = race.event.start_date
+	race_ids = {}
+	for race_id, event_id, date in models.Race.objects.filter(event__series=series, distance=distance, event__cancelled=False,
+			event__invisible=False).order_by('id').values_list('id', 'event_id', 'event__start_date'):
 		if date not in events_by_date:
-			events_by_date[date] = race.event
-		elif race.event != events_by_date[date]:
+			events_by_date[date] = event_id
+			race_ids[event_id] = race_id
+		elif event_id != events_by_date[date]:
 			raise Exception(f'В серии с id {series.id} есть сразу два забега, прошедшие {date}, с одной и той же дистанцией {distance}')
 		if date.year not in events_by_year:
-			events_by_year[date.year] = race.event
-		elif race.event != events_by_year[date.year]:
+			events_by_year[date.year] = event_id
+		elif event_id != events_by_year[date.year]:
 			is_annual_event = False
-	return sorted(events_by_date.keys()), is_annual_event
-
-class Runner_strike:
-	max_strike_length = 0
-	max_strike_start = None
-	max_strike_end = None
-	first = None
-	last = None
-	first_in_row = None
-	last_in_row = None
-	def __init__(self, n_events):
-		self.results: List[Any] = [None] * n_events
-	def calc_strikes(self):
-		cur_strike_length = 0
-		cur_strike_start = None
-		cur_strike_end = None
-		for i, result in enumerate(self.results):
-			if result is None:
-				cur_strike_length = 0
-				cur_strike_start = None
-				continue
-
-			if self.first is None:
-				self.first = result.race
-			self.last = result.race
-
-			cur_strike_length += 1
-			if cur_strike_start is None:
-				cur_strike_start = i
-			if cur_strike_length > self.max_strike_length:
-				self.max_strike_length = cur_strike_length
-				self.max_strike_start = cur_strike_start
-				self.max_strike_end = i
-		self.first_in_row = self.results[self.max_strike_start].race # pytype: disable=attribute-error
-		self.last_in_row = self.results[self.max_strike_end].race    # pytype: disable=attribute-error
-	def maybe_strike_obj(self, series, distance, runner, is_annual_event) -> Optional[models.Strike]: # To store in DB
-		participations = [result for result in self.results if result is not None]
-		if len(participations) < models.MIN_FINISHES_FOR_STRIKE:
-			return None
-		if len(participations) * 100 < len(self.results) * models.MIN_FINISHES_FOR_STRIKE_PERCENT:
-			return None
-		result_values = [result.result for result in participations if result.status == models.STATUS_FINISHED]
-		self.calc_strikes()
-
-		best_result = average_result = None
-		if result_values:
-			best_result = max(result_values) if (distance.distance_type in models.TYPES_MINUTES) else min(result_values)
-			average_result = sum(result_values) / len(result_values)
-
-		return models.Strike(
-				series=series,
-				distance=distance,
-				runner=runner,
-				total_participations=len(participations),
-				total_participations_in_row=self.max_strike_length,
-				is_annual_event=is_annual_event,
-				best_result=best_result,
-				average_result=average_result,
-				first=self.first,
-				last=self.last,
-				first_in_row=self.first_in_row,
-				last_in_row=self.last_in_row,
-			)
+	return [(events_by_date[date], race_ids[events_by_date[date]]) for date in sorted(events_by_date)], is_annual_event
+
+# Participations are stored as bitmaps: bit i is set if the runner finished the i-th event of the series on the distance.
+def bits_from_bytes(value) -> int:
+	return int.from_bytes(bytes(value), 'little')
+
+def bits_to_bytes(bits: int) -> bytes:
+	return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+def count_bits(bits: int) -> int:
+	return bin(bits).count('1')
+
+def lowest_bit(bits: int) -> int:
+	return (bits & -bits).bit_length() - 1
+
+# Returns the length of the longest run of set bits and the index of its first bit (the earliest of such runs).
+# After k steps, bit i of runs is set iff bits i, ..., i+k-1 of bits are set.
+def longest_run(bits: int) -> Tuple[int, Optional[int]]:
+	length = 0
+	runs = bits
+	last_runs = 0
+	while runs:
+		length += 1
+		last_runs = runs
+		runs &= runs >> 1
+	if length == 0:
+		return 0, None
+	return length, lowest_bit(last_runs)
+
+# Moves bit i to new_indices[i] and drops it if new_indices[i] is None.
+def remap_bits(bits: int, new_indices: List[Optional[int]]) -> int:
+	res = 0
+	while bits:
+		i = lowest_bit(bits)
+		bits &= bits - 1
+		if (i < len(new_indices)) and (new_indices[i] is not None):
+			res |= 1 << new_indices[i]
+	return res
+
+def participations(series: models.Series, distance: models.Distance):
+	return models.Result.objects.filter(race__event__series=series, race__distance=distance,
+		status__in=PARTICIPATION_STATUSES).exclude(runner=None)
+
+# Builds the bitmaps of runners from their results. rows are tuples (runner_id, event_id, status, result).
+# Results of cancelled or invisible events, that are not in event_index, are skipped.
+def make_bitmaps(series: models.Series, distance: models.Distance, rows: Iterable[Tuple[int, int, int, int]],
+		event_index: Dict[int, int]) -> Dict[int, models.Strike_bitmap]:
+	bitmaps = {}
+	is_minutes = distance.distance_type in models.TYPES_MINUTES
+	for runner_id, event_id, status, result in rows:
+		if event_id not in event_index:
+			continue
+		if runner_id not in bitmaps:
+			bitmaps[runner_id] = models.Strike_bitmap(series=series, distance=distance, runner_id=runner_id, n_finished=0, sum_result=0)
+			bitmaps[runner_id].bits = 0
+		bitmap = bitmaps[runner_id]
+		bitmap.bits |= 1 << event_index[event_id]
+		if status == models.STATUS_FINISHED:
+			bitmap.n_finished += 1
+			bitmap.sum_result += result
+			if (bitmap.best_result is None) or ((result > bitmap.best_result) if is_minutes else (result < bitmap.best_result)):
+				bitmap.best_result = result
+	for bitmap in bitmaps.values():
+		bitmap.events = bits_to_bytes(bitmap.bits)
+	return bitmaps
+
+def maybe_strike_obj(bitmap: models.Strike_bitmap, race_ids: List[int], is_annual_event: bool) -> Optional[models.Strike]: # To store in DB
+	n_participations = count_bits(bitmap.bits)
+	if n_participations < models.MIN_FINISHES_FOR_STRIKE:
+		return None
+	if n_participations * 100 < len(race_ids) * models.MIN_FINISHES_FOR_STRIKE_PERCENT:
+		return None
+	max_strike_length, max_strike_start = longest_run(bitmap.bits)
+	return models.Strike(
+			series_id=bitmap.series_id,
+			distance_id=bitmap.distance_id,
+			runner_id=bitmap.runner_id,
+			total_participations=n_participations,
+			total_participations_in_row=max_strike_length,
+			is_annual_event=is_annual_event,
+			best_result=bitmap.best_result,
+			average_result=(bitmap.sum_result / bitmap.n_finished) if bitmap.n_finished else None,
+			first_id=race_ids[lowest_bit(bitmap.bits)],
+			last_id=race_ids[bitmap.bits.bit_length() - 1],
+			first_in_row_id=race_ids[max_strike_start],
+			last_in_row_id=race_ids[max_strike_start + max_strike_length - 1],
+		)
 
 # We want to save just MAX_STRIKES_FOR_SERIES strikes with largest total_participations, and also all strikes with the same value.
 def filter_largest_strikes(strike_objs: List[models.Strike]) -> List[models.Strike]:
@@ -94,64 +141,121 @@ def filter_largest_strikes(strike_objs: List[models.Strike]) -> List[models.Stri
 	min_participations = strikes_sorted[models.MAX_STRIKES_FOR_SERIES - 1].total_participations
 	return [strike_obj for strike_obj in strike_objs if strike_obj.total_participations >= min_participations]
 
-# Returns the number of created strikes
-def calc_strikes_for_distance(series: models.Series, distance: models.Distance, to_delete_old: bool=True) -> int:
-	if to_delete_old:
-		series.strike_set.filter(distance=distance).delete()
-		series.series_distance_data_set.filter(distance=distance).delete()
-	if series.id in (
-			1664, # Wings For Life
-			2057, # Бегущие сердца
-			2273, # Стадионный марафон, Эстония
-			3545, # Забег.рф
-			3615, # Legal Run
-			3735, # Достигая цели
-			4006, # Witunia Weekend Maraton
-			4792, # Iver Swim, плавание во многих городах
-			5962, # первенство Приволжского федерального округа
-			7365, # Зеленый марафон
-			8328, # Легкоатлетический забег «На старт»
-			):
-		return 0
-	event_dates, is_annual_event = race_dates_and_check_annuality(series, distance)
-	if len(event_dates) < models.MIN_FINISHES_FOR_STRIKE:
-		return 0
-	event_dates_inv = {event_dates[i]: i for i in range(len(event_dates))}
-
-	# Fill runner_strikes
-	runner_strikes = {}
-	events_with_results = set() # To determine first, last, count of events with at least one result.
-	for result in models.Result.objects.filter(race__event__series=series, race__distance=distance, status__in=(models.STATUS_FINISHED, models.STATUS_COMPLETED)).exclude(
-			runner=None).exclude(race__event__cancelled=True).exclude(race__event__invisible=True).select_related('runner', 'race__event').order_by('race__event__start_date'):
-		events_with_results.add(result.race.event)
-		if result.runner not in runner_strikes:
-			runner_strikes[result.runner] = Runner_strike(len(event_dates))
-		if result.race.event.start_date not in event_dates_inv:
-			print('Here is the bug', result.id, result.race.id, result.race.event.start_date, event_dates_inv)
-		runner_strikes[result.runner].results[event_dates_inv[result.race.event.start_date]] = result
+# Replaces the strikes of (series, distance) with the ones calculated from the bitmaps of all its runners.
+# Returns the number of created strikes.
+def save_strikes(series: models.Series, distance: models.Distance, bitmaps: Iterable[models.Strike_bitmap],
+		events: List[Tuple[int, int]], is_annual_event: bool) -> int:
+	race_ids = [race_id for _, race_id in events]
 	strike_objs = []
-	for runner, runner_strike in runner_strikes.items():
-		maybe_strike = runner_strike.maybe_strike_obj(series, distance, runner, is_annual_event)
+	events_with_results = 0 # To determine first, last, count of events with at least one result.
+	for bitmap in bitmaps:
+		events_with_results |= bitmap.bits
+		maybe_strike = maybe_strike_obj(bitmap, race_ids, is_annual_event)
 		if maybe_strike:
 			strike_objs.append(maybe_strike)
-
 	largest_strikes = filter_largest_strikes(strike_objs)
-	for strike_obj in largest_strikes:
-		strike_obj.save()
-	if largest_strikes:
-		events_with_results_sorted = sorted(events_with_results, key=lambda event:event.start_date)
-		models.Series_distance_data.objects.create(
-			series=series,
-			distance=distance,
-			n_events=len(events_with_results_sorted),
-			first=events_with_results_sorted[0],
-			last=events_with_results_sorted[-1],
-		)
+	with transaction.atomic():
+		series.strike_set.filter(distance=distance).delete()
+		series.series_distance_data_set.filter(distance=distance).delete()
+		models.Strike.objects.bulk_create(largest_strikes)
+		if largest_strikes:
+			models.Series_distance_data.objects.create(
+				series=series,
+				distance=distance,
+				n_events=count_bits(events_with_results),
+				first_id=events[lowest_bit(events_with_results)][0],
+				last_id=events[events_with_results.bit_length() - 1][0],
+			)
 	return len(largest_strikes)
 
+def delete_strike_data(series: models.Series, distance: Optional[models.Distance]=None):
+	for queryset in (series.strike_set, series.series_distance_data_set, series.strike_bitmap_set, series.strike_state_set):
+		if distance:
+			queryset.filter(distance=distance).delete()
+		else:
+			queryset.all().delete()
+
+# Rebuilds the bitmaps and the strikes of (series, distance) from all its results. Returns the number of created strikes.
+def calc_strikes_for_distance(series: models.Series, distance: models.Distance, to_delete_old: bool=True) -> int:
+	started_at = timezone.now()
+	if to_delete_old:
+		delete_strike_data(series, distance)
+	if series.id in SERIES_WITHOUT_STRIKES:
+		return 0
+	events, is_annual_event = event_races_and_check_annuality(series, distance)
+	if len(events) < models.MIN_FINISHES_FOR_STRIKE:
+		return 0
+	event_index = {event_id: i for i, (event_id, _) in enumerate(events)}
+	bitmaps = make_bitmaps(series, distance,
+		participations(series, distance).values_list('runner_id', 'race__event_id', 'status', 'result').iterator(), event_index)
+	with transaction.atomic():
+		models.Strike_bitmap.objects.bulk_create(bitmaps.values(), batch_size=BITMAPS_PER_QUERY)
+		state = models.Strike_state(series=series, distance=distance, watermark=started_at)
+		state.set_event_ids([event_id for event_id, _ in events])
+		state.save()
+	return save_strikes(series, distance, bitmaps.values(), events, is_annual_event)
+
+# Returns the ids of events that were added or removed since the last update, or whose results could change since then.
+def get_changed_event_ids(distance: models.Distance, event_ids: List[int], old_event_ids: List[int], since: datetime.datetime) -> Set[int]:
+	res = set(event_ids).symmetric_difference(old_event_ids)
+	# Loading, claiming and attaching results are logged for their events.
+	res.update(models.Table_update.objects.filter(model_name='Event', row_id__in=event_ids, added_time__gte=since).values_list(
+		'row_id', flat=True))
+	res.update(models.Result.objects.filter(race__event_id__in=event_ids, race__distance=distance, last_update__gte=since).values_list(
+		'race__event_id', flat=True))
+	return res
+
+# Updates the strikes of (series, distance) using the bitmaps saved by the previous run: we load only the results of events
+# changed since then, and recalculate the bitmaps only of runners who have or had results there.
+# The bitmaps of other runners are just shifted if the list of events has changed. Returns the number of created strikes.
+def update_strikes_for_distance(series: models.Series, distance: models.Distance) -> int:
+	started_at = timezone.now()
+	state = models.Strike_state.objects.filter(series=series, distance=distance).first()
+	if (state is None) or (series.id in SERIES_WITHOUT_STRIKES):
+		return calc_strikes_for_distance(series, distance)
+	events, is_annual_event = event_races_and_check_annuality(series, distance)
+	if len(events) < models.MIN_FINISHES_FOR_STRIKE:
+		return calc_strikes_for_distance(series, distance)
+	event_ids = [event_id for event_id, _ in events]
+	event_index = {event_id: i for i, event_id in enumerate(event_ids)}
+	old_event_ids = state.get_event_ids()
+	changed_event_ids = get_changed_event_ids(distance, event_ids, old_event_ids, state.watermark)
+	old_changed_mask = sum(1 << i for i, event_id in enumerate(old_event_ids) if event_id in changed_event_ids)
+	new_indices = [event_index.get(event_id) for event_id in old_event_ids] if (event_ids != old_event_ids) else None
+
+	touched_runner_ids = set(participations(series, distance).filter(race__event_id__in=changed_event_ids.intersection(event_ids)).values_list(
+		'runner_id', flat=True))
+	bitmaps = {}
+	bitmaps_to_shift = []
+	for bitmap in models.Strike_bitmap.objects.filter(series=series, distance=distance).iterator():
+		bitmap.bits = bits_from_bytes(bitmap.events)
+		if bitmap.bits & old_changed_mask:
+			touched_runner_ids.add(bitmap.runner_id)
+		elif new_indices is not None:
+			bitmap.bits = remap_bits(bitmap.bits, new_indices)
+			bitmap.events = bits_to_bytes(bitmap.bits)
+			bitmaps_to_shift.append(bitmap)
+		bitmaps[bitmap.runner_id] = bitmap
+
+	touched_runner_ids = sorted(touched_runner_ids)
+	new_bitmaps = {}
+	for i in range(0, len(touched_runner_ids), RUNNERS_PER_QUERY):
+		new_bitmaps.update(make_bitmaps(series, distance, participations(series, distance).filter(
+			runner_id__in=touched_runner_ids[i:i + RUNNERS_PER_QUERY]).values_list('runner_id', 'race__event_id', 'status', 'result'), event_index))
+	old_bitmap_ids = [bitmaps.pop(runner_id).id for runner_id in touched_runner_ids if runner_id in bitmaps]
+	with transaction.atomic():
+		for i in range(0, len(old_bitmap_ids), BITMAPS_PER_QUERY):
+			models.Strike_bitmap.objects.filter(pk__in=old_bitmap_ids[i:i + BITMAPS_PER_QUERY]).delete()
+		models.Strike_bitmap.objects.bulk_create(new_bitmaps.values(), batch_size=BITMAPS_PER_QUERY)
+		models.Strike_bitmap.objects.bulk_update(bitmaps_to_shift, ['events'], batch_size=BITMAPS_PER_QUERY)
+		state.set_event_ids(event_ids)
+		state.watermark = started_at
+		state.save()
+	bitmaps.update(new_bitmaps)
+	return save_strikes(series, distance, bitmaps.values(), events, is_annual_event)
+
 def calc_strikes(series: models.Series) -> Dict[models.Distance, int]:
-	series.strike_set.all().delete()
-	series.series_distance_data_set.all().delete()
+	delete_strike_data(series)
 	res = {}
 	distance_ids = Counter(models.Race.objects.filter(event__series=series).exclude(load_status=models.RESULTS_NOT_LOADED).values_list('distance_id', flat=True))
 	for distance_id, count in distance_ids.items():
@@ -163,7 +267,7 @@ def calc_strikes(series: models.Series) -> Dict[models.Distance, int]:
 def calc_strikes_from_queue() -> str:
 	n_pairs = n_strikes_found = 0
 	for strike_queue in list(models.Strike_queue.objects.select_related('series', 'distance')):
-		n_strikes_found += calc_strikes_for_distance(strike_queue.series, strike_queue.distance)
+		n_strikes_found += update_strikes_for_distance(strike_queue.series, strike_queue.distance)
 		n_pairs += 1
 		strike_queue.delete()
 	return f'обработано пар (серия, дистанция): {n_pairs}, найдено страйков: {n_strikes_found}'
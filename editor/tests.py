@@ -1,10 +1,18 @@
+from collections import defaultdict
+import datetime
 import decimal
+import operator
+import pandas as pd
+import types
+from django.db.models import Q
 from unittest import TestCase
 from typing import Optional
 
-from results import models, results_util
-from editor import parse_strings, runner_stat
-from editor.views import views_common, views_klb_stat, views_protocol
+from dbchecks import incremental as dbchecks_incremental
+from results import forms, models, page_cache, results_util
+from results.views import views_common as results_views_common, views_race as results_views_race
+from editor import parse_strings, rating_tables, regions_visited, runner_stat, series_strike
+from editor.views import views_age_group_record, views_common, views_klb_stat, views_protocol, views_result, views_stat
 
 # After adding a new test, also add it to commands/run_tests.py!
 
@@ -158,6 +166,169 @@ class KLBScoreTest(TestCase):
 
 		self.assertEqual(decimal.Decimal('0.105'), views_klb_stat.length2bonus(20900, 2022))
 
+class KLBMatchTest(TestCase):
+	def test_calc_participant_score(self):
+		participant = models.Klb_participant(year=2022)
+		scores = [('1.5', '0.3'), ('4', '0.1'), ('2', '0.2'), ('3', '0.4'), ('2.5', '19.9')]
+		klb_results = [models.Klb_result(id=i, klb_score=decimal.Decimal(klb_score), bonus_score=decimal.Decimal(bonus_score))
+			for i, (klb_score, bonus_score) in enumerate(scores)]
+		views_klb_stat.calc_participant_score(participant, klb_results, is_active_year=True)
+		self.assertEqual([False, True, True, True, True], [klb_result.is_in_best for klb_result in klb_results])
+		self.assertTrue(all(klb_result.is_in_best_bonus for klb_result in klb_results))
+		self.assertEqual(20, participant.bonus_sum) # The bonus is capped
+		self.assertEqual(decimal.Decimal('31.5'), participant.score_sum)
+		self.assertEqual(5, participant.n_starts)
+
+	def test_calc_team_places(self):
+		club = models.Club(name='Клуб')
+		teams = [
+			models.Klb_team(id=1, year=2022, club=club, number=1, name='Клуб', score=decimal.Decimal(10)),
+			models.Klb_team(id=2, year=2022, club=club, number=2, name='Клуб-2', score=decimal.Decimal(20)),
+			models.Klb_team(id=3, year=2022, club=club, number=models.INDIVIDUAL_RUNNERS_CLUB_NUMBER, name='Индивидуалы', score=decimal.Decimal(30)),
+		]
+		views_klb_stat.calc_team_places(2022, teams, {1: 1000, 2: 3})
+		self.assertEqual([2, 1, None], [team.place for team in teams])
+		self.assertEqual([None, 1, None], [team.place_small_teams for team in teams])
+		self.assertEqual([None, 1, None], [team.place_secondary_teams for team in teams])
+
+class KeysetPaginationTest(TestCase):
+	def test_keyset_condition(self):
+		self.assertEqual(
+			Q(n_starts__lt=5) | Q(n_starts=5, lname__gt='Иванов') | Q(n_starts=5, lname='Иванов', pk__gt=10),
+			results_views_common.get_keyset_condition(['-n_starts', 'lname', 'pk'], (5, 'Иванов', 10)),
+		)
+		self.assertIsNone(results_views_common.get_keyset_condition(['place', 'pk'], (None, 10)))
+
+	# MySQL puts NULLs last in descending order, so they go after any non-NULL value.
+	def test_keyset_condition_nullable_desc(self):
+		self.assertEqual(
+			(Q(n_starts__lt=5) | Q(n_starts__isnull=True)) | Q(n_starts=5, pk__gt=10),
+			results_views_common.get_keyset_condition(['-n_starts', 'pk'], (5, 10), {'n_starts'}),
+		)
+		self.assertEqual({'n_starts', 'city__name'}, results_views_common.get_nullable_ordering_fields(models.Runner, ['-n_starts', 'city__name', 'lname', 'pk']))
+
+# Supports just the lookups that RatingTableItems uses, so that we don't need rows in the DB.
+class FakeQuerySet:
+	LOOKUPS = {'gt': operator.gt, 'lte': operator.le, 'in': lambda value, values: value in values}
+	def __init__(self, objs):
+		self.objs = objs
+	def filter(self, **kwargs):
+		objs = self.objs
+		for key, value in kwargs.items():
+			field, lookup = key.split('__')
+			objs = [obj for obj in objs if self.LOOKUPS[lookup](getattr(obj, 'id' if (field == 'pk') else field), value)]
+		return FakeQuerySet(objs)
+	def order_by(self, field):
+		return FakeQuerySet(sorted(self.objs, key=lambda obj: getattr(obj, field)))
+	def values_list(self, field, flat):
+		return [getattr(obj, field) for obj in self.objs]
+	def __iter__(self):
+		return iter(self.objs)
+
+class RatingTableTest(TestCase):
+	def test_items(self):
+		table = types.SimpleNamespace(n_entries=4, rating_position_set=FakeQuerySet(
+			[types.SimpleNamespace(position=position, object_id=object_id) for position, object_id in [(1, 30), (2, 10), (3, 40), (4, 20)]]))
+		# The object with id 40 doesn't fit the rating anymore.
+		items = results_views_race.RatingTableItems(table, FakeQuerySet([types.SimpleNamespace(id=obj_id) for obj_id in (10, 20, 30)]))
+		self.assertEqual(4, items.count())
+		self.assertEqual(4, len(items))
+		self.assertEqual([30, 10], [obj.id for obj in items[0:2]])
+		self.assertEqual([20], [obj.id for obj in items[2:]])
+		self.assertEqual(10, items[1].id)
+
+	def test_table_keys(self):
+		keys = rating_tables.get_table_keys()
+		self.assertEqual(len(keys), len(set(keys)))
+		self.assertIn(('', results_util.DIST_MARATHON_ID, 0, forms.RATING_BEST_MALE), keys)
+		self.assertNotIn(('', results_util.DISTANCE_ANY, 0, forms.RATING_BEST_MALE), keys)
+
+class PageCacheTest(TestCase):
+	def test_lru(self):
+		local = page_cache.LocalLRUCache(max_entries=2)
+		local.set('a', 1)
+		local.set('b', 2)
+		self.assertEqual(1, local.get('a'))
+		local.set('c', 3) # 'b' is the least recently used one now
+		self.assertIsNone(local.get('b'))
+		self.assertEqual(1, local.get('a'))
+		self.assertEqual(3, local.get('c'))
+
+	def test_versions(self):
+		tiered_cache = page_cache.make_local_stand_in()
+		keys = [(page_cache.OBJECT_RACE, 1), (page_cache.OBJECT_RUNNER, 2)]
+		versions = tiered_cache.get_versions(keys)
+		self.assertEqual(versions, tiered_cache.get_versions(keys))
+		tiered_cache.bump_versions([(page_cache.OBJECT_RACE, 1)])
+		new_versions = tiered_cache.get_versions(keys)
+		self.assertNotEqual(versions[0], new_versions[0])
+		self.assertEqual(versions[1], new_versions[1])
+		# A lost version doesn't return to any of the old values.
+		tiered_cache.shared.delete(page_cache.version_key((page_cache.OBJECT_RACE, 1)))
+		self.assertNotIn(tiered_cache.get_versions(keys)[0], (versions[0], new_versions[0]))
+
+	def test_public_page_keys(self):
+		self.assertEqual([(page_cache.OBJECT_RUNNER, 5)], models.get_public_page_keys(models.Runner(id=5)))
+		self.assertEqual([], models.get_public_page_keys(models.Runner(id=5), created=True)) # No page of a new runner is cached yet
+		self.assertEqual([(page_cache.OBJECT_RACE, 1), (page_cache.OBJECT_RUNNER, 2)],
+			models.get_public_page_keys(models.Result(race_id=1, runner_id=2), created=True))
+
+	def test_stats(self):
+		tiered_cache = page_cache.make_local_stand_in()
+		tiered_cache.count_stat('race', 'hit')
+		self.assertEqual({'hit': 0, 'miss': 0}, tiered_cache.get_stats('race')) # Not flushed yet
+		tiered_cache._last_stats_flush -= page_cache.STATS_FLUSH_INTERVAL
+		tiered_cache.count_stat('race', 'hit')
+		self.assertEqual({'hit': 2, 'miss': 0}, tiered_cache.get_stats('race'))
+
+	def test_csrf_token(self):
+		content = b'<form><input type="hidden" name="csrfmiddlewaretoken" value="abc123"></form>'
+		self.assertEqual(b'<form><input type="hidden" name="csrfmiddlewaretoken" value="%%csrf_token%%"></form>',
+			page_cache.CSRF_TOKEN_RE.sub(rb'\1' + page_cache.CSRF_TOKEN_PLACEHOLDER + rb'\2', content))
+
+class IncrementalDbChecksTest(TestCase):
+	def test_related_paths(self):
+		self.assertEqual([('klb_person__', models.Klb_person), ('klb_person__runner__', models.Runner)],
+			dbchecks_incremental.get_related_paths(models.Klb_result, 'klb_person__runner__id'))
+		self.assertEqual([], dbchecks_incremental.get_related_paths(models.Klb_result, 'event_raw_id'))
+
+class AuditLogBufferTest(TestCase):
+	def test_nesting(self):
+		self.assertIsNone(models.Audit_log_buffer.current())
+		with models.Audit_log_buffer() as outer:
+			with models.Audit_log_buffer() as inner:
+				self.assertIs(outer, inner)
+				inner.add(models.Table_update(model_name='Runner', row_id=1), [], (1, 2), [])
+				inner.add(models.Table_update(model_name='Runner', row_id=2), [], (1, 2), [])
+			self.assertEqual(2, len(outer.table_updates)) # The inner buffer doesn't flush
+			self.assertEqual({(1, 2)}, outer.strike_queue_keys)
+			outer.table_updates = []
+			outer.strike_queue_keys = set()
+		self.assertIsNone(models.Audit_log_buffer.current())
+
+	# Otherwise flush() would write the records to the DB.
+	def test_no_flush_on_exception(self):
+		with self.assertRaises(ValueError):
+			with models.Audit_log_buffer() as buffer:
+				buffer.add(models.Table_update(model_name='Runner', row_id=1), [], (1, 2), [])
+				raise ValueError()
+		self.assertIsNone(models.Audit_log_buffer.current())
+		self.assertEqual(1, len(buffer.table_updates))
+
+class StrikeBitmapTest(TestCase):
+	def test_longest_run(self):
+		self.assertEqual((0, None), series_strike.longest_run(0))
+		self.assertEqual((3, 0), series_strike.longest_run(0b1101100111))
+		self.assertEqual((2, 1), series_strike.longest_run(0b110110)) # The earliest of the longest runs
+	def test_remap(self):
+		self.assertEqual(0b11, series_strike.remap_bits(0b1011, [1, None, 3, 0]))
+		self.assertEqual(2**70 + 5, series_strike.bits_from_bytes(series_strike.bits_to_bytes(2**70 + 5)))
+
+class RegionsVisitedTest(TestCase):
+	def test_counts(self):
+		self.assertEqual([3, 0, 1], regions_visited.counts_from_bytes(regions_visited.counts_to_bytes([3, 0, 1, 0, 0])))
+		self.assertEqual([regions_visited.MAX_COUNT], regions_visited.counts_from_bytes(regions_visited.counts_to_bytes([10**6])))
+
 class TrackerURLTest(TestCase):
 	def test_1(self):
 		self.assertEqual((7827045671, 1, False), results_util.maybe_strava_activity_number('https://www.strava.com/activities/7827045671'))
@@ -173,3 +344,82 @@ class EddingtonTest(TestCase):
 		self.assertEqual( (41, 1), runner_stat.eddington([42195] * 41 + [41999]))
 		self.assertEqual( (41, 1), runner_stat.eddington([42195] * 41 + [41999] * 1000))
 		self.assertEqual( (42, 43), runner_stat.eddington([42195] * 1000))
+
+	# The vectorized version must give the same numbers as eddington() for each runner.
+	def test_by_runner(self):
+		lengths_by_runner = {
+			1: [1000 * x for x in [1,2,3,4,5]],
+			2: [1,2,3,4,5],
+			3: [1,2,1001,4,5],
+			4: [42195] * 41 + [41999],
+			5: [42195] * 41 + [41999] * 1000,
+			6: [42195] * 1000,
+		}
+		df = pd.DataFrame([(runner_id, length) for runner_id, lengths in lengths_by_runner.items() for length in lengths],
+			columns=['runner_id', 'length'])
+		res = runner_stat.eddington_by_runner(df)
+		for runner_id, lengths in lengths_by_runner.items():
+			self.assertEqual(runner_stat.eddington(lengths),
+				(res.at[runner_id, 'eddington'], res.at[runner_id, 'eddington_for_next_level']))
+
+class PlacesTest(TestCase):
+	def test_1(self):
+		M, F, U = results_util.GENDER_MALE, results_util.GENDER_FEMALE, results_util.GENDER_UNKNOWN
+		self.assertEqual([], views_result.calc_places([]))
+		self.assertEqual(
+			[(1, 1, 1), (2, 1, None), (2, 2, 2), (4, None, 3), (5, 3, None)],
+			views_result.calc_places([(100, None, M, 'm40'), (200, None, F, None), (200, None, M, 'm40'), (300, None, U, 'm40'), (400, None, M, None)]),
+		)
+		# Equal results with different place_raw get different overall places but the same gender and category places.
+		self.assertEqual(
+			[(1, 1, 1), (2, 1, 1), (3, 3, 3)],
+			views_result.calc_places([(100, 1, M, 'm40'), (100, 2, M, 'm40'), (200, 3, M, 'm40')]),
+		)
+
+class NameBirthdayIndexTest(TestCase):
+	def test_find_runner_ids(self):
+		birthday = datetime.date(1980, 1, 2)
+		index = {views_stat.name_birthday_key('Иванов', 'Иван', birthday): [(1, ''), (2, 'петрович'), (3, 'сергеевич'), (2, '')]}
+		find = views_stat.find_runner_ids_by_name_and_birthday
+		self.assertEqual({1, 2, 3}, find(index, 'ИВАНОВ', 'иван', '', birthday))
+		self.assertEqual({1, 2}, find(index, 'Иванов', 'Иван', 'Петрович', birthday))
+		self.assertEqual({1, 2}, find(index, 'Иванов', 'Иван', 'Иванович', birthday))
+		self.assertEqual(set(), find(index, 'Иванов', 'Иван', '', datetime.date(1980, 1, 3)))
+
+	# Like the DB collation, we ignore accents, so such runners are ambiguous; but 'й' differs from 'и'.
+	def test_accents(self):
+		birthday = datetime.date(1980, 1, 2)
+		index = defaultdict(list)
+		index[views_stat.name_birthday_key('García', 'José', birthday)].append((1, ''))
+		index[views_stat.name_birthday_key('Garcia', 'Jose', birthday)].append((2, ''))
+		self.assertEqual({1, 2}, views_stat.find_runner_ids_by_name_and_birthday(index, 'GARCIA', 'José', '', birthday))
+		self.assertEqual('елкин', models.fold_name_for_comparison('Ёлкин'))
+		self.assertNotEqual(models.fold_name_for_comparison('Бойко'), models.fold_name_for_comparison('Боико'))
+
+class RunnerSearchNameTest(TestCase):
+	def test_search_name_rows(self):
+		self.assertEqual(
+			{('елкин', 'петр', ''), ('петр', 'елкин', ''), ('elkin', 'petr', ''), ('petr', 'elkin', '')},
+			models.search_name_rows([('Ёлкин', 'Пётр', '')]),
+		)
+		self.assertEqual({('smith', 'john', 'a'), ('john', 'smith', 'a')}, models.search_name_rows([('Smith', 'John', 'A')]))
+		self.assertEqual({('john', '', '')}, models.search_name_rows([('', 'John', '')]))
+
+class AgeGroupRecordTest(TestCase):
+	def test_fits_age_group(self):
+		fits = views_age_group_record.fits_age_group
+		senior = models.Record_age_group(age_group_type=models.RECORD_AGE_GROUP_TYPE_SENIOR, age_min=40)
+		young = models.Record_age_group(age_group_type=models.RECORD_AGE_GROUP_TYPE_YOUNG, age_min=20)
+		absolute = models.Record_age_group(age_group_type=models.RECORD_AGE_GROUP_TYPE_ABSOLUTE)
+		self.assertTrue(fits(absolute, 2020, None, None, None, None))
+		self.assertFalse(fits(senior, 2020, None, None, None, None))
+		self.assertFalse(fits(young, 2020, None, None, 1, None))
+		self.assertTrue(fits(senior, 2020, 45, None, None, None))
+		self.assertFalse(fits(senior, 2020, 46, None, None, None))
+		self.assertTrue(fits(senior, 2020, None, datetime.date(1978, 5, 5), None, None))
+		# The runner's birthday is more important than the one from the protocol.
+		self.assertTrue(fits(senior, 2020, None, datetime.date(1990, 5, 5), 1, datetime.date(1978, 5, 5)))
+		self.assertFalse(fits(senior, 2020, None, datetime.date(1978, 5, 5), 1, datetime.date(1990, 5, 5)))
+		self.assertTrue(fits(young, 2020, 20, None, None, None))
+		self.assertFalse(fits(young, 2020, None, datetime.date(2000, 5, 5), None, None))
+		self.assertTrue(fits(young, 2020, None, datetime.date(2001, 5, 5), 1, None))
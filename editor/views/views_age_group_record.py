@@ -1,12 +1,14 @@
-from django.db.models import Q, F, ExpressionWrapper, IntegerField
+from django.db.models import Q, F, ExpressionWrapper, IntegerField, Max
 from django.shortcuts import get_object_or_404, render, redirect
 from django.db.models.functions import ExtractYear
 from django.forms import modelformset_factory
 from django.contrib import messages
-from collections import OrderedDict
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass, field
 from django.http import Http404
 from django.urls import reverse
 import datetime
+import heapq
 
 from results import models, results_util
 from results.views import views_age_group_record
@@ -18,6 +20,10 @@ from editor.views.views_user_actions import log_form_change
 from typing import Dict, List, Optional, Set, Tuple
 
 N_EXTRA_RECORDS = 3
+# How many best appropriate results we check at most when looking for possible records.
+N_RESULTS_TO_CHECK = 100
+# find_candidates_for_all_groups reads the results with ids in ranges of this length, one range per query
+RESULT_IDS_PER_QUERY = 200000
 EARLIEST_RECORD_DATE = datetime.date(1991, 1, 1)
 
 EVENT_IDS_NOT_FOR_RECORDS = {
@@ -250,17 +256,15 @@ def record_mark_good(request, bad_record_id):
 		return redirect(request.POST['next_url'])
 	return redirect('results:age_group_records')
 
-def get_appropriate_results(country, gender, age_group, distance, surface_type):
-	other_gender = 3 - gender
+# Results of the country on the distance and surface type that fit for records, for all genders and age groups.
+def get_appropriate_results_for_all_groups(country, distance, surface_type):
 	results = models.Result.objects.filter(
 			Q(race__distance_real=None) | Q(race__distance_real__length__gte=distance.length),
 			Q(runner=None) | Q(runner__city=None) | Q(runner__city__region__country=country),
 			race__distance=distance,
 			status=models.STATUS_FINISHED,
 			race__is_for_handicapped=False,
-		).exclude(runner__gender=other_gender).exclude(gender=other_gender).annotate(
-		res_diff=ExpressionWrapper(ExtractYear(F('race__event__start_date'))-ExtractYear(F('birthday')), output_field=IntegerField())).annotate(
-		runner_diff=ExpressionWrapper(ExtractYear(F('race__event__start_date'))-ExtractYear(F('runner__birthday')), output_field=IntegerField()))
+		)
 	if country.id != 'RU': # For other countries, either runner or event must belong to the country
 		results = results.filter(
 			Q(runner__city__region__country=country)
@@ -268,19 +272,6 @@ def get_appropriate_results(country, gender, age_group, distance, surface_type):
 			| Q(race__event__series__city__region__country=country)
 		)
 
-	if age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_SENIOR:
-		age_min = age_group.age_min
-		age_max = age_min + models.AGE_GROUP_RECORDS_AGE_GAP
-		results = results.exclude(
-			Q(age__lt=age_min) | Q(age__gt=age_max)).exclude(
-			Q(res_diff__lt=age_min) | Q(res_diff__gt=age_max), birthday__isnull=False, runner__birthday=None).exclude(
-			Q(runner_diff__lt=age_min) | Q(runner_diff__gt=age_max), runner__isnull=False, runner__birthday__isnull=False).exclude(
-			Q(runner=None) | Q(runner__birthday=None), age=None, birthday=None)
-	elif age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_YOUNG:
-		results = results.exclude(age__gt=age_group.age_min).exclude(birthday__isnull=False, res_diff__gte=age_group.age_min).exclude(
-			runner__isnull=False, runner__birthday__isnull=False, runner_diff__gte=age_group.age_min).exclude(
-			Q(runner=None) | Q(runner__birthday=None), age=None, birthday=None)
-
 	other_countries_codes = set(models.Country_conversion.objects.exclude(country=None).exclude(country=country).values_list('country_raw', flat=True))
 	results = results.exclude(Q(runner=None) | Q(runner__city=None), country_name__in=other_countries_codes)
 
@@ -306,6 +297,122 @@ def get_appropriate_results(country, gender, age_group, distance, surface_type):
 				race__event__series__surface_type__in=surface_types_for_series)
 		)
 
+def get_appropriate_results(country, gender, age_group, distance, surface_type):
+	other_gender = 3 - gender
+	results = get_appropriate_results_for_all_groups(country, distance, surface_type).exclude(runner__gender=other_gender).exclude(gender=other_gender).annotate(
+		res_diff=ExpressionWrapper(ExtractYear(F('race__event__start_date'))-ExtractYear(F('birthday')), output_field=IntegerField())).annotate(
+		runner_diff=ExpressionWrapper(ExtractYear(F('race__event__start_date'))-ExtractYear(F('runner__birthday')), output_field=IntegerField()))
+
+	if age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_SENIOR:
+		age_min = age_group.age_min
+		age_max = age_min + models.AGE_GROUP_RECORDS_AGE_GAP
+		results = results.exclude(
+			Q(age__lt=age_min) | Q(age__gt=age_max)).exclude(
+			Q(res_diff__lt=age_min) | Q(res_diff__gt=age_max), birthday__isnull=False, runner__birthday=None).exclude(
+			Q(runner_diff__lt=age_min) | Q(runner_diff__gt=age_max), runner__isnull=False, runner__birthday__isnull=False).exclude(
+			Q(runner=None) | Q(runner__birthday=None), age=None, birthday=None)
+	elif age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_YOUNG:
+		results = results.exclude(age__gt=age_group.age_min).exclude(birthday__isnull=False, res_diff__gte=age_group.age_min).exclude(
+			runner__isnull=False, runner__birthday__isnull=False, runner_diff__gte=age_group.age_min).exclude(
+			Q(runner=None) | Q(runner__birthday=None), age=None, birthday=None)
+	return results
+
+# Repeats the conditions of get_appropriate_results on the age for one result with provided fields.
+def fits_age_group(age_group: models.Record_age_group, event_year: int, age: Optional[int], birthday: Optional[datetime.date],
+		runner_id: Optional[int], runner_birthday: Optional[datetime.date]) -> bool:
+	if age_group.age_group_type not in (models.RECORD_AGE_GROUP_TYPE_SENIOR, models.RECORD_AGE_GROUP_TYPE_YOUNG):
+		return True
+	if (age is None) and (birthday is None) and (runner_birthday is None):
+		return False
+	res_diff = (event_year - birthday.year) if birthday else None
+	runner_diff = (event_year - runner_birthday.year) if runner_birthday else None
+	if age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_SENIOR:
+		age_min = age_group.age_min
+		age_max = age_min + models.AGE_GROUP_RECORDS_AGE_GAP
+		if (age is not None) and not (age_min <= age <= age_max):
+			return False
+		if (res_diff is not None) and (runner_birthday is None) and not (age_min <= res_diff <= age_max):
+			return False
+		return (runner_diff is None) or (age_min <= runner_diff <= age_max)
+	# age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_YOUNG
+	if (age is not None) and (age > age_group.age_min):
+		return False
+	if (res_diff is not None) and (res_diff >= age_group.age_min):
+		return False
+	return (runner_diff is None) or (runner_diff < age_group.age_min)
+
+# The best results of one (gender, age group) pair found by find_candidates_for_all_groups.
+@dataclass
+class BucketCandidates:
+	n_results: int = 0 # The number of all appropriate results, as get_appropriate_results(...).count() would return
+	results: List[models.Result] = field(default_factory=list) # The best of them except results not for records, best first
+	is_complete: bool = True # Are these all appropriate results except results not for records?
+
+# Scans all appropriate results on the distance and surface type once and distributes them to all pairs (gender, age group).
+# For each pair keeps only the best N_RESULTS_TO_CHECK + 1 + <number of its existing records> results,
+# i.e. enough for find_better_age_group_results_for_tuple not to go to the DB.
+# Returns the dict (gender, age_group_id) -> BucketCandidates.
+def find_candidates_for_all_groups(country: models.Country, distance: models.Distance, surface_type: int, age_groups,
+		bad_result_ids_by_bucket: Dict[Tuple[int, int], Set[int]],
+		n_existing_records_by_bucket: Dict[Tuple[int, int], int]) -> Dict[Tuple[int, int], BucketCandidates]:
+	distance_is_minutes = (distance.distance_type in models.TYPES_MINUTES)
+	buckets = [(gender, age_group) for gender in (results_util.GENDER_MALE, results_util.GENDER_FEMALE) for age_group in age_groups]
+	max_size = {(gender, age_group.id): N_RESULTS_TO_CHECK + 1 + n_existing_records_by_bucket.get((gender, age_group.id), 0)
+		for gender, age_group in buckets}
+	n_results = Counter()
+	n_good_results = Counter()
+	# For each bucket, a heap of (-value, -result_id) of its best results, so that the worst of them is the first one.
+	heaps = defaultdict(list)
+	# mysqlclient loads the whole result of a query to memory, even with iterator(), so we read the results by ranges of ids.
+	results = get_appropriate_results_for_all_groups(country, distance, surface_type).order_by()
+	max_result_id = models.Result.objects.aggregate(Max('id'))['id__max'] or 0
+	rows = (row for id_from in range(0, max_result_id + 1, RESULT_IDS_PER_QUERY)
+		for row in results.filter(pk__gte=id_from, pk__lt=id_from + RESULT_IDS_PER_QUERY).values_list(
+			'id', 'result', 'gender', 'runner_id', 'runner__gender', 'age', 'birthday', 'runner__birthday', 'race__event__start_date'))
+	for result_id, value, gender, runner_id, runner_gender, age, birthday, runner_birthday, start_date in rows:
+		# The smaller the key, the better the result.
+		key = (-value if distance_is_minutes else value, result_id)
+		for bucket_gender, age_group in buckets:
+			other_gender = 3 - bucket_gender
+			if (gender == other_gender) or (runner_gender == other_gender):
+				continue
+			if not fits_age_group(age_group, start_date.year, age, birthday, runner_id, runner_birthday):
+				continue
+			bucket = (bucket_gender, age_group.id)
+			n_results[bucket] += 1
+			if result_id in bad_result_ids_by_bucket.get(bucket, ()):
+				continue
+			n_good_results[bucket] += 1
+			heap = heaps[bucket]
+			if len(heap) < max_size[bucket]:
+				heapq.heappush(heap, (-key[0], -key[1]))
+			elif key < (-heap[0][0], -heap[0][1]):
+				heapq.heapreplace(heap, (-key[0], -key[1]))
+
+	result_ids = sorted(set(-neg_id for heap in heaps.values() for _, neg_id in heap))
+	results_by_id = {}
+	for i in range(0, len(result_ids), 1000):
+		results_by_id.update(models.Result.objects.select_related('race__event__series', 'runner').in_bulk(result_ids[i:i + 1000]))
+	res = {}
+	for bucket_gender, age_group in buckets:
+		bucket = (bucket_gender, age_group.id)
+		best_keys = sorted((-neg_key, -neg_id) for neg_key, neg_id in heaps[bucket])
+		res[bucket] = BucketCandidates(
+			n_results=n_results[bucket],
+			results=[results_by_id[result_id] for _, result_id in best_keys],
+			is_complete=(n_good_results[bucket] <= max_size[bucket]),
+		)
+	return res
+
+# Returns the results that satisfy condition in the same order as queryset.order_by(result_order) where queryset contains
+# exactly the appropriate results satisfying condition: from candidates if there are enough of them, otherwise from the DB.
+def best_results_from_candidates(candidates: Optional[BucketCandidates], condition, queryset, result_order: str):
+	if candidates is not None:
+		results = [result for result in candidates.results if condition(result)]
+		if candidates.is_complete or (len(results) > N_RESULTS_TO_CHECK):
+			return results
+	return queryset.order_by(result_order)
+
 # Returns <=N_TOP_RESULTS pairs: (result, age_on_event_date if known else None), and <were all suitable results checked?>
 def filter_by_age_on_event_date(results, age_group: models.Record_age_group, debug=False) -> Tuple[List[Tuple[models.Result, Optional[int]]], bool]:
 	filtered_results = []
@@ -314,7 +421,7 @@ def filter_by_age_on_event_date(results, age_group: models.Record_age_group, deb
 	all_checked = True
 	# for result in results[:100]: # To avoid errors 502
 	for i, result in enumerate(results):
-		if i == 100:
+		if i == N_RESULTS_TO_CHECK:
 			all_checked = False
 			break
 		if result.runner and result.runner.birthday_known:
@@ -365,10 +472,21 @@ def check_record_eligibility(distance: models.Distance, surface_type: int, resul
 		return False, 'Результаты с ручным хронометражем на дистанциях до 800 м не учитываюся с 1 января 2022 г.'
 	return True, ''
 
-# Returns the amounts of deleted candidates and created candidates
+# Returns the amounts of deleted candidates and created candidates.
+# If candidates are given (by find_candidates_for_all_groups), takes the results from them instead of the DB when possible;
+# then the caller must save the number of appropriate results itself.
+# If new_possible_records is given, appends new Possible_record_result objects to it instead of saving them.
 def find_better_age_group_results_for_tuple(country: models.Country, gender: int, age_group: models.Record_age_group, distance: models.Distance, surface_type: int,
 		result_not_for_record_ids=None, debug=False,
-		to_delete_old=False, check_electronic_records=True, request=None) -> Tuple[int, int]:
+		to_delete_old=False, check_electronic_records=True, request=None,
+		candidates: Optional[BucketCandidates]=None, new_possible_records: Optional[List[models.Possible_record_result]]=None) -> Tuple[int, int]:
+	def add_possible_record(**kwargs):
+		record = models.Possible_record_result(**kwargs)
+		if new_possible_records is None:
+			record.save()
+		else:
+			new_possible_records.append(record)
+
 	n_deleted = 0
 	if to_delete_old:
 		n_deleted = age_group.possible_record_result_set.filter(
@@ -391,18 +509,21 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 	runners_with_records = set(existing_record_results.exclude(runner=None).exclude(cur_place=None).values_list('runner_id', flat=True))
 
 	all_appropriate_results = get_appropriate_results(country, gender, age_group, distance, surface_type)
-	results_number, _ = models.Record_candidate_results_number.objects.get_or_create(
-		country=country, gender=gender, age_group=age_group, distance=distance, surface_type=surface_type)
-	results_number.number = all_appropriate_results.count()
-	results_number.save()
+	if candidates is None:
+		results_number, _ = models.Record_candidate_results_number.objects.get_or_create(
+			country=country, gender=gender, age_group=age_group, distance=distance, surface_type=surface_type)
+		results_number.number = all_appropriate_results.count()
+		results_number.save()
 
 	appropriate_results_with_existing_records = all_appropriate_results.exclude(pk__in=result_not_for_record_ids).select_related('race__event__series', 'runner')
 	appropriate_results = appropriate_results_with_existing_records.exclude(pk__in=existing_record_result_ids)
 	# For some distances, there are too many results in absolute category, so the request results don't fit in RAM. We leave only fast enough results then
+	max_value = None
 	if (age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_ABSOLUTE) and (not distance_is_minutes):
 		cur_record = existing_record_results.filter(cur_place=1).first()
 		if cur_record and cur_record.value:
-			appropriate_results = appropriate_results.filter(result__lt=1.5*cur_record.value)
+			max_value = 1.5*cur_record.value
+			appropriate_results = appropriate_results.filter(result__lt=max_value)
 
 	
 	n_top_results = get_n_top_results_by_age_group(age_group)
@@ -419,7 +540,9 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 		print(country, gender, age_group, distance, surface_type)
 		if age_group.age_min is None:
 			print(appropriate_results.order_by(result_order).query)
-	best_results_with_ages, all_checked = filter_by_age_on_event_date(appropriate_results.order_by(result_order), age_group, debug)
+	best_results_with_ages, all_checked = filter_by_age_on_event_date(best_results_from_candidates(candidates,
+		lambda result: (result.id not in existing_record_result_ids) and ((max_value is None) or (result.result < max_value)),
+		appropriate_results, result_order), age_group, debug)
 	if (not all_checked) and request:
 		messages.warning(request, f'{country}, {age_group}, {gender}, {distance}, {surface_type}: проверены не все результаты, лишь лучшие 100')
 	n_slower_results_found = 0
@@ -456,7 +579,7 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 		if check_electronic_results and result.is_electronic():
 			is_electro = True
 			new_electronic_result_found = True
-		models.Possible_record_result.objects.create(
+		add_possible_record(
 				country=country,
 				gender=gender,
 				age_group=age_group,
@@ -483,14 +606,21 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 			was_record_ever=True).exclude(race=None).select_related('race__event'):
 		results = appropriate_results_with_existing_records.filter(race__event__start_date__lt=ever_record_result.race.event.start_date)
 
+		prev_min_value = prev_max_value = None
 		if surface_type != results_util.SURFACE_DEFAULT:
 			# For non-ultra distances we don't check too low results.
 			if distance_is_minutes:
-				results = results.filter(result__gte=int(round(ever_record_result.value * 0.8)))
+				prev_min_value = int(round(ever_record_result.value * 0.8))
+				results = results.filter(result__gte=prev_min_value)
 			else:
-				results = results.filter(result__lte=int(round(ever_record_result.value * 1.2)))
-
-		best_results_with_ages, all_checked = filter_by_age_on_event_date(results.order_by(result_order), age_group, debug)
+				prev_max_value = int(round(ever_record_result.value * 1.2))
+				results = results.filter(result__lte=prev_max_value)
+
+		best_results_with_ages, all_checked = filter_by_age_on_event_date(best_results_from_candidates(candidates,
+			lambda result: (result.race.event.start_date < ever_record_result.race.event.start_date)
+				and ((prev_min_value is None) or (result.result >= prev_min_value))
+				and ((prev_max_value is None) or (result.result <= prev_max_value)),
+			results, result_order), age_group, debug)
 		if (not all_checked) and request:
 			messages.warning(request, f'{country}, {age_group}, {gender}, {distance}, {surface_type}: для бывших рекордов проверены не все результаты, лишь лучшие 100')
 		if best_results_with_ages:
@@ -515,7 +645,7 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 			if check_electronic_results and result.is_electronic():
 				is_electro = True
 				new_electronic_result_found = True
-			models.Possible_record_result.objects.create(
+			add_possible_record(
 					country=country,
 					gender=gender,
 					age_group=age_group,
@@ -534,7 +664,9 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 		worst_electronic_record = existing_record_results.exclude(cur_place_electronic=None).order_by('-cur_place_electronic').first()
 		best_electronic_results = appropriate_results_with_existing_records.exclude(pk__in=existing_record_result_ids).filter(
 			race__timing__in=(models.TIMING_UNKNOWN, models.TIMING_ELECTRONIC))
-		best_electronic_results_with_ages, all_checked = filter_by_age_on_event_date(best_electronic_results.order_by(result_order), age_group, debug)
+		best_electronic_results_with_ages, all_checked = filter_by_age_on_event_date(best_results_from_candidates(candidates,
+			lambda result: (result.id not in existing_record_result_ids) and (result.race.timing in (models.TIMING_UNKNOWN, models.TIMING_ELECTRONIC)),
+			best_electronic_results, result_order), age_group, debug)
 		if (not all_checked) and request:
 			messages.warning(request, f'{country}, {age_group}, {gender}, {distance}, {surface_type}: для электронных рекордов проверены не все результаты, лишь лучшие 100')
 		if best_electronic_results_with_ages:
@@ -553,7 +685,7 @@ def find_better_age_group_results_for_tuple(country: models.Country, gender: int
 				)
 			elif (worst_electronic_record is None) or (worst_electronic_record.value > result.result) or \
 					(worst_electronic_record.cur_place_electronic < n_top_results):
-				models.Possible_record_result.objects.create(
+				add_possible_record(
 						country=country,
 						gender=gender,
 						age_group=age_group,
@@ -608,6 +740,24 @@ def generate_better_age_group_results_for_tuple(request, country_id, gender_code
 		return redirect('results:ultra_record_details', **kwargs)
 	return redirect('results:age_group_record_details', age=age, surface_code=surface_code, **kwargs)
 
+# Creates or updates Record_candidate_results_number for all pairs (gender, age group) at once.
+def save_candidate_results_numbers(country: models.Country, distance: models.Distance, surface_type: int,
+		candidates_by_bucket: Dict[Tuple[int, int], BucketCandidates]):
+	existing = {(item.gender, item.age_group_id): item for item in models.Record_candidate_results_number.objects.filter(
+		country=country, distance=distance, surface_type=surface_type)}
+	to_create = []
+	to_update = []
+	for (gender, age_group_id), candidates in candidates_by_bucket.items():
+		item = existing.get((gender, age_group_id))
+		if item is None:
+			to_create.append(models.Record_candidate_results_number(country=country, gender=gender, age_group_id=age_group_id,
+				distance=distance, surface_type=surface_type, number=candidates.n_results))
+		elif item.number != candidates.n_results:
+			item.number = candidates.n_results
+			to_update.append(item)
+	models.Record_candidate_results_number.objects.bulk_create(to_create)
+	models.Record_candidate_results_number.objects.bulk_update(to_update, ['number'])
+
 def generate_better_age_group_results(country_id, generate_outdoor=True, generate_indoor=True, generate_ultra=True, debug=False):
 	if debug:
 		print(f'{datetime.datetime.now()} generate_better_age_group_results for country {country_id} started')
@@ -634,18 +784,32 @@ def generate_better_age_group_results(country_id, generate_outdoor=True, generat
 
 	for distance_id, surface_type in distance_surface_pairs:
 		distance = models.Distance.objects.get(pk=distance_id)
+		if surface_type == results_util.SURFACE_DEFAULT:
+			# We now search only for absolute records in ultra distances
+			tuple_age_groups = [age_group for age_group in age_groups if age_group.age_group_type == models.RECORD_AGE_GROUP_TYPE_ABSOLUTE]
+		else:
+			tuple_age_groups = list(age_groups)
+		bad_result_ids_by_bucket = {(gender, age_group_id): ids for (gender, age_group_id, tuple_distance_id, tuple_surface_type), ids
+			in bad_result_ids_by_tuple.items() if (tuple_distance_id == distance.id) and (tuple_surface_type == surface_type)}
+		n_existing_records_by_bucket = Counter(models.Record_result.objects.filter(country=country, distance=distance, surface_type=surface_type).exclude(
+			result=None).values_list('gender', 'age_group_id'))
+		candidates_by_bucket = find_candidates_for_all_groups(country, distance, surface_type, tuple_age_groups,
+			bad_result_ids_by_bucket, n_existing_records_by_bucket)
+		save_candidate_results_numbers(country, distance, surface_type, candidates_by_bucket)
+
+		new_possible_records = []
 		for gender in (results_util.GENDER_MALE, results_util.GENDER_FEMALE):
-			distance_is_minutes = (distance.distance_type in models.TYPES_MINUTES)
-			for age_group in age_groups:
-				if (surface_type == results_util.SURFACE_DEFAULT) and (age_group.age_group_type != models.RECORD_AGE_GROUP_TYPE_ABSOLUTE):
-					# We now search only for absolute records in ultra distances
-					continue
+			for age_group in tuple_age_groups:
 				check_electronic_records = update_records_for_tuple(country, gender, age_group, distance, surface_type)
 				n_just_deleted, n_just_created = find_better_age_group_results_for_tuple(
 					country, gender, age_group, distance, surface_type,
-					result_not_for_record_ids=bad_result_ids_by_tuple.get((gender, age_group.id, distance.id, surface_type), set()),
-					debug=debug, check_electronic_records=check_electronic_records)
+					result_not_for_record_ids=bad_result_ids_by_bucket.get((gender, age_group.id), set()),
+					debug=debug, check_electronic_records=check_electronic_records,
+					candidates=candidates_by_bucket[(gender, age_group.id)], new_possible_records=new_possible_records)
 				n_results_created += n_just_created
+		models.Possible_record_result.objects.bulk_create(new_possible_records, batch_size=1000)
+		if debug:
+			print(f'{datetime.datetime.now()} {distance}, surface {surface_type}: {len(new_possible_records)} possible records found')
 
 	stat.set_stat_value(f'possible_age_records_gen_{country_id}', 0, datetime.date.today())
 	if debug:
@@ -102,6 +102,8 @@ def update_runner(request, creator, runner_old, runner_new):
 	if request and (n_rows > 0):
 		messages.success(request, f'Поле runner в таблице dj_result исправлено у {n_rows} записей.')
 	n_extra_names = runner_old.extra_name_set.update(runner=runner_new)
+	if n_extra_names > 0:
+		models.Runner_search_name.update_for_runner(runner_new.id)
 	if request and (n_extra_names > 0):
 		messages.success(request, f'Перенесено дополнительных имён у старого бегуна к новому: {n_extra_names}')
 	n_records = runner_old.record_result_set.update(runner=runner_new)
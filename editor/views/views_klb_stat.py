@@ -1,13 +1,14 @@
 # TODO -> ../klb_stat.py
+from django.db import transaction
 from django.db.models import F, Sum
 import datetime
 import decimal
 import re
 import xlsxwriter
-from collections import Counter
+from collections import Counter, defaultdict
 
 from results import models, models_klb, results_util
-from editor import runner_stat
+from editor import klb_score_tables, runner_stat
 from typing import Optional, Tuple
 from . import views_common
 
@@ -47,39 +48,39 @@ def distance2meters(distance_raw):
 def get_sport_score(result_year: int, birth_year: int, gender: int, length: int, centiseconds: int) -> decimal.Decimal:
 	if result_year <= 2021:
 		class_year = 2017 if (result_year <= 2017) else 2018 # There are only 2017 and 2018 for now
-		classes = models.Sport_class.objects.filter(year=class_year, gender=gender, length__lte=length).order_by('-length').first()
-		return results_util.quantize(3 ** ( 2 + (classes.master_value - (centiseconds / 100)) / (classes.third_class_value - classes.master_value) ))
+		master_value, third_class_value = klb_score_tables.get_sport_class(class_year, gender, length)
+		return results_util.quantize(3 ** ( 2 + (master_value - (centiseconds / 100)) / (third_class_value - master_value) ))
 	if result_year > 2022:
 		result_year = 2022 # FIXME
 
 	if length <= 10000:
-		top3_small_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_5KM_ID)
+		top3_small_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_5KM_ID)
 		small_dist = 5000
-		top3_average_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_10KM_ID)
+		top3_average_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_10KM_ID)
 		average_dist = 10000
-		top3_big_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
+		top3_big_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
 		big_dist = 21098
 	if (length > 10000) and (length <= 42200):
-		top3_small_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_10KM_ID)
+		top3_small_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_10KM_ID)
 		small_dist = 10000
-		top3_average_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
+		top3_average_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
 		average_dist = 21098
-		top3_big_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
+		top3_big_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
 		big_dist = 42195
 	if (length > 42200) and (length <= 100000):
-		top3_small_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
+		top3_small_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_HALFMARATHON_ID)
 		small_dist = 21098
-		top3_average_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
+		top3_average_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
 		average_dist = 42195
-		top3_big_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_100KM_ID)
+		top3_big_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_100KM_ID)
 		big_dist = 100000
 	if (length > 100000):
-		top3_small_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
+		top3_small_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_MARATHON_ID)
 		small_dist = 42195
-		top3_average_dist_time = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_100KM_ID)
+		top3_average_dist_time = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_100KM_ID)
 		average_dist = 100000
 		top3_big_dist_time = 24 * 60 * 60 * 100
-		big_dist = models.Top_world_result.get_average_result(result_year, gender, results_util.DIST_24HOURS_ID)
+		big_dist = klb_score_tables.get_average_result(result_year, gender, results_util.DIST_24HOURS_ID)
 	coef_a = (top3_big_dist_time - top3_small_dist_time) * (average_dist - small_dist) - (top3_average_dist_time - top3_small_dist_time) * (big_dist - small_dist)
 	coef_a /= ((big_dist ** 2) - (small_dist ** 2)) * (average_dist - small_dist) - ((average_dist ** 2) - (small_dist ** 2)) * (big_dist - small_dist)
 	coef_b = (top3_average_dist_time - top3_small_dist_time - coef_a * ((average_dist ** 2) - (small_dist ** 2))) / (average_dist - small_dist)
@@ -102,7 +103,7 @@ def get_klb_score(result_year: int, birth_year: int, gender: int, length: int, c
 		return centiseconds, clean_score, bonus_score
 
 	# models.write_log(f'Running get_klb_coefficient for {result_year}, {gender}, {result_year - birth_year}, {length}')
-	age_coef = models.Coefficient.get_klb_coefficient(result_year, gender, result_year - birth_year, length)
+	age_coef = klb_score_tables.get_klb_coefficient(result_year, gender, result_year - birth_year, length)
 	# models.write_log(f'Result: {age_coef}')
 	if result_year <= 2021:
 		centiseconds = 100 * roundup_centiseconds(centiseconds)
@@ -285,17 +286,77 @@ def update_team_score(team, to_clean=True, to_calc_sum=False):
 		team.n_members_started = participants.filter(n_starts__gt=0).count()
 		team.save()
 
-def fill_match_places(year, fill_age_places=False):
+# The fields that update_match and fill_match_places recalculate.
+KLB_RESULT_SCORE_FIELDS = ('is_in_best', 'is_in_best_bonus')
+KLB_PARTICIPANT_SCORE_FIELDS = ('score_sum', 'bonus_sum', 'n_starts', 'is_in_best')
+KLB_PARTICIPANT_PLACE_FIELDS = ('place', 'place_gender', 'place_group')
+KLB_TEAM_SCORE_FIELDS = ('score', 'bonus_score', 'n_members', 'n_members_started')
+KLB_TEAM_PLACE_FIELDS = ('n_members', 'place', 'place_small_teams', 'place_medium_teams', 'place_secondary_teams')
+
+def field_values(objects, fields):
+	return {obj.id: tuple(getattr(obj, field) for field in fields) for obj in objects}
+
+# Returns the objects whose fields differ from old_values that were collected by field_values before the recalculation.
+def changed_objects(objects, fields, old_values):
+	return [obj for obj in objects if tuple(getattr(obj, field) for field in fields) != old_values[obj.id]]
+
+def bulk_update_changed(model, objects, fields, old_values) -> int:
+	to_update = changed_objects(objects, fields, old_values)
+	model.objects.bulk_update(to_update, fields, batch_size=1000)
+	return len(to_update)
+
+# The same as update_participant_score, but in memory: marks the best results of the participant
+# and fills their sums. klb_results must be all participant's results of the match sorted by id.
+def calc_participant_score(participant, klb_results, is_active_year: bool):
+	year = participant.year
+	for klb_result in klb_results:
+		klb_result.is_in_best = False
+		klb_result.is_in_best_bonus = False
+	for klb_result in sorted(klb_results, key=lambda x: -x.klb_score)[:models_klb.get_n_results_for_clean_score(year)]:
+		klb_result.is_in_best = True
+	if not is_active_year:
+		return
+	for klb_result in sorted(klb_results, key=lambda x: -x.bonus_score)[:models_klb.get_n_results_for_bonus_score(year)]:
+		klb_result.is_in_best_bonus = True
+	bonus_sum = sum((klb_result.bonus_score for klb_result in klb_results if klb_result.is_in_best_bonus), decimal.Decimal(0))
+	participant.bonus_sum = min(bonus_sum, models_klb.get_max_bonus_per_year(year))
+	clean_sum = sum((klb_result.klb_score for klb_result in klb_results if klb_result.is_in_best), decimal.Decimal(0))
+	participant.score_sum = participant.bonus_sum + clean_sum
+	participant.n_starts = len(klb_results)
+
+# The same as update_team_score(team, to_calc_sum=True), but in memory. participants must be sorted by id.
+def calc_team_score(team, participants, is_active_year: bool):
+	n_runners_for_club_clean_score = models_klb.get_n_runners_for_team_clean_score(team.year)
+	if len(participants) <= n_runners_for_club_clean_score:
+		for participant in participants:
+			participant.is_in_best = True
+	else:
+		for participant in participants:
+			participant.is_in_best = False
+		started = [participant for participant in participants if participant.n_starts]
+		started.sort(key=lambda x: (-(x.score_sum - x.bonus_sum), -x.n_starts))
+		for participant in started[:n_runners_for_club_clean_score]:
+			participant.is_in_best = True
+	if is_active_year:
+		clean_score = sum((participant.score_sum - participant.bonus_sum for participant in participants if participant.is_in_best),
+			decimal.Decimal(0))
+		team.bonus_score = sum((participant.bonus_sum for participant in participants), decimal.Decimal(0))
+		team.score = clean_score + team.bonus_score
+		team.n_members = len(participants)
+		team.n_members_started = sum(1 for participant in participants if participant.n_starts > 0)
+
+# teams must have club loaded. n_members_by_team: team_id -> number of its participants.
+def calc_team_places(year: int, teams, n_members_by_team):
 	place = 0
 	place_small_teams = 0
 	place_medium_teams = 0
 	place_secondary_teams = 0
-	models.Klb_team.objects.filter(year=year).update(place=None, place_small_teams=None, place_medium_teams=None, place_secondary_teams=None)
 	small_team_limit = models_klb.get_small_team_limit(year)
 	medium_team_limit = models_klb.get_medium_team_limit(year)
-	for team in models.Klb_team.objects.filter(year=year).exclude(number=models.INDIVIDUAL_RUNNERS_CLUB_NUMBER).select_related('club').order_by(
-			'-score', 'name'):
-		team.n_members = team.klb_participant_set.count()
+	for team in teams:
+		team.place = team.place_small_teams = team.place_medium_teams = team.place_secondary_teams = None
+	for team in sorted((team for team in teams if team.number != models.INDIVIDUAL_RUNNERS_CLUB_NUMBER), key=lambda x: (-x.score, x.name)):
+		team.n_members = n_members_by_team.get(team.id, 0)
 		place += 1
 		team.place = place
 		if team.n_members <= small_team_limit:
@@ -307,40 +368,63 @@ def fill_match_places(year, fill_age_places=False):
 		elif team.n_members <= medium_team_limit:
 			place_medium_teams += 1
 			team.place_medium_teams = place_medium_teams
-		team.save()
+
+# participants must have klb_person loaded and be sorted by id.
+# Returns the numbers of participants with positive score: in total, by gender and by age group.
+def calc_participant_places(participants) -> Tuple[int, Counter, Counter]:
+	place = 0
+	place_gender = Counter()
+	place_group = Counter()
+	for participant in participants:
+		participant.place = participant.place_gender = participant.place_group = None
+	for participant in sorted((participant for participant in participants if participant.score_sum > 0), key=lambda x: -x.score_sum):
+		gender = participant.klb_person.gender
+		place += 1
+		place_gender[gender] += 1
+		place_group[participant.age_group_id] += 1
+
+		participant.place = place
+		participant.place_gender = place_gender[gender]
+		participant.place_group = place_group[participant.age_group_id]
+	return place, place_gender, place_group
+
+def fill_age_groups_sizes(year: int, participants, n_started: int, n_started_by_gender: Counter, n_started_by_group: Counter):
+	n_by_gender = Counter(participant.klb_person.gender for participant in participants)
+	n_by_group = Counter(participant.age_group_id for participant in participants)
+	groups = list(models.Klb_age_group.objects.filter(year=year))
+	for group in groups:
+		if group.birthyear_min is not None:
+			group.n_participants = n_by_group[group.id]
+			group.n_participants_started = n_started_by_group[group.id]
+		elif group.gender == models.GENDER_UNKNOWN:
+			group.n_participants = len(participants)
+			group.n_participants_started = n_started
+		else:
+			group.n_participants = n_by_gender[group.gender]
+			group.n_participants_started = n_started_by_gender[group.gender]
+	models.Klb_age_group.objects.bulk_update(groups, ['n_participants', 'n_participants_started'])
+
+def fill_team_and_participant_places(year: int, teams, participants, fill_age_places: bool):
+	n_members_by_team = Counter(participant.team_id for participant in participants if participant.team_id)
+	old_values = field_values(teams, KLB_TEAM_PLACE_FIELDS)
+	calc_team_places(year, teams, n_members_by_team)
+	bulk_update_changed(models.Klb_team, teams, KLB_TEAM_PLACE_FIELDS, old_values)
 
 	if fill_age_places:
-		place = 0
-		place_gender = {results_util.GENDER_FEMALE: 0, results_util.GENDER_MALE: 0}
-		place_group = {}
-		models.Klb_participant.objects.filter(year=year).update(place=None, place_gender=None, place_group=None)
-		for participant in models.Klb_participant.objects.filter(year=year, score_sum__gt=0).select_related(
-				'klb_person', 'age_group').order_by('-score_sum'):
-			gender = participant.klb_person.gender
-			group_id = participant.age_group.id
-
-			place += 1
-			place_gender[gender] += 1
-			place_group[group_id] = place_group.get(group_id, 0) + 1
-
-			participant.place = place
-			participant.place_gender = place_gender[gender]
-			participant.place_group = place_group[group_id]
+		old_values = field_values(participants, KLB_PARTICIPANT_PLACE_FIELDS)
+		n_started, n_started_by_gender, n_started_by_group = calc_participant_places(participants)
+		bulk_update_changed(models.Klb_participant, participants, KLB_PARTICIPANT_PLACE_FIELDS, old_values)
+		fill_age_groups_sizes(year, participants, n_started, n_started_by_gender, n_started_by_group)
 
-			participant.save()
-		models.Klb_age_group.objects.filter(year=year, gender=models.GENDER_UNKNOWN).update(
-			n_participants=models.Klb_participant.objects.filter(year=year).count(),
-			n_participants_started=place
-		)
-		for gender in [results_util.GENDER_FEMALE, results_util.GENDER_MALE]:
-			models.Klb_age_group.objects.filter(year=year, birthyear_min=None, gender=gender).update(
-				n_participants=models.Klb_participant.objects.filter(year=year, klb_person__gender=gender).count(),
-				n_participants_started=place_gender[gender]
-			)
-		for group in models.Klb_age_group.objects.filter(year=year, birthyear_min__isnull=False):
-			group.n_participants = models.Klb_participant.objects.filter(year=year, age_group=group).count()
-			group.n_participants_started = place_group.get(group.id, 0)
-			group.save()
+def load_match_teams(year: int):
+	return list(models.Klb_team.objects.filter(year=year).select_related('club').order_by('id'))
+
+def load_match_participants(year: int):
+	return list(models.Klb_participant.objects.filter(year=year).select_related('klb_person').order_by('id'))
+
+def fill_match_places(year, fill_age_places=False):
+	with transaction.atomic():
+		fill_team_and_participant_places(year, load_match_teams(year), load_match_participants(year), fill_age_places)
 
 def fill_participants_stat_places(year, match_categories=None, debug=False):
 	if match_categories is None:
@@ -370,20 +454,50 @@ def fill_categories_n_participants(year):
 		match_category.save()
 	print('Done!')
 
+# Recalculates best results, participants and teams scores of the whole match in memory and saves only changed rows
+def update_match_scores(year: int, debug: bool=False):
+	is_active_year = models.is_active_klb_year(year)
+	with transaction.atomic():
+		klb_results = list(models.Klb_result.objects.filter(race__event__start_date__year__range=models_klb.match_year_range(year)).only(
+			'id', 'klb_person_id', 'klb_score', 'bonus_score', *KLB_RESULT_SCORE_FIELDS).order_by('id'))
+		participants = load_match_participants(year)
+		teams = load_match_teams(year)
+		old_results_values = field_values(klb_results, KLB_RESULT_SCORE_FIELDS)
+		old_participants_values = field_values(participants, KLB_PARTICIPANT_SCORE_FIELDS)
+		old_teams_values = field_values(teams, KLB_TEAM_SCORE_FIELDS)
+
+		results_by_person = defaultdict(list)
+		for klb_result in klb_results:
+			klb_result.is_in_best = False
+			klb_result.is_in_best_bonus = False
+			results_by_person[klb_result.klb_person_id].append(klb_result)
+		for participant in participants:
+			calc_participant_score(participant, results_by_person.get(participant.klb_person_id, []), is_active_year)
+
+		participants_by_team = defaultdict(list)
+		for participant in participants:
+			if participant.team_id:
+				participants_by_team[participant.team_id].append(participant)
+		for team in teams:
+			calc_team_score(team, participants_by_team.get(team.id, []), is_active_year)
+
+		n_results = bulk_update_changed(models.Klb_result, klb_results, KLB_RESULT_SCORE_FIELDS, old_results_values)
+		n_participants = bulk_update_changed(models.Klb_participant, participants, KLB_PARTICIPANT_SCORE_FIELDS, old_participants_values)
+		n_teams = bulk_update_changed(models.Klb_team, teams, KLB_TEAM_SCORE_FIELDS, old_teams_values)
+		if debug:
+			print(f'{datetime.datetime.now()} Scores are updated. Changed: {n_results} results, {n_participants} participants, {n_teams} teams')
+
+		fill_team_and_participant_places(year, teams, participants, fill_age_places=is_active_year)
+
 # Update everything: participants score, teams score. teams places, age group places
 def update_match(year, debug=False):
 	if debug:
 		print('{} Started KLBMatch-{} update'.format(datetime.datetime.now(), year))
-	models.Klb_result.objects.filter(race__event__start_date__year__range=models_klb.match_year_range(year)).update(
-		is_in_best=False, is_in_best_bonus=False)
 	models.Klb_participant_stat.objects.filter(klb_participant__year=year).delete()
 	match_categories = models.Klb_match_category.get_categories_by_year(year)
 	for participant in models.Klb_participant.objects.filter(year=year):
-		update_participant_score(participant, to_clean=False)
 		update_participant_stat(participant, clean_stat=False, match_categories=match_categories)
-	for team in models.Klb_team.objects.filter(year=year):
-		update_team_score(team, to_calc_sum=True)
-	fill_match_places(year=year, fill_age_places=models.is_active_klb_year(year))
+	update_match_scores(year, debug=debug)
 	fill_participants_stat_places(year=year, match_categories=match_categories, debug=debug)
 	if debug:
 		print("Year {} is updated".format(year))
@@ -4,12 +4,19 @@ from django.contrib.auth.models import User
 from django.db.models import Count, Q
 from django.contrib import messages
 
+from django.core.cache import cache
+
 from collections import OrderedDict
+import csv
+from dataclasses import dataclass
 import datetime
 from decimal import Decimal
 import math
+import openpyxl
+import os
+import pickle
 import re
-from typing import Any, List
+from typing import Any, Dict, List
 import xlrd
 
 from results import models, models_klb, results_util
@@ -234,6 +241,149 @@ def xlrd_cell2pair(cell, datemode):
 		res['error'] = cell_error
 	return res
 
+# How long a parsed protocol sheet stays in the cache, so that the editor doesn't re-read the file at each step.
+PARSED_SHEET_CACHE_TIMEOUT = 60 * 60 * 4
+# Larger sheets are not cached and are read from the file each time, so that a few huge protocols don't fill the cache.
+MAX_CACHED_SHEET_BYTES = 2 * 2**20
+
+class SheetReadError(Exception):
+	pass
+
+# A sheet of a protocol with the cells in the format of xlrd_cell2pair.
+@dataclass
+class ParsedSheet:
+	sheetnames: List[str]
+	sheet_index: int
+	datemode: int
+	ncols_total: int # data contains at most MAX_N_COLS first columns
+	data: List[List[Dict[str, Any]]]
+	header_row: int
+
+def empty_cell() -> Dict[str, Any]:
+	return {'value': '', 'type': xlrd.XL_CELL_EMPTY}
+
+# Converts a value read by openpyxl to the same dict that xlrd_cell2pair returns for the same cell in an xls file.
+def openpyxl_value2pair(value) -> Dict[str, Any]:
+	if value is None:
+		return empty_cell()
+	if isinstance(value, bool):
+		return {'value': int(value), 'type': xlrd.XL_CELL_BOOLEAN}
+	if isinstance(value, (int, float)):
+		return {'value': int(value) if float(value).is_integer() else value, 'type': xlrd.XL_CELL_NUMBER}
+	if isinstance(value, str):
+		value = value.strip()
+		return {'value': value, 'type': xlrd.XL_CELL_TEXT if value else xlrd.XL_CELL_EMPTY}
+	res = {'type': xlrd.XL_CELL_DATE}
+	try:
+		if isinstance(value, datetime.timedelta): # Durations longer than a day; xlrd reads them as dates of January 1900
+			cell_datetime = xlrd_date_value2tuple(value.total_seconds() / 86400, 0)
+		elif isinstance(value, datetime.datetime):
+			cell_datetime = ((0, 0, 0) if (value.year <= 1899) else (value.year, value.month, value.day)) \
+				+ (value.hour, value.minute, value.second, value.microsecond)
+		elif isinstance(value, datetime.date):
+			cell_datetime = (value.year, value.month, value.day, 0, 0, 0, 0)
+		else: # datetime.time
+			cell_datetime = (0, 0, 0, value.hour, value.minute, value.second, value.microsecond)
+		res['datetime'] = cell_datetime
+		res['value'] = tuple2date_or_time(cell_datetime)
+	except Exception as e:
+		res['value'] = str(value)
+		res['error'] = 'Некорректные дата/время: {}'.format(str(e))
+	return res
+
+# Each of the iter_*_rows functions returns the list of sheet names, the index of the sheet to read (0 if there is no sheet_index),
+# the datemode, and the iterator over the rows of that sheet. Each row is the triple:
+# a list of at most MAX_N_COLS cells, the number of non-empty cells, the full number of cells in the row.
+def iter_xls_rows(path: str, sheet_index: int):
+	wb_xls = xlrd.open_workbook(path, on_demand=True)
+	sheetnames = wb_xls.sheet_names()
+	if not (0 <= sheet_index < len(sheetnames)):
+		sheet_index = 0
+	sheet = wb_xls.sheet_by_index(sheet_index)
+	def rows():
+		for row_index in range(sheet.nrows):
+			cells = sheet.row_slice(row_index, 0, MAX_N_COLS)
+			yield [xlrd_cell2pair(cell, wb_xls.datemode) for cell in cells], \
+				sum(cell.ctype not in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK) for cell in cells), sheet.ncols
+		wb_xls.release_resources()
+	return sheetnames, sheet_index, wb_xls.datemode, rows()
+
+def iter_xlsx_rows(path: str, sheet_index: int):
+	workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+	sheetnames = workbook.sheetnames
+	if not (0 <= sheet_index < len(sheetnames)):
+		sheet_index = 0
+	worksheet = workbook.worksheets[sheet_index]
+	def rows():
+		for values in worksheet.iter_rows(max_col=MAX_N_COLS, values_only=True):
+			cells = [openpyxl_value2pair(value) for value in values]
+			yield cells, sum(cell['type'] != xlrd.XL_CELL_EMPTY for cell in cells), max(len(values), worksheet.max_column or 0)
+		workbook.close()
+	return sheetnames, sheet_index, 0, rows()
+
+def iter_csv_rows(path: str, sheet_index: int):
+	def rows():
+		with open(path, encoding='utf-8-sig', newline='') as file_in:
+			sample = file_in.read(64 * 1024)
+			file_in.seek(0)
+			try:
+				dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+			except csv.Error:
+				dialect = csv.excel
+			for values in csv.reader(file_in, dialect):
+				cells = [openpyxl_value2pair(value) for value in values[:MAX_N_COLS]]
+				yield cells, sum(cell['type'] != xlrd.XL_CELL_EMPTY for cell in cells), len(values)
+	return [os.path.basename(path)], 0, 0, rows()
+
+ROW_ITERATORS = {
+	'xls': iter_xls_rows,
+	'xlsx': iter_xlsx_rows,
+	'xlsm': iter_xlsx_rows,
+	'csv': iter_csv_rows,
+}
+
+# Reads the sheet row by row, so that only the converted cells are kept in memory.
+# If there is no sheet with such index, reads the first one.
+def read_sheet(path: str, sheet_index: int) -> ParsedSheet:
+	extension = path.split(".")[-1].lower()
+	if extension not in ROW_ITERATORS:
+		raise SheetReadError(f'недопустимое расширение {extension}')
+	try:
+		sheetnames, sheet_index, datemode, rows = ROW_ITERATORS[extension](path, sheet_index)
+		data = []
+		ncols_total = 0
+		max_nonempty_cells_number = 0
+		header_row = 0
+		for row_index, (row, nonempty_cells_number, row_length) in enumerate(rows):
+			data.append(row)
+			ncols_total = max(ncols_total, row_length)
+			if nonempty_cells_number > max_nonempty_cells_number + 3:
+				max_nonempty_cells_number = nonempty_cells_number
+				header_row = row_index
+	except Exception as e:
+		raise SheetReadError(repr(e)) from e
+	ncols = min(ncols_total, MAX_N_COLS)
+	for row in data:
+		row.extend(empty_cell() for _ in range(ncols - len(row)))
+	return ParsedSheet(sheetnames=sheetnames, sheet_index=sheet_index, datemode=datemode, ncols_total=ncols_total, data=data, header_row=header_row)
+
+# Returns the parsed sheet from the cache, if the file wasn't changed since then, or reads it.
+def get_parsed_sheet(protocol: models.Document, sheet_index: int) -> ParsedSheet:
+	path = protocol.get_upload_path()
+	file_stat = os.stat(path)
+	key = f'protocol_sheet_{protocol.id}_{sheet_index}_{int(file_stat.st_mtime)}_{file_stat.st_size}'
+	pickled = cache.get(key)
+	if pickled is not None:
+		return pickle.loads(pickled)
+	sheet = read_sheet(path, sheet_index)
+	pickled = pickle.dumps(sheet, pickle.HIGHEST_PROTOCOL)
+	if len(pickled) <= MAX_CACHED_SHEET_BYTES:
+		try:
+			cache.set(key, pickled, PARSED_SHEET_CACHE_TIMEOUT)
+		except OSError: # E.g. no space left. The page works without the cache, just slower.
+			pass
+	return sheet
+
 def tuple2centiseconds(time, length=None):
 	res = (((time[0] * 60) + time[1]) * 60 + time[2]) * 100
 	if len(time) > 3 and time[3]:
@@ -1197,7 +1347,7 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 	context['race'] = race
 	context['event'] = event
 	context['races'] = races.select_related('distance').order_by('distance__distance_type', '-distance__length', 'precise_name')
-	wb_xls = None
+	parsed_sheet = None
 	column_numbers = None
 	n_splits = 0
 
@@ -1220,58 +1370,39 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 	context['protocols'] = protocols
 	context['protocol'] = protocol
 
-	path = protocol.get_upload_path()
-	extension = path.split(".")[-1].lower()
-	if extension in ["xls", "xlsx", "xlsm"]:
-		try:
-			wb_xls = xlrd.open_workbook(path)
-		except Exception as e:
-			messages.warning(request, f'Не получилось открыть файл {path}: ошибка xlrd: {repr(e)}')
-	else:
-		messages.warning(request, f'Не получилось открыть файл {path}: недопустимое расширение {extension}')
+	try:
+		parsed_sheet = get_parsed_sheet(protocol, get_sheet_index(sheet_id, request.POST))
+	except (OSError, SheetReadError) as e:
+		messages.warning(request, f'Не получилось открыть файл {protocol.get_upload_path()}: {e}')
 
-	if wb_xls:
-		context['sheetnames'] = wb_xls.sheet_names()
-		sheet_index = get_sheet_index(sheet_id, request.POST)
+	if parsed_sheet:
+		context['sheetnames'] = parsed_sheet.sheetnames
+		sheet_index = parsed_sheet.sheet_index
 		context['sheet_index'] = sheet_index
-		sheet = wb_xls.sheet_by_index(sheet_index)
-		ncols = sheet.ncols
+		ncols = parsed_sheet.ncols_total
 		if ncols > MAX_N_COLS:
 			messages.warning(request, f'В протоколе целых {ncols} столбцов! Это слишком много. Работаем с первыми {MAX_N_COLS}')
 			ncols = MAX_N_COLS
 
-		data = []
-		max_nonempty_cells_number = 0
-		max_nonempty_cells_index = 0
-		for row_index in range(sheet.nrows):
-			row = []
-			nonempty_cells_number = 0
-			for col_index in range(ncols):
-				row.append(xlrd_cell2pair(sheet.cell(row_index, col_index), wb_xls.datemode))
-				if sheet.cell_type(row_index, col_index) not in [xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK]:
-					nonempty_cells_number += 1
-			# row[0] = str(row_index) # + "(" + str(nonempty_cells_number) + ")"
-			data.append(row)
-			if nonempty_cells_number > max_nonempty_cells_number + 3:
-				max_nonempty_cells_number = nonempty_cells_number
-				max_nonempty_cells_index = row_index
-		header_row = max_nonempty_cells_index
+		data = parsed_sheet.data
+		nrows = len(data)
+		header_row = parsed_sheet.header_row
 		column_data_types = [CELL_DATA_PASS] * ncols
 		column_split_values = [0] * ncols
 		column_numbers = [{'number': i} for i in range(ncols)]
-		rows_with_results = [0] * sheet.nrows
+		rows_with_results = [0] * nrows
 
 		settings['show_gender_column'] = False
-		settings['genders'] = [False] * sheet.nrows
+		settings['genders'] = [False] * nrows
 		settings['show_category_column'] = False
-		settings['categories'] = [''] * sheet.nrows
+		settings['categories'] = [''] * nrows
 		settings['has_empty_results'] = False
 		settings['show_category_prefix_choices'] = False
 
 		to_update_rows = ('frmProtocol_update' in request.POST) or ('frmProtocol_submit' in request.POST)
 		to_submit = ('frmProtocol_submit' in request.POST)
 		if to_update_rows or ('new_race_id' in request.POST):
-			for i in range(sheet.nrows):
+			for i in range(nrows):
 				rows_with_results[i] = request.POST.get('count_row_' + str(i), 0)
 			for i in range(ncols):
 				column_data_types[i] = results_util.int_safe(request.POST.get('select_' + str(i), 0))
@@ -1280,11 +1411,11 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 			settings['save_old_results'] = results_util.int_safe(request.POST.get('save_old_results', OLD_RESULTS_LEAVE_ALL))
 			settings['show_gender_column'] = results_util.int_safe(request.POST.get('show_gender_column', 0)) > 0
 			if settings['show_gender_column']:
-				for i in range(sheet.nrows):
+				for i in range(nrows):
 					settings['genders'][i] = ('gender_row_' + str(i)) in request.POST
 			settings['show_category_column'] = results_util.int_safe(request.POST.get('show_category_column', 0)) > 0
 			if settings['show_category_column']:
-				for i in range(sheet.nrows):
+				for i in range(nrows):
 					settings['categories'][i] = request.POST.get('category_row_' + str(i), '').strip()
 			settings['cumulative_splits'] = 'cumulative_splits' in request.POST
 
@@ -1297,7 +1428,7 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 			if settings['show_category_prefix_choices']:
 				settings['category_prefix'] = results_util.int_safe(request.POST.get('category_prefix', CATEGORY_PREFIX_NONE))
 		else: # default values
-			for i in range(header_row + 1, sheet.nrows):
+			for i in range(header_row + 1, nrows):
 				rows_with_results[i] = 1
 		if (not any(column_data_types)) or ( (not to_submit) and ('refresh_row_headers' in request.POST) ):
 			column_data_types, column_split_values = default_data_types(
@@ -1311,7 +1442,7 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 			type2col, split2col, column_types_ok = process_column_types(request, race, column_data_types, column_split_values)
 			# Are data in all important columns OK?
 			data, n_parse_errors, n_parse_warnings, column_numbers, settings = process_cell_values(
-				race, rows_with_results, wb_xls.datemode, data, column_data_types, column_numbers, type2col, settings)
+				race, rows_with_results, parsed_sheet.datemode, data, column_data_types, column_numbers, type2col, settings)
 			context['n_parse_errors'] = n_parse_errors
 			context['n_parse_warnings'] = n_parse_warnings
 			context['ok_to_import'] = column_types_ok and (n_parse_errors == 0)
@@ -1323,7 +1454,7 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 						messages.warning(request, 'В протоколе нет столбца с полом. Этот столбец добавлен автоматически. '
 							+ 'Отметьте галочки в строках с женщинами.')
 					else:
-						for i in range(sheet.nrows):
+						for i in range(nrows):
 							settings['genders'][i] = \
 								results_util.string2gender(data[i][type2col[CELL_DATA_CATEGORY]]['value']) == results_util.GENDER_FEMALE
 						messages.warning(request, 'В протоколе нет столбца с полом. Этот столбец добавлен автоматически. '
@@ -1355,7 +1486,7 @@ def protocol_details(request, event_id=None, race_id=None, protocol_id=None, she
 		]
 		context['used_rows'] = set([i for i in range(len(column_data_types)) if (column_data_types[i] != CELL_DATA_PASS)])
 		context['data'] = [{'checked': rows_with_results[i], 'data': data[i],
-			'gender': settings['genders'][i], 'category': settings['categories'][i]} for i in range(sheet.nrows)]
+			'gender': settings['genders'][i], 'category': settings['categories'][i]} for i in range(nrows)]
 		context['header_row'] = header_row
 		if settings['has_empty_results']:
 			context['has_empty_results'] = settings['has_empty_results']
@@ -1390,7 +1521,6 @@ def process_protocol(race_id=None, protocol_id=None, sheet_index=None, settings=
 		print('Не найдена дистанция с id', race_id)
 		return False
 	event = race.event
-	wb_xls = None
 
 	protocols = event.get_xls_protocols()
 	print('Подходящие протоколы у дистанции:')
@@ -1409,40 +1539,25 @@ def process_protocol(race_id=None, protocol_id=None, sheet_index=None, settings=
 
 	print('Работаем с протоколом {}, id {}.'.format(protocol.get_upload_path(), protocol.id))
 	try:
-		wb_xls = xlrd.open_workbook(protocol.get_upload_path())
-	except Exception as e:
-		print(f'Не получилось открыть файл протокола: ошибка xlrd: {repr(e)}')
+		parsed_sheet = get_parsed_sheet(protocol, sheet_index or 0)
+	except (OSError, SheetReadError) as e:
+		print(f'Не получилось открыть файл протокола: {e}')
 		return False
 
-	sheetnames = wb_xls.sheet_names()
+	sheetnames = parsed_sheet.sheetnames
 	print('Листы в протоколе:')
 	for i in range(len(sheetnames)):
 		print('№ {}: {}'.format(i, sheetnames[i]))
-	sheet_index = sheet_index if (sheet_index and (0 <= sheet_index < len(sheetnames))) else 0
-	sheet = wb_xls.sheet_by_index(sheet_index)
+	sheet_index = parsed_sheet.sheet_index
 	print('Работаем с листом «{}», № {}.'.format(sheetnames[sheet_index], sheet_index))
 
-	nrows = sheet.nrows
-	ncols = sheet.ncols
+	data = parsed_sheet.data
+	nrows = len(data)
+	ncols = parsed_sheet.ncols_total
 	if ncols > MAX_N_COLS:
 		print(f'В протоколе целых {ncols} столбцов! Это слишком много. Работаем с первыми {MAX_N_COLS}')
 		ncols = MAX_N_COLS
-
-	data = []
-	max_nonempty_cells_number = 0
-	max_nonempty_cells_index = 0
-	for row_index in range(nrows):
-		row = []
-		nonempty_cells_number = 0
-		for col_index in range(ncols):
-			row.append(xlrd_cell2pair(sheet.cell(row_index,col_index), wb_xls.datemode))
-			if sheet.cell_type(row_index,col_index) not in [xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK]:
-				nonempty_cells_number += 1
-		# row[0] = str(row_index) # + "(" + str(nonempty_cells_number) + ")"
-		data.append(row)
-		if nonempty_cells_number > max_nonempty_cells_number + 3:
-			max_nonempty_cells_number = nonempty_cells_number
-			max_nonempty_cells_index = row_index
+	max_nonempty_cells_index = parsed_sheet.header_row
 	print('Размер листа: {} строк, {} столбцов.'.format(len(data), len(data[0]) if data else 0))
 
 	if 'save_old_results' not in settings:
@@ -1503,7 +1618,7 @@ def process_protocol(race_id=None, protocol_id=None, sheet_index=None, settings=
 	# Are data in all important columns OK?
 	column_numbers = [{'number': i} for i in range(ncols)]
 	data, n_parse_errors, n_parse_warnings, column_numbers, settings = process_cell_values(
-		race, rows_with_results, wb_xls.datemode, data, column_data_types, column_numbers, type2col, settings)
+		race, rows_with_results, parsed_sheet.datemode, data, column_data_types, column_numbers, type2col, settings)
 	print('Всего ошибок:', n_parse_errors)
 	print('Всего предупреждений:', n_parse_warnings)
 	ok_to_import = column_types_ok and (n_parse_errors == 0)
@@ -3,7 +3,6 @@ from django.db.models.query import Prefetch
 from django.shortcuts import get_object_or_404, render, redirect
 from django.utils import timezone
 
-import os
 import re
 from typing import Optional
 
@@ -96,12 +95,10 @@ def mark_item_not_failed(request, row_id: int):
 		return redirect('editor:protocol_queue')
 	if request.GET.get('delete_event_file'):
 		scraper = main.Scraper(row, row.download_attempt_set.first())
-		path = scraper.StandardFormPath()
-		if os.path.isfile(path):
-			os.remove(path)
-			messages.success(request, 'Файл забега в стандартной форме удалён')
+		if scraper.DeleteStandardForm():
+			messages.success(request, 'Файлы забега в стандартной форме удалены')
 		else:
-			messages.warning(request, f'Файл {path} не существует')
+			messages.warning(request, f'В папке {scraper.StandardFormDir()} нет файлов забега')
 	row.result = models.DOWNLOAD_NOT_STARTED
 	row.save()
 	messages.success(request, f'URL {row.url_site} возвращён в очередь')
@@ -2,6 +2,9 @@ from django.shortcuts import get_object_or_404, render, redirect
 from django.forms import modelformset_factory
 from django.db.models import Q
 from django.contrib import messages
+from django.utils import timezone
+
+from typing import Optional
 
 from results import models, models_klb, results_util
 from editor import forms, runner_stat
@@ -58,11 +61,13 @@ def split_name(name_raw, first_name_position): # Return triple: lname, fname, mi
 		else: # Горбунков Семён Семёнович
 			return name_split[0], name_split[1], " ".join(name_split[2:])
 
-def fill_places(race):
-	results = race.result_set.filter(result__gt=0, status=models.STATUS_FINISHED, source=models.RESULT_SOURCE_DEFAULT).select_related(
-		'category_size').order_by('-result' if (race.distance.distance_type in models.TYPES_MINUTES) else 'result', 'place_raw')
-	n_results = results.count()
-
+# Receives the finished results of a race as tuples (result, place_raw, gender, category name in lower case or None)
+# in the order from the best result to the worst one.
+# Returns the list of (place, gender place, category place) for them. Gender place is None for unknown gender,
+# category place is None for results without category.
+# Equal results get the same place; in the overall ranking, they must also have the same place_raw.
+def calc_places(rows: list[tuple[int, Optional[int], int, Optional[str]]]) -> list[tuple[int, Optional[int], Optional[int]]]:
+	res = []
 	# How many people we already passed
 	overall_place = 0
 	gender_places = [0, 0, 0, 0]
@@ -78,53 +83,86 @@ def fill_places(race):
 	prev_place_raw = None
 	prev_gender_results = [None, None, None, None]
 	prev_category_results = dict()
-	for result in results:
+	for result, place_raw, gender, category in rows:
 		overall_place += 1
-		if result.result == prev_overall_result and result.place_raw == prev_place_raw:
-			result.place = overall_place_last
+		if result == prev_overall_result and place_raw == prev_place_raw:
+			place = overall_place_last
 		else:
-			result.place = overall_place
+			place = overall_place
 			overall_place_last = overall_place
-			prev_overall_result = result.result
+			prev_overall_result = result
 
-		if result.gender != results_util.GENDER_UNKNOWN:
-			gender_places[result.gender] += 1
-			if result.result == prev_gender_results[result.gender]:
-				result.place_gender = gender_places_last[result.gender]
+		place_gender = None
+		if gender != results_util.GENDER_UNKNOWN:
+			gender_places[gender] += 1
+			if result == prev_gender_results[gender]:
+				place_gender = gender_places_last[gender]
 			else:
-				result.place_gender = gender_places[result.gender]
-				gender_places_last[result.gender] = gender_places[result.gender]
-				prev_gender_results[result.gender] = result.result
+				place_gender = gender_places[gender]
+				gender_places_last[gender] = gender_places[gender]
+				prev_gender_results[gender] = result
 
-		if result.category_size:
-			category = result.category_size.name.lower()
+		place_category = None
+		if category is not None:
 			category_places[category] = category_places.get(category, 0) + 1
-			if result.result == prev_category_results.get(category, None):
-				result.place_category = category_places_last[category]
+			if result == prev_category_results.get(category, None):
+				place_category = category_places_last[category]
 			else:
-				result.place_category = category_places[category]
+				place_category = category_places[category]
 				category_places_last[category] = category_places[category]
-				prev_category_results[category] = result.result
-		result.save()
-		prev_place_raw = result.place_raw
+				prev_category_results[category] = result
+		res.append((place, place_gender, place_category))
+		prev_place_raw = place_raw
+	return res
+
+# Fills overall, gender and category places for all official results of the race, and the sizes of categories.
+# Only the results whose places changed are written to the DB.
+# Returns the number of finished results and the number of non-empty categories.
+def fill_places(race):
+	rows = list(race.result_set.filter(result__gt=0, status=models.STATUS_FINISHED, source=models.RESULT_SOURCE_DEFAULT).order_by(
+		'-result' if (race.distance.distance_type in models.TYPES_MINUTES) else 'result', 'place_raw').values_list(
+		'id', 'result', 'place_raw', 'gender', 'category_size__name', 'place', 'place_gender', 'place_category'))
+	n_results = len(rows)
+	places = calc_places([(result, place_raw, gender, None if (category is None) else category.lower()) for _, result, place_raw, gender, category, _, _, _ in rows])
+
+	now = timezone.now()
+	results_to_update = []
+	category_places = dict()
+	for (result_id, _, _, gender, category, old_place, old_place_gender, old_place_category), (place, place_gender, place_category) \
+			in zip(rows, places):
+		# Just like before, we don't touch gender/category places of results with unknown gender/without category.
+		if place_gender is None:
+			place_gender = old_place_gender
+		if place_category is None:
+			place_category = old_place_category
+		else:
+			category_places[category.lower()] = category_places.get(category.lower(), 0) + 1
+		if (place, place_gender, place_category) != (old_place, old_place_gender, old_place_category):
+			results_to_update.append(models.Result(id=result_id, place=place, place_gender=place_gender, place_category=place_category,
+				last_update=now))
+	models.Result.objects.bulk_update(results_to_update, ['place', 'place_gender', 'place_category', 'last_update'], batch_size=1000)
 
-	race.category_size_set.all().update(size=0)
+	category_sizes = {category_size.name.lower(): category_size for category_size in race.category_size_set.all()}
 	for category, size in list(category_places.items()):
-		category_size, created = models.Category_size.objects.get_or_create(race=race, name=category)
-		if created:
+		if category not in category_sizes:
+			category_sizes[category] = models.Category_size.objects.create(race=race, name=category, size=size)
 			models.send_panic_email(
 				'Results with category have no category_size link',
 				'At race {} (id {}) there are results with category {} (size {}) but without a link to category size'.format(
 					race, race.id, category, size)
 			)
-		category_size.size = size
-		category_size.save()
-
-	race.result_set.filter(Q(result=0) | Q(status__gt=models.STATUS_FINISHED), source=models.RESULT_SOURCE_DEFAULT).update(
-		place=None, place_gender=None, place_category=None)
-	for category_size in list(race.category_size_set.filter(size=0)):
-		if not category_size.result_set.exists():
-			category_size.delete()
+	category_sizes_to_update = []
+	for category, category_size in category_sizes.items():
+		size = category_places.get(category, 0)
+		if category_size.size != size:
+			category_size.size = size
+			category_sizes_to_update.append(category_size)
+	models.Category_size.objects.bulk_update(category_sizes_to_update, ['size'])
+
+	race.result_set.filter(Q(result=0) | Q(status__gt=models.STATUS_FINISHED), source=models.RESULT_SOURCE_DEFAULT).exclude(
+		place=None, place_gender=None, place_category=None).update(place=None, place_gender=None, place_category=None)
+	race.category_size_set.filter(size=0, result=None).delete()
+	models.invalidate_public_pages(race)
 
 	return n_results, len(category_places)
 
@@ -3,16 +3,16 @@ from django.contrib.auth.models import User
 from django.db.models import Count, Q
 from django.utils import timezone
 from django.conf import settings
-from collections import Counter
+from collections import Counter, defaultdict
 import datetime
 import logging
 import re
 import io
-from typing import List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from results import models, models_klb, results_util
 from editor import klb_letters, monitoring, runner_stat
-from dbchecks import dbchecks
+from dbchecks import incremental as dbchecks_incremental
 
 def update_race_size_stat(debug=False):
 	bad_races = []
@@ -28,10 +28,13 @@ def update_race_size_stat(debug=False):
 				race_size = race.race_size
 				if race.n_results < race_size.n_results - 1:
 					bad_races.append((race, race_size.last_update, race_size.n_results, race.n_results))
+				if race.n_results != race_size.n_results:
+					models.Rating_table.mark_dirty_for_race(race)
 				race_size.n_results = race.n_results
 				race_size.save()
 			else:
 				models.Race_size.objects.create(race=race, n_results=race.n_results)
+				models.Rating_table.mark_dirty_for_race(race)
 				n_races_added += 1
 	if debug:
 		for race, last_update, old_n_results, n_results in bad_races:
@@ -109,6 +112,40 @@ def get_runners_by_name_and_birthday(lname, fname, midname, birthday):
 	runners_with_extra_name_ids = runners_with_extra_name.values_list('runner_id', flat=True)
 	return runners.union(models.Runner.objects.filter(pk__in=set(runners_with_extra_name_ids)))
 
+# We look for runners with these birthdays in one query
+BIRTHDAYS_PER_QUERY = 1000
+RESULTS_PER_QUERY = 1000
+# The letter about attached results lists at most this number of them
+MAX_RESULTS_IN_LETTER = 1000
+
+NameBirthdayKey = Tuple[str, str, datetime.date]
+# key -> list of (runner_id, folded midname)
+NameBirthdayIndex = Dict[NameBirthdayKey, List[Tuple[int, str]]]
+
+# The DB compares names ignoring case and accents, so we do the same.
+def name_birthday_key(lname: str, fname: str, birthday: datetime.date) -> NameBirthdayKey:
+	return (models.fold_name_for_comparison(lname), models.fold_name_for_comparison(fname), birthday)
+
+# Loads all runners with known birthday from given ones and their extra names, in a few queries.
+def build_name_birthday_index(birthdays: Iterable[datetime.date]) -> NameBirthdayIndex:
+	index = defaultdict(list)
+	birthdays = sorted(set(birthdays))
+	for i in range(0, len(birthdays), BIRTHDAYS_PER_QUERY):
+		birthdays_chunk = birthdays[i:i + BIRTHDAYS_PER_QUERY]
+		for runner_id, lname, fname, midname, birthday in models.Runner.objects.filter(
+				birthday_known=True, birthday__in=birthdays_chunk).values_list('id', 'lname', 'fname', 'midname', 'birthday'):
+			index[name_birthday_key(lname, fname, birthday)].append((runner_id, models.fold_name_for_comparison(midname)))
+		for runner_id, lname, fname, midname, birthday in models.Extra_name.objects.filter(
+				runner__birthday_known=True, runner__birthday__in=birthdays_chunk).values_list('runner_id', 'lname', 'fname', 'midname', 'runner__birthday'):
+			index[name_birthday_key(lname, fname, birthday)].append((runner_id, models.fold_name_for_comparison(midname)))
+	return index
+
+# The same as get_runners_by_name_and_birthday but returns only the ids and uses the index.
+def find_runner_ids_by_name_and_birthday(index: NameBirthdayIndex, lname: str, fname: str, midname: str, birthday: datetime.date) -> Set[int]:
+	midname = models.fold_name_for_comparison(midname)
+	return set(runner_id for runner_id, runner_midname in index.get(name_birthday_key(lname, fname, birthday), [])
+		if (not midname) or (runner_midname in ('', midname)))
+
 def get_new_results_text(results_by_race):
 	res = ''
 	n_results = 0
@@ -134,36 +171,62 @@ def attach_results_with_birthday(robot, admin, debug=False):
 	mail_body = ''
 	mail_errors = ''
 	mail_summary = ''
-	name_birthday_tuples = set(models.Result.objects.filter(runner=None, birthday_known=True, source=models.RESULT_SOURCE_DEFAULT, bib_given_to_unknown=False).exclude(
-		lname='').exclude(fname='').values_list('lname', 'fname', 'midname', 'birthday'))
+	result_ids_by_tuple = defaultdict(list)
+	for result_id, lname, fname, midname, birthday in models.Result.objects.filter(runner=None, birthday_known=True, source=models.RESULT_SOURCE_DEFAULT,
+			bib_given_to_unknown=False).exclude(lname='').exclude(fname='').values_list('id', 'lname', 'fname', 'midname', 'birthday'):
+		result_ids_by_tuple[(lname, fname, midname, birthday)].append(result_id)
 	if debug:
-		print('Different tuples:', len(name_birthday_tuples))
-	mail_header = (f'\nСегодня у нас {len(name_birthday_tuples)} различных наборов (ФИО, дата рождения) у результатов,'
+		print('Different tuples:', len(result_ids_by_tuple))
+	mail_header = (f'\nСегодня у нас {len(result_ids_by_tuple)} различных наборов (ФИО, дата рождения) у результатов,'
 			+ ' не присоединённых ни к какому бегуну.')
-	for lname, fname, midname, birthday in sorted(name_birthday_tuples):
-		if n_results > 999:
-			break
-		runners = get_runners_by_name_and_birthday(lname, fname, midname, birthday)
-		runners_count = runners.count()
-		if runners_count > 1:
-			mail_errors += (f'\nЕсть больше одного бегуна {lname} {fname} {midname} {birthday.isoformat()}. Непонятно, к кому присоединять такие результаты. '
-				+ results_util.SITE_URL + results_util.reverse_runners_by_name(lname, fname))
-			if len(mail_errors) > 5000:
-				break
-		elif runners_count == 1:
-			runner = runners[0]
-			for result in models.Result.objects.filter(runner=None, birthday_known=True, source=models.RESULT_SOURCE_DEFAULT,
-					lname=lname, fname=fname, midname=midname, birthday=birthday, bib_given_to_unknown=False).select_related('race__event'):
+
+	index = build_name_birthday_index(birthday for _, _, _, birthday in result_ids_by_tuple)
+	runner_id_by_result_id = {}
+	for lname, fname, midname, birthday in sorted(result_ids_by_tuple):
+		runner_ids = find_runner_ids_by_name_and_birthday(index, lname, fname, midname, birthday)
+		if len(runner_ids) > 1:
+			if len(mail_errors) <= 5000:
+				mail_errors += (f'\nЕсть больше одного бегуна {lname} {fname} {midname} {birthday.isoformat()}. Непонятно, к кому присоединять такие результаты. '
+					+ results_util.SITE_URL + results_util.reverse_runners_by_name(lname, fname))
+		elif len(runner_ids) == 1:
+			runner_id = runner_ids.pop()
+			for result_id in result_ids_by_tuple[(lname, fname, midname, birthday)]:
+				runner_id_by_result_id[result_id] = runner_id
+	if debug:
+		print('Results to attach:', len(runner_id_by_result_id))
+
+	runners = models.Runner.objects.select_related('user__user_profile', 'klb_person').in_bulk(set(runner_id_by_result_id.values()))
+	klb_person_ids = set(runner.klb_person_id for runner in runners.values() if runner.klb_person_id)
+	klb_participants = {}
+	klb_person_event_pairs = set()
+	if klb_person_ids:
+		for participant in models.Klb_participant.objects.filter(klb_person_id__in=klb_person_ids):
+			klb_participants[(participant.klb_person_id, participant.year)] = participant
+		klb_person_event_pairs = set(models.Klb_result.objects.filter(klb_person_id__in=klb_person_ids).values_list('klb_person_id', 'race__event_id'))
+
+	result_ids = list(runner_id_by_result_id)
+	for i in range(0, len(result_ids), RESULTS_PER_QUERY):
+		result_ids_chunk = result_ids[i:i + RESULTS_PER_QUERY]
+		result_ids_with_mail = set(models.Result_for_mail.objects.filter(result_id__in=result_ids_chunk, is_sent=False).values_list('result_id', flat=True))
+		results_to_update = []
+		results_for_mail = []
+		now = timezone.now()
+		with models.Audit_log_buffer(): # All log records of the chunk are saved with a few queries
+			# A result could be attached to someone since we selected it.
+			for result in models.Result.objects.filter(pk__in=result_ids_chunk, runner=None).select_related('race__event'):
 				n_results += 1
+				runner = runners[runner_id_by_result_id[result.id]]
 				race = result.race
 				event = race.event
 				event_date = event.start_date
 				result.runner = runner
+				result.last_update = now # bulk_update doesn't set auto_now fields, and the incremental DB checks rely on this one.
 				field_list = ['runner']
 				comment = ''
 				if runner.user:
 					result.user = runner.user
-					result.add_for_mail()
+					if (result.status == models.STATUS_FINISHED) and (result.id not in result_ids_with_mail):
+						results_for_mail.append(models.Result_for_mail(user=runner.user, result=result))
 					field_list.append('user')
 					n_results_with_user += 1
 					user_url = ''
@@ -177,16 +240,16 @@ def attach_results_with_birthday(robot, admin, debug=False):
 					runner.save()
 					models.log_obj_create(robot, runner, models.ACTION_UPDATE, field_list=['midname'],
 						comment='Автоматически при добавлении результата с id {}'.format(result.id), verified_by=admin)
-				result.save()
+				results_to_update.append(result)
 				touched_runners.add(runner)
 				is_for_klb = False
 				klb_participant = None
 				if runner.klb_person and models.is_active_klb_year(event_date.year):
-					klb_participant = runner.klb_person.klb_participant_set.filter(year=event_date.year).first()
+					klb_participant = klb_participants.get((runner.klb_person_id, event_date.year))
 				if klb_participant and (result.get_klb_status() == models.KLB_STATUS_OK) \
 						and ( (klb_participant.date_registered == None) or (klb_participant.date_registered <= event_date) ) \
 						and ( (klb_participant.date_removed == None) or (klb_participant.date_removed >= event_date) ) \
-						and not runner.klb_person.klb_result_set.filter(race__event=event).exists():
+						and ((runner.klb_person_id, event.id) not in klb_person_event_pairs):
 					is_for_klb = True
 				models.log_obj_create(robot, event, models.ACTION_RESULT_UPDATE, field_list=field_list,
 					child_object=result, comment='Автоматически по имени и дате рождения', is_for_klb=is_for_klb,
@@ -194,15 +257,21 @@ def attach_results_with_birthday(robot, admin, debug=False):
 				if is_for_klb:
 					n_results_for_klb += 1
 					comment += ' Добавляем результат в КЛБМатч.'
-				if result.place_gender == 1:
-					race.fill_winners_info()
-					n_winners_touched += 1
-				if race not in new_results_by_race:
-					new_results_by_race[race] = []
-				new_results_by_race[race].append((result, runner, comment))
+				if n_results <= MAX_RESULTS_IN_LETTER:
+					if race not in new_results_by_race:
+						new_results_by_race[race] = []
+					new_results_by_race[race].append((result, runner, comment))
+			models.Result.objects.bulk_update(results_to_update, ['runner', 'user', 'last_update'])
+			models.Result_for_mail.objects.bulk_create(results_for_mail)
+		for result in results_to_update:
+			if result.place_gender == 1:
+				result.race.fill_winners_info()
+				n_winners_touched += 1
 	runner_stat.update_runners_and_users_stat(touched_runners)
 	if n_results:
 		mail_body = '\n\nПрисоединяем следующие результаты с датой рождения к бегунам:\n\n' + get_new_results_text(new_results_by_race)
+		if n_results > MAX_RESULTS_IN_LETTER:
+			mail_body += f'\n…и ещё {n_results - MAX_RESULTS_IN_LETTER} результатов.\n'
 		mail_summary += (f'\n\nИтого присоединено результатов: {n_results}. В том числе:\n'
 			+ f'Отправлены на модерацию в КЛБМатч: {n_results_for_klb}.\nПривязаны к пользователям: {n_results_with_user}.')
 		if n_midnames_filled:
@@ -248,12 +317,12 @@ def create_new_runners_with_birthdays(robot, admin, debug=False):
 	name_birthday_tuples_counter = Counter([(a.lower(), b.lower(), c) for a, b, c in free_official_results.exclude(
 		lname='').exclude(fname='').values_list('lname', 'fname', 'birthday')])
 	name_birthday_tuples = set([k for k, v in list(name_birthday_tuples_counter.items()) if (v > 1)])
-	runner_tuples = set([(a.lower(), b.lower(), c) for a, b, c in models.Runner.objects.filter(birthday_known=True).values_list(
-		'lname', 'fname', 'birthday')])
+	# Runners (or their extra names) with these names and birthdays already exist. If they are unique, attach_results_with_birthday attaches the results.
+	index = build_name_birthday_index(birthday for _, _, birthday in name_birthday_tuples)
 	n_good_tuples = n_similar_runnes_errors = n_errors_unknown_gender = 0
 	report_success = ''
 	report_errors = ''
-	for lname, fname, birthday in sorted(name_birthday_tuples - runner_tuples):
+	for lname, fname, birthday in sorted(key for key in name_birthday_tuples if key not in index):
 		if n_good_tuples >= 100:
 			break
 		results = free_official_results.filter(lname=lname, fname=fname, birthday=birthday)
@@ -299,12 +368,13 @@ def create_new_runners_with_birthdays(robot, admin, debug=False):
 			)
 		models.log_obj_create(robot, runner, models.ACTION_CREATE, comment='Создание нового бегуна по дате рождения', verified_by=admin)
 		n_results_touched = 0
-		for result in list(results):
-			n_results_touched += 1
-			result.runner = runner
-			result.save()
-			models.log_obj_create(robot, result.race.event, models.ACTION_RESULT_UPDATE, field_list=['runner'], child_object=result,
-				comment='Создание нового бегуна по дате рождения', verified_by=admin)
+		with models.Audit_log_buffer():
+			for result in list(results):
+				n_results_touched += 1
+				result.runner = runner
+				result.save()
+				models.log_obj_create(robot, result.race.event, models.ACTION_RESULT_UPDATE, field_list=['runner'], child_object=result,
+					comment='Создание нового бегуна по дате рождения', verified_by=admin)
 		runner_stat.update_runner_stat(runner=runner)
 		n_good_tuples += 1
 		mail_body += (f'\n{n_good_tuples}. {results_util.SITE_URL}{runner.get_absolute_url()} — {runner.get_lname_fname()} '
@@ -428,12 +498,15 @@ def mark_old_payments_as_inactive():
 		return '\n\nНеоплаченных платежей помечено как неактивные: {}, затронуто участников КЛБМатча: {}'.format(n_payments_marked, n_participants_marked)
 	return ''
 
-def get_db_checks_report():
+FULL_DB_CHECKS_WEEKDAY = 6 # On Sundays we check all rows; on other days, only the changed ones.
+def get_db_checks_report(full: Optional[bool]=None):
 	logger = logging.getLogger('dbchecks')
+	if full is None:
+		full = datetime.date.today().weekday() == FULL_DB_CHECKS_WEEKDAY
 
 	res = ''
 	# Checking ForeignKeys and OneToOneFields #
-	for model_name, data in list(dbchecks.check_all_relationships2(logger).items()):
+	for model_name, data in list(dbchecks_incremental.check_all_relationships(full=full, logger=logger).items()):
 		res += '\n\nЗаписи в таблице {} с некорректными ссылками на другие таблицы: {}, {}'.format(model_name, data[0][0], data[0][1])
 		res += '\nЗапрос, который их выдаёт: {}'.format(data[1])
 
@@ -448,7 +521,7 @@ def get_db_checks_report():
 		(models.Klb_result, 'klb_person__runner__id', 'result__runner_id', set(models.Klb_result.objects.filter(is_error=True).values_list('pk', flat=True))),
 	]
 
-	for model_name, data in list(dbchecks.check_equality_by_list(check_list, logger).items()):
+	for model_name, data in list(dbchecks_incremental.check_equality_by_list(check_list, full=full, logger=logger).items()):
 		res += '\n\nРасхождения в значениях полей {} — всего {}. Первые:'.format(model_name, data[0])
 		for i, item in enumerate(data[1][:5]):
 			res += '\n{}. '.format(i + 1)
@@ -8,6 +8,8 @@ import os
 import io
 from PIL import Image
 import re
+import threading
+import unicodedata
 from typing import Any, Dict, List, Optional, Tuple
 
 from django.conf import settings
@@ -18,9 +20,9 @@ from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.mail import EmailMultiAlternatives, send_mail
 from django.core.validators import validate_email, MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Q, F, Max, Count
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.forms import SplitDateTimeField
 from django.urls import reverse
@@ -28,7 +30,7 @@ from django.utils import timezone
 
 
 from . import custom_fields
-from . import links, models_klb, results_util
+from . import links, models_klb, page_cache, results_util
 from .transliteration_v5 import transliterate
 
 import starrating.aggr.race_deletion
@@ -386,6 +388,7 @@ class Region(models.Model):
 	name_orig = models.CharField(verbose_name='Название на языке страны, где находится', max_length=100, default='')
 	is_active = models.BooleanField(verbose_name='Существует ли сейчас', default=True)
 	population = models.IntegerField(verbose_name='Население', default=None, null=True)
+	index_in_country = models.SmallIntegerField(verbose_name='Номер бита в Runner_regions.regions', default=None, null=True)
 	class Meta:
 		constraints = [
 			models.UniqueConstraint(fields=['country', 'name'], name='region_country_name'),
@@ -1286,6 +1289,7 @@ class Race(models.Model):
 		self.winner_nonbinary = results.filter(gender=results_util.GENDER_NONBINARY, is_improbable=False).exclude(place_gender=None).order_by('place_gender', 'lname', 'fname').first()
 		if to_save:
 			self.save()
+			Rating_table.mark_dirty_for_race(self)
 	def get_men_percent(self):
 		if self.n_participants_finished and self.n_participants_finished_male:
 			return min(100, int(self.n_participants_finished_male * 100 / self.n_participants_finished))
@@ -1419,6 +1423,47 @@ class Race(models.Model):
 	def delete(self, *args, **kwargs):
 		starrating.aggr.race_deletion.delete_race_and_ratings(self, *args, **kwargs)
 
+# A precomputed page of results:rating for given country ('' for all countries), distance, year (0 for all years) and rating type.
+# The rows are in Rating_position. editor/rating_tables.py rebuilds the tables marked as dirty.
+class Rating_table(models.Model):
+	country_id = models.CharField(verbose_name='Страна (пусто — все страны)', max_length=3, blank=True)
+	distance_id = models.IntegerField(verbose_name='id дистанции или results_util.DISTANCE_ANY/DISTANCE_WHOLE_EVENTS')
+	year = models.SmallIntegerField(verbose_name='Год (0 — все годы)')
+	rating_type = models.SmallIntegerField(verbose_name='Тип рейтинга')
+	n_entries = models.IntegerField(verbose_name='Число строк в рейтинге', default=None, null=True)
+	is_dirty = models.BooleanField(verbose_name='Нужно ли пересчитать', default=True, db_index=True)
+	last_update = models.DateTimeField(verbose_name='Время последнего пересчёта', default=None, null=True)
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['country_id', 'distance_id', 'year', 'rating_type'], name='rating_table_key'),
+		]
+	def is_built(self) -> bool:
+		return self.n_entries is not None
+	# Marks all the tables that may contain the race or its event. They will be rebuilt on the next update.
+	@classmethod
+	def mark_dirty_for_race(cls, race):
+		event = race.event
+		city = event.city if event.city_id else event.series.city
+		country_ids = ['']
+		if city:
+			country_ids.append(city.region.country_id)
+		cls.objects.filter(
+			country_id__in=country_ids,
+			distance_id__in=(race.distance_id, results_util.DISTANCE_ANY, results_util.DISTANCE_WHOLE_EVENTS),
+			year__in=(0, event.start_date.year),
+			is_dirty=False,
+		).update(is_dirty=True)
+
+class Rating_position(models.Model):
+	table = models.ForeignKey(Rating_table, verbose_name='Рейтинг', on_delete=models.CASCADE)
+	position = models.IntegerField(verbose_name='Место в рейтинге, начиная с 1')
+	object_id = models.IntegerField(verbose_name='id забега, дистанции или результата')
+	value = models.IntegerField(verbose_name='Значение, по которому упорядочен рейтинг')
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['table', 'position'], name='rating_position_table_position'),
+		]
+
 MAX_CATEGORY_LENGTH = 100
 # We extract the category of a result to a separate model to store here the number of finishers for each category.
 class Category_size(models.Model):
@@ -1586,6 +1631,107 @@ class Extra_name(models.Model):
 		res += ' ' + self.lname
 		return res
 
+NAME_FIELDS = ('lname', 'fname', 'midname')
+
+# Lowercase, 'ё' -> 'е'. Runner_search_name stores names in this form, and search queries should be normalized the same way.
+def normalize_name_for_search(name: str) -> str:
+	return name.strip().lower().replace('ё', 'е')
+
+# Folds the name about as the utf8mb4_ru_0900_ai_ci collation of name columns compares them: ignoring case and accents.
+# Only 'й' stays a separate letter there.
+def fold_name_for_comparison(name: str) -> str:
+	return ''.join(char if (char == 'й') else ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+		for char in normalize_name_for_search(name))
+
+# Returns the (word1, word2, midname) rows for Runner_search_name for given (lname, fname, midname) tuples.
+def search_name_rows(names) -> set[Tuple[str, str, str]]:
+	rows = set()
+	for lname, fname, midname in names:
+		variants = [tuple(normalize_name_for_search(x) for x in (lname, fname, midname))]
+		if re.search('[а-я]', ''.join(variants[0])):
+			variants.append(tuple(transliterate(x).lower() for x in variants[0]))
+		for lname, fname, midname in variants:
+			for word1, word2 in ((lname, fname), (fname, lname)):
+				if word1:
+					rows.add((word1[:MAX_SEARCH_NAME_LENGTH], word2[:MAX_SEARCH_NAME_LENGTH], midname[:MAX_SEARCH_NAME_LENGTH]))
+	return rows
+
+MAX_SEARCH_NAME_LENGTH = 100
+RUNNERS_PER_SEARCH_NAMES_BATCH = 10000
+class Runner_search_name(models.Model):
+	""" Нормализованные имена бегунов для поиска по началу фамилии и имени: основное и все дополнительные имена,
+	в порядках «фамилия имя» и «имя фамилия», а для кириллических имён — ещё и в транслитерации """
+	runner = models.ForeignKey('Runner', verbose_name='Бегун', on_delete=models.CASCADE)
+	word1 = models.CharField(verbose_name='Первое слово', max_length=MAX_SEARCH_NAME_LENGTH)
+	word2 = models.CharField(verbose_name='Второе слово', max_length=MAX_SEARCH_NAME_LENGTH, blank=True)
+	midname = models.CharField(verbose_name='Отчество', max_length=MAX_SEARCH_NAME_LENGTH, blank=True)
+	class Meta:
+		indexes = [
+			models.Index(fields=['word1', 'word2', 'midname', 'runner']),
+		]
+	# Finds the runners whose some name starts with word1 and, if given, word2 in any order.
+	# If midname is given, the name's midname must be either empty or start with it.
+	# On MySQL, startswith is LIKE BINARY that ignores the collation and can't use the index for the ranges, so we use istartswith.
+	@classmethod
+	def matching(cls, word1: str, word2: str='', midname: str=''):
+		names = cls.objects.filter(word1__istartswith=normalize_name_for_search(word1))
+		if word2:
+			names = names.filter(word2__istartswith=normalize_name_for_search(word2))
+		if midname:
+			names = names.filter(Q(midname='') | Q(midname__istartswith=normalize_name_for_search(midname)))
+		return names
+	# Makes the runner's rows correspond to their current names.
+	@classmethod
+	def update_for_runner(cls, runner_id: int):
+		names = list(Runner.objects.filter(pk=runner_id).values_list(*NAME_FIELDS))
+		names += list(Extra_name.objects.filter(runner_id=runner_id).values_list(*NAME_FIELDS))
+		rows = search_name_rows(names)
+		existing = {}
+		for row_id, word1, word2, midname in cls.objects.filter(runner_id=runner_id).values_list('id', 'word1', 'word2', 'midname'):
+			existing[(word1, word2, midname)] = row_id
+		to_delete = [row_id for row, row_id in existing.items() if row not in rows]
+		if to_delete:
+			cls.objects.filter(pk__in=to_delete).delete()
+		cls.objects.bulk_create([cls(runner_id=runner_id, word1=word1, word2=word2, midname=midname)
+			for word1, word2, midname in rows if (word1, word2, midname) not in existing])
+	# Creates the rows for runners just created with bulk_create that doesn't send post_save. They must already have ids
+	# and no extra names yet.
+	@classmethod
+	def bulk_create_for_runners(cls, runners: List['Runner']):
+		cls.objects.bulk_create([cls(runner_id=runner.id, word1=word1, word2=word2, midname=midname)
+			for runner in runners for word1, word2, midname in search_name_rows([(runner.lname, runner.fname, runner.midname)])],
+			batch_size=5000)
+	# Recreates the rows for all runners, RUNNERS_PER_SEARCH_NAMES_BATCH runners at a time.
+	@classmethod
+	def rebuild(cls, debug: bool=False) -> int:
+		n_rows = 0
+		max_id = Runner.objects.aggregate(Max('id'))['id__max'] or 0
+		for id_from in range(0, max_id + 1, RUNNERS_PER_SEARCH_NAMES_BATCH):
+			id_range = (id_from, id_from + RUNNERS_PER_SEARCH_NAMES_BATCH - 1)
+			names_by_runner = {}
+			for runner_id, lname, fname, midname in Runner.objects.filter(pk__range=id_range).values_list('id', *NAME_FIELDS):
+				names_by_runner[runner_id] = [(lname, fname, midname)]
+			for runner_id, lname, fname, midname in Extra_name.objects.filter(runner_id__range=id_range).values_list('runner_id', *NAME_FIELDS):
+				if runner_id in names_by_runner:
+					names_by_runner[runner_id].append((lname, fname, midname))
+			rows = [cls(runner_id=runner_id, word1=word1, word2=word2, midname=midname)
+				for runner_id, names in names_by_runner.items() for word1, word2, midname in search_name_rows(names)]
+			with transaction.atomic():
+				cls.objects.filter(runner_id__range=id_range).delete()
+				cls.objects.bulk_create(rows, batch_size=5000)
+			n_rows += len(rows)
+			if debug:
+				print(f'{datetime.datetime.now()} Runners up to id {id_range[1]} are processed, {n_rows} rows created')
+		return n_rows
+
+# On commit: when a runner is deleted, its extra names are deleted before the runner itself,
+# and by then we don't need to create rows for it anymore.
+@receiver(post_save, sender=Extra_name)
+@receiver(post_delete, sender=Extra_name)
+def update_search_names_for_extra_name(sender, instance, **kwargs):
+	runner_id = instance.runner_id
+	transaction.on_commit(lambda: Runner_search_name.update_for_runner(runner_id))
+
 AVATAR_SIZE = (200, 400)
 def avatar_name(instance, filename):
 	new_name = 'dj_media/avatar/' + str(instance.user.id) + '.' + file_extension(filename)
@@ -1837,6 +1983,7 @@ class Table_update(models.Model):
 			models.Index(fields=['user', 'added_time', 'action_type', 'model_name']),
 			models.Index(fields=['verified_by', 'added_time', 'action_type', 'model_name']),
 			models.Index(fields=['row_id', 'is_verified', 'action_type']),
+			models.Index(fields=['model_name', 'added_time']),
 		]
 	def append_comment(self, comment):
 		if comment:
@@ -1872,6 +2019,104 @@ class Field_update(models.Model):
 	field_name = models.CharField(verbose_name='Название изменённого поля', max_length=40)
 	new_value = models.CharField(verbose_name='Новое значение поля', max_length=MAX_VALUE_LENGTH, blank=True)
 
+# The state of one check from dbchecks/incremental.py between runs.
+class Db_check_state(models.Model):
+	name = models.CharField(verbose_name='Проверка', max_length=250, unique=True)
+	watermark = models.DateTimeField(verbose_name='Начало последнего запуска; следующий проверит строки, изменённые после него',
+		default=None, null=True)
+	next_pk = models.BigIntegerField(verbose_name='С какого id проверять строки таблиц, где не видно изменений', default=0)
+	last_full_run = models.DateTimeField(verbose_name='Время последней полной проверки', default=None, null=True)
+	duration = models.FloatField(verbose_name='Длительность последнего запуска, с', default=0)
+	n_errors = models.IntegerField(verbose_name='Число ошибок при последнем запуске', default=0)
+	def __str__(self):
+		return self.name
+
+AUDIT_LOG_CHUNK_SIZE = 1000
+
+# Inserts objs to the DB with one query per chunk_size objects and fills their ids.
+# Django's bulk_create doesn't fill them on MySQL, but InnoDB gives consecutive ids to all rows
+# of one multi-row INSERT, and LAST_INSERT_ID() returns the first of them.
+def bulk_create_with_ids(model, objs: list, chunk_size: int=AUDIT_LOG_CHUNK_SIZE):
+	for start in range(0, len(objs), chunk_size):
+		chunk = objs[start:start + chunk_size]
+		model.objects.bulk_create(chunk, batch_size=len(chunk))
+		if connection.features.can_return_rows_from_bulk_insert:
+			continue
+		with connection.cursor() as cursor:
+			cursor.execute('SELECT LAST_INSERT_ID()')
+			first_id = cursor.fetchone()[0]
+		for i, obj in enumerate(chunk):
+			obj.pk = first_id + i
+
+# Collects everything log_obj_create and log_obj_delete write and saves it with a few bulk queries on exit.
+# Use it around loops that log many objects:
+# with Audit_log_buffer():
+# 	for runner in runners:
+# 		log_obj_create(...)
+# Nested buffers just pass everything to the outermost one.
+# If an exception leaves the block, nothing is written: the logged changes are often saved only at the end of the block.
+class Audit_log_buffer:
+	_local = threading.local()
+	def __init__(self):
+		self.table_updates = [] # Pairs (Table_update without id, list of pairs (field name, new value))
+		self.strike_queue_keys = set() # Pairs (series_id, distance_id)
+		self.page_keys = set() # Keys of outdated cached pages
+		self.objs_to_invalidate = {} # (class, id) -> event or race; we look for their pages only once on flush
+	@classmethod
+	def current(cls) -> Optional['Audit_log_buffer']:
+		return getattr(cls._local, 'buffer', None)
+	def __enter__(self):
+		self.is_outermost = self.current() is None
+		if self.is_outermost:
+			self._local.buffer = self
+		return self.current()
+	def __exit__(self, exc_type, exc_value, traceback):
+		if self.is_outermost:
+			self._local.buffer = None
+			if exc_type is None:
+				self.flush()
+		return False
+	def add(self, table_update, fields: list[tuple[str, str]], strike_queue_key: Optional[tuple[int, int]], objs: list[Any],
+			created: bool=False):
+		self.table_updates.append((table_update, fields))
+		if strike_queue_key:
+			self.strike_queue_keys.add(strike_queue_key)
+		for obj in objs:
+			if created and (obj is not None):
+				self.page_keys.update(get_public_page_keys(obj, created=True))
+			elif isinstance(obj, (Event, Race)) and obj.id:
+				self.objs_to_invalidate[(obj.__class__, obj.id)] = obj
+			elif obj is not None:
+				self.page_keys.update(get_public_page_keys(obj)) # Doesn't need DB queries for other objects
+	def flush(self):
+		if self.table_updates:
+			bulk_create_with_ids(Table_update, [table_update for table_update, _ in self.table_updates])
+			Field_update.objects.bulk_create([Field_update(table_update_id=table_update.id, field_name=field_name, new_value=new_value)
+				for table_update, fields in self.table_updates for field_name, new_value in fields], batch_size=AUDIT_LOG_CHUNK_SIZE)
+		if self.strike_queue_keys:
+			Strike_queue.objects.bulk_create([Strike_queue(series_id=series_id, distance_id=distance_id)
+				for series_id, distance_id in self.strike_queue_keys], ignore_conflicts=True)
+		page_cache.invalidate(self.page_keys.union(get_public_page_keys(*self.objs_to_invalidate.values())))
+		self.table_updates = []
+		self.strike_queue_keys = set()
+		self.page_keys = set()
+		self.objs_to_invalidate = {}
+
+# Writes the row to Table_update and its fields to Field_update, or passes them to the current Audit_log_buffer.
+# created means that objs were just created; see get_public_page_keys.
+def save_log_record(table_update, fields: list[tuple[str, str]], strike_queue_key: Optional[tuple[int, int]], objs: list[Any],
+		created: bool=False):
+	buffer = Audit_log_buffer.current()
+	if buffer:
+		buffer.add(table_update, fields, strike_queue_key, objs, created)
+		return
+	table_update.save()
+	Field_update.objects.bulk_create([Field_update(table_update=table_update, field_name=field_name, new_value=new_value)
+		for field_name, new_value in fields])
+	if strike_queue_key:
+		Strike_queue.objects.get_or_create(series_id=strike_queue_key[0], distance_id=strike_queue_key[1])
+	page_cache.invalidate(get_public_page_keys(*objs, created=created))
+
 # Manual creation for unofficial series and result, for result claim
 def log_obj_create(user, obj, action, field_list: Optional[list[str]]=None, child_object: Any=None, comment='', verified_by=None):
 	child_id = child_object.id if child_object else None
@@ -1880,29 +2125,58 @@ def log_obj_create(user, obj, action, field_list: Optional[list[str]]=None, chil
 		is_verified = True
 	else:
 		is_verified = is_admin(user)
-	table_update = Table_update.objects.create(model_name=obj.__class__.__name__, child_id=child_id,
+	table_update = Table_update(model_name=obj.__class__.__name__, child_id=child_id,
 		row_id=obj.id, action_type=action, user=user, is_verified=is_verified, verified_by=verified_by)
 	log_empty_fields = True
 	if field_list is None:
 		log_empty_fields = False # We log them only if the field_set is provided
 		field_list = [f.name for f in obj_with_attrs.__class__._meta.get_fields()]
+	fields = []
 	for field in field_list:
 		if hasattr(obj_with_attrs, field) and (log_empty_fields or getattr(obj_with_attrs, field)):
-			Field_update.objects.create(table_update=table_update, field_name=field,
-				new_value=str(getattr(obj_with_attrs, field))[:MAX_VALUE_LENGTH])
+			fields.append((field, str(getattr(obj_with_attrs, field))[:MAX_VALUE_LENGTH]))
 	if comment:
-		Field_update.objects.create(table_update=table_update, field_name=UPDATE_COMMENT_FIELD_NAME,
-			new_value=comment[:MAX_VALUE_LENGTH])
+		fields.append((UPDATE_COMMENT_FIELD_NAME, comment[:MAX_VALUE_LENGTH]))
+	strike_queue_key = None
 	if (action == ACTION_RESULT_UPDATE) and ('runner' in field_list):
-		Strike_queue.objects.get_or_create(series_id=obj.series_id, distance_id=child_object.race.distance_id)
+		strike_queue_key = (obj.series_id, child_object.race.distance_id)
+	save_log_record(table_update, fields, strike_queue_key, [obj, child_object], created=(action == ACTION_CREATE) and (child_object is None))
 def log_obj_delete(user, obj, child_object=None, action_type=ACTION_DELETE, comment='', verified_by=None):
 	child_id = child_object.id if child_object else None
 	is_verified = (verified_by is not None) or is_admin(user)
-	table_update = Table_update.objects.create(model_name=obj.__class__.__name__, row_id=obj.id, action_type=action_type,
+	table_update = Table_update(model_name=obj.__class__.__name__, row_id=obj.id, action_type=action_type,
 		user=user, is_verified=is_verified, verified_by=verified_by, child_id=child_id)
-	if comment:
-		Field_update.objects.create(table_update=table_update, field_name=UPDATE_COMMENT_FIELD_NAME,
-			new_value=comment[:MAX_VALUE_LENGTH])
+	fields = [(UPDATE_COMMENT_FIELD_NAME, comment[:MAX_VALUE_LENGTH])] if comment else []
+	save_log_record(table_update, fields, None, [obj, child_object])
+
+# Returns the keys of the cached pages of the changed objects and of the pages that show them.
+# If created, the objects were just created: there can't be cached pages of them yet, only of the pages that show them.
+# Objects of other models are not shown on cached pages.
+def get_public_page_keys(*objs, created: bool=False) -> list[page_cache.ObjectKey]:
+	keys = []
+	for obj in objs:
+		if isinstance(obj, Series):
+			if not created:
+				keys.append((page_cache.OBJECT_SERIES, obj.id))
+		elif isinstance(obj, Event):
+			keys.append((page_cache.OBJECT_SERIES, obj.series_id))
+			if obj.id and not created:
+				keys.append((page_cache.OBJECT_EVENT, obj.id))
+				keys += [(page_cache.OBJECT_RACE, race_id) for race_id in Race.objects.filter(event_id=obj.id).values_list('id', flat=True)]
+		elif isinstance(obj, Race):
+			keys += [(page_cache.OBJECT_EVENT, obj.event_id),
+				(page_cache.OBJECT_SERIES, Event.objects.filter(pk=obj.event_id).values_list('series_id', flat=True).first())]
+			if not created:
+				keys.append((page_cache.OBJECT_RACE, obj.id))
+		elif isinstance(obj, Result):
+			keys += [(page_cache.OBJECT_RACE, obj.race_id), (page_cache.OBJECT_RUNNER, obj.runner_id)]
+		elif isinstance(obj, Runner):
+			if not created:
+				keys.append((page_cache.OBJECT_RUNNER, obj.id))
+	return keys
+
+def invalidate_public_pages(*objs):
+	page_cache.invalidate(get_public_page_keys(*objs))
 
 STATUS_FINISHED = 0
 STATUS_DNF = 1
@@ -2558,7 +2832,7 @@ DOCUMENT_SUFFIXES = {
 	DOC_TYPE_REGISTRATION: 'Re',
 }
 DOC_PROTOCOL_TYPES = (DOC_TYPE_PROTOCOL, DOC_TYPE_PRELIMINARY_PROTOCOL)
-Q_IS_XLS_FILE = Q(upload__iendswith='.xls') | Q(upload__iendswith='.xlsx')
+Q_IS_XLS_FILE = Q(upload__iendswith='.xls') | Q(upload__iendswith='.xlsx') | Q(upload__iendswith='.xlsm') | Q(upload__iendswith='.csv')
 DOC_TYPES_NOT_FOR_RIGHT_COLUMN = (DOC_TYPE_UNKNOWN, DOC_TYPE_LOGO, DOC_TYPE_PHOTOS, DOC_TYPE_IMPRESSIONS)
 MAX_EVENT_NAME_LENGTH = 20
 def create_document_file_name(date, suffix, name, city_name, series_id, extension, sample=None):
@@ -2714,7 +2988,7 @@ class Document(models.Model):
 		self.save()
 		log_obj_create(user, self.event, ACTION_DOCUMENT_UPDATE, field_list=['is_processed'], child_object=self, comment=comment)
 	def is_xls(self):
-		return self.upload and self.upload.name.lower().endswith(('.xls', '.xlsx'))
+		return self.upload and self.upload.name.lower().endswith(('.xls', '.xlsx', '.xlsm', '.csv'))
 	def is_xls_protocol(self):
 		return self.is_xls() and (self.document_type in DOC_PROTOCOL_TYPES)
 	def is_eligible_for_queue(self):
@@ -3354,6 +3628,10 @@ class Runner(models.Model):
 			or (self.klb_person is not None) or (self.user is not None)
 	def __str__(self):
 		return get_name(self)
+@receiver(post_save, sender=Runner)
+def update_search_names_for_runner(sender, instance, update_fields=None, **kwargs):
+	if (update_fields is None) or set(update_fields) & set(NAME_FIELDS):
+		Runner_search_name.update_for_runner(instance.id)
 
 # A link to some article about given runner.
 class Runner_link(models.Model):
@@ -3991,6 +4269,19 @@ class Function_call(models.Model):
 	def __str__(self):
 		return f'{self.name}({self.args})'
 
+# A run of runner_stat.update_runners_stat_parallel. We store its progress to continue it if the run was killed.
+class Runners_stat_job(models.Model):
+	reset_cur_year_stat = models.BooleanField(verbose_name='Обнулялась ли статистика за текущий год', default=False)
+	id_done = models.BigIntegerField(verbose_name='Все бегуны с меньшими id уже обработаны', default=0)
+	n_runners = models.IntegerField(verbose_name='Число обработанных бегунов', default=0)
+	start_time = models.DateTimeField(verbose_name='Время запуска', auto_now_add=True)
+	last_update = models.DateTimeField(verbose_name='Время последнего обновления', auto_now=True)
+	finish_time = models.DateTimeField(verbose_name='Время завершения', default=None, null=True, blank=True, db_index=True)
+	class Meta:
+		verbose_name = 'Пересчёт статистики всех бегунов'
+	def __str__(self):
+		return f'Runners_stat_job {self.id}: done up to runner id {self.id_done}'
+
 COURSE_CERTIFICATE_GRADES = (
 	(1, 'A'),
 	(2, 'B'),
@@ -4104,6 +4395,36 @@ class Series_distance_data(models.Model):
 			models.UniqueConstraint(fields=['series', 'distance'], name='distance_data_series_distance'),
 		]
 
+# For incremental strike updates: the events of (series, distance) in the order of their dates,
+# as they were at the last update. Bit i of Strike_bitmap.events refers to the i-th of them.
+class Strike_state(models.Model):
+	series = models.ForeignKey(Series, verbose_name='Серия', on_delete=models.CASCADE)
+	distance = models.ForeignKey(Distance, verbose_name='Дистанция', on_delete=models.CASCADE)
+	event_ids = models.TextField(verbose_name='id забегов через запятую в порядке дат', default='')
+	watermark = models.DateTimeField(verbose_name='Начало последнего пересчёта')
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['series', 'distance'], name='strike_state_series_distance'),
+		]
+	def get_event_ids(self) -> list[int]:
+		return [int(event_id) for event_id in self.event_ids.split(',')] if self.event_ids else []
+	def set_event_ids(self, event_ids: list[int]):
+		self.event_ids = ','.join(str(event_id) for event_id in event_ids)
+
+# All participations of one runner in the events of (series, distance), for all runners with at least one of them.
+class Strike_bitmap(models.Model):
+	series = models.ForeignKey(Series, verbose_name='Серия', on_delete=models.CASCADE)
+	distance = models.ForeignKey(Distance, verbose_name='Дистанция', on_delete=models.CASCADE)
+	runner = models.ForeignKey(Runner, verbose_name='Бегун', on_delete=models.CASCADE)
+	events = models.BinaryField(verbose_name='Битовая маска забегов с финишем (little-endian)')
+	n_finished = models.SmallIntegerField(verbose_name='Число результатов со статусом «финишировал»', default=0)
+	sum_result = models.BigIntegerField(verbose_name='Сумма этих результатов', default=0)
+	best_result = models.IntegerField(verbose_name='Лучший из этих результатов', null=True, default=None)
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['series', 'distance', 'runner'], name='strike_bitmap_series_distance_runner'),
+		]
+
 class Regions_visited(models.Model):
 	country = models.ForeignKey(Country, verbose_name='Страна', default='RU', on_delete=models.CASCADE)
 	distance = models.ForeignKey(Distance, verbose_name='Дистанция', on_delete=models.CASCADE, null=True, default=None)
@@ -4119,6 +4440,24 @@ class Regions_visited(models.Model):
 			models.Index(fields=['country', 'distance', 'value']),
 		]
 
+# Regions of the country where the runner finished (at all distances if distance is None).
+# Regions_visited is the top of these rows; the runner's page with regions is built from counts.
+class Runner_regions(models.Model):
+	country = models.ForeignKey(Country, verbose_name='Страна', on_delete=models.CASCADE)
+	distance = models.ForeignKey(Distance, verbose_name='Дистанция', on_delete=models.CASCADE, null=True, default=None)
+	runner = models.ForeignKey(Runner, verbose_name='Бегун', on_delete=models.CASCADE)
+	regions = models.BinaryField(verbose_name='Битовая маска регионов по Region.index_in_country (little-endian)')
+	counts = models.BinaryField(verbose_name='Число финишей в каждом регионе, по 2 байта (little-endian)')
+	n_finishes = models.IntegerField(verbose_name='Число финишей')
+	value = models.SmallIntegerField(verbose_name='Число регионов, в которых финишировал(а)')
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['country', 'distance', 'runner'], name='runner_regions_country_distance_runner'),
+		]
+		indexes = [
+			models.Index(fields=['country', 'distance', 'value']),
+		]
+
 DOWNLOAD_NOT_STARTED = 0
 DOWNLOAD_SUCCESS = 1
 DOWNLOAD_SUCCESS_WITH_WARNINGS = 2
@@ -4168,6 +4507,8 @@ class Download_attempt(models.Model):
 	result = models.SmallIntegerField(verbose_name='Результат загрузки', choices=DOWNLOAD_CHOICES, default=DOWNLOAD_IN_PROGRESS)
 	status = models.CharField(verbose_name='Последний статус о процессе загрузки', max_length=1000)
 	error = models.CharField(verbose_name='Текст ошибки', max_length=1000)
+	# Is updated regularly while a queue worker processes the attempt. If it is too old, the worker is dead.
+	last_heartbeat = models.DateTimeField(verbose_name='Последний сигнал от процесса загрузки', null=True, default=None)
 	class Meta:
 		indexes = [
 			models.Index(fields=['scraped_event', 'start_time']),
@@ -4175,6 +4516,8 @@ class Download_attempt(models.Model):
 	def UpdateStatus(self, message: str):
 		self.status = (f'{datetime.datetime.now()}, pid {os.getpid()}: {message}')[:1000]
 		print(self.status)
+		if self.last_heartbeat:
+			self.last_heartbeat = timezone.now()
 		self.save()
 
 class Series_name(models.Model):
@@ -0,0 +1,190 @@
+# Caching of rendered public pages for anonymous visitors.
+# There are two tiers: a small LRU dictionary in each process in front of the shared Django cache.
+# Page keys include the versions of the races, events, runners and series shown on the page. Any change of such an object
+# bumps its version (see invalidate()), so old pages are never served again and just expire.
+# A version is a random number, not a counter: if the shared cache loses a version key, the object gets a new random version
+# instead of starting again from a value that some old page may still be stored under.
+import collections
+import functools
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, Iterable, Optional, Tuple
+
+from django.contrib import messages
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+LOCAL_MAX_ENTRIES = 300
+LOCAL_TIMEOUT = 60 # In seconds. Local copies are dropped earlier than shared ones, so that processes don't keep too much memory.
+PAGE_TIMEOUT = 60 * 60 * 4
+VERSION_TIMEOUT = None # Versions should outlive the pages that use them.
+STATS_FLUSH_INTERVAL = 60 # In seconds. Hit and miss counters are summed up in each process and written to the shared cache that often.
+
+OBJECT_RACE = 'race'
+OBJECT_EVENT = 'event'
+OBJECT_RUNNER = 'runner'
+OBJECT_SERIES = 'series'
+ObjectKey = Tuple[str, int]
+
+# Pages for anonymous visitors contain a CSRF token in the search forms. We store the pages without it
+# and insert the token of the current visitor when serving a page.
+CSRF_TOKEN_RE = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_TOKEN_PLACEHOLDER = b'%%csrf_token%%'
+
+# A thread-safe dictionary that forgets least recently used keys and keys older than timeout.
+class LocalLRUCache:
+	def __init__(self, max_entries: int=LOCAL_MAX_ENTRIES, timeout: float=LOCAL_TIMEOUT):
+		self.max_entries = max_entries
+		self.timeout = timeout
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key: str) -> Optional[Any]:
+		with self._lock:
+			item = self._data.get(key)
+			if item is None:
+				return None
+			expires_at, value = item
+			if expires_at < time.monotonic():
+				del self._data[key]
+				return None
+			self._data.move_to_end(key)
+			return value
+
+	def set(self, key: str, value: Any):
+		with self._lock:
+			self._data[key] = (time.monotonic() + self.timeout, value)
+			self._data.move_to_end(key)
+			while len(self._data) > self.max_entries:
+				self._data.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+class TieredCache:
+	def __init__(self, shared, local: Optional[LocalLRUCache]=None):
+		self.shared = shared
+		self.local = local if local else LocalLRUCache()
+		self._pending_stats = collections.Counter()
+		self._last_stats_flush = time.monotonic()
+		self._stats_lock = threading.Lock()
+
+	def get(self, key: str) -> Optional[Any]:
+		value = self.local.get(key)
+		if value is None:
+			value = self.shared.get(key)
+			if value is not None:
+				self.local.set(key, value)
+		return value
+
+	def set(self, key: str, value: Any, timeout: int=PAGE_TIMEOUT):
+		self.shared.set(key, value, timeout)
+		self.local.set(key, value)
+
+	# Versions are always read from the shared tier: otherwise other processes would not notice the changes.
+	# Objects without a version get a new one; add() keeps the version if another process has just created it.
+	def get_versions(self, object_keys: Iterable[ObjectKey]) -> list[int]:
+		keys = [version_key(object_key) for object_key in object_keys]
+		versions = self.shared.get_many(keys)
+		missing = [key for key in keys if key not in versions]
+		if missing:
+			for key in missing:
+				self.shared.add(key, new_version(), VERSION_TIMEOUT)
+			versions.update(self.shared.get_many(missing))
+		return [versions.get(key, 0) for key in keys]
+
+	# One write for all the keys, without reading them first.
+	def bump_versions(self, object_keys: Iterable[ObjectKey]):
+		keys = {version_key(object_key) for object_key in object_keys}
+		if keys:
+			self.shared.set_many({key: new_version() for key in keys}, timeout=VERSION_TIMEOUT)
+
+	def incr(self, key: str, timeout: Optional[int]=PAGE_TIMEOUT, delta: int=1):
+		try:
+			self.shared.incr(key, delta)
+		except ValueError: # There is no such key yet
+			self.shared.set(key, delta, timeout)
+
+	# Counting each hit in the shared cache would mean a write on each request, so we count them in the process.
+	def count_stat(self, page_type: str, name: str):
+		with self._stats_lock:
+			self._pending_stats[stat_key(page_type, name)] += 1
+			if time.monotonic() - self._last_stats_flush < STATS_FLUSH_INTERVAL:
+				return
+			pending = self._pending_stats
+			self._pending_stats = collections.Counter()
+			self._last_stats_flush = time.monotonic()
+		for key, delta in pending.items():
+			self.incr(key, delta=delta)
+
+	def get_stats(self, page_type: str) -> dict[str, int]:
+		keys = {name: stat_key(page_type, name) for name in ('hit', 'miss')}
+		values = self.shared.get_many(keys.values())
+		return {name: values.get(key, 0) for name, key in keys.items()}
+
+def new_version() -> int:
+	return random.getrandbits(63)
+
+def version_key(object_key: ObjectKey) -> str:
+	return f'page_version_{object_key[0]}_{object_key[1]}'
+
+def stat_key(page_type: str, name: str) -> str:
+	return f'page_stat_{page_type}_{name}'
+
+# For tests and for running without the shared cache table.
+def make_local_stand_in() -> TieredCache:
+	return TieredCache(LocMemCache('page_cache_stand_in', {}), LocalLRUCache())
+
+_tiered_cache = None
+def get_tiered_cache() -> TieredCache:
+	global _tiered_cache
+	if _tiered_cache is None:
+		_tiered_cache = TieredCache(caches['pages'])
+	return _tiered_cache
+
+def set_tiered_cache(tiered_cache: Optional[TieredCache]):
+	global _tiered_cache
+	_tiered_cache = tiered_cache
+
+# Makes all cached pages with these objects outdated.
+def invalidate(object_keys: Iterable[ObjectKey]):
+	object_keys = [(object_type, object_id) for object_type, object_id in object_keys if object_id]
+	if object_keys:
+		get_tiered_cache().bump_versions(object_keys)
+
+# memcached accepts only short keys without spaces, so the path is hashed.
+def page_key(page_type: str, full_path: str, versions: list[int]) -> str:
+	versions_str = '_'.join(str(version) for version in versions)
+	return f'page_{page_type}_{versions_str}_{hashlib.md5(full_path.encode()).hexdigest()}'
+
+def can_use_cache(request) -> bool:
+	return (request.method == 'GET') and not request.user.is_authenticated and (len(messages.get_messages(request)) == 0)
+
+# Serves the page of the view to anonymous visitors from the cache. object_keys_func gets the view's kwargs
+# and returns the keys of the objects that the page shows, e.g. [(OBJECT_RACE, race_id)].
+def cache_public_page(page_type: str, object_keys_func):
+	def decorator(view):
+		@functools.wraps(view)
+		def wrapper(request, *args, **kwargs):
+			if not can_use_cache(request):
+				return view(request, *args, **kwargs)
+			tiered_cache = get_tiered_cache()
+			key = page_key(page_type, request.get_full_path(), tiered_cache.get_versions(object_keys_func(**kwargs)))
+			content = tiered_cache.get(key)
+			if content is not None:
+				tiered_cache.count_stat(page_type, 'hit')
+				return HttpResponse(content.replace(CSRF_TOKEN_PLACEHOLDER, get_token(request).encode()))
+			tiered_cache.count_stat(page_type, 'miss')
+			response = view(request, *args, **kwargs)
+			if (response.status_code == 200) and not response.streaming and not response.cookies \
+					and (len(messages.get_messages(request)) == 0):
+				tiered_cache.set(key, CSRF_TOKEN_RE.sub(rb'\1' + CSRF_TOKEN_PLACEHOLDER + rb'\2', response.content))
+			return response
+		return wrapper
+	return decorator
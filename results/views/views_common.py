@@ -1,11 +1,17 @@
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models.query import Prefetch
 from django.db.models import Q, Sum
 from django.shortcuts import render
+from django.utils.functional import cached_property
 
 from collections import OrderedDict
 import datetime
-from typing import Any, Dict, Set
+import functools
+import hashlib
+import operator
+from typing import Any, Dict, Iterable, List, Optional, Set
 
 from results import forms, models, models_klb, results_util
 
@@ -19,15 +25,123 @@ def get_page_num(request):
 	return 1
 
 def get_results_with_splits_ids(results):
-	result_ids = set(results.values_list('pk', flat=True))
+	return get_result_ids_with_splits(set(results.values_list('pk', flat=True)))
+
+def get_result_ids_with_splits(result_ids: Iterable[int]) -> Set[int]:
 	return set(models.Split.objects.filter(result_id__in=result_ids).values_list('result_id', flat=True).order_by().distinct())
 
-def paginate_and_render(request, template, context, queryset, show_all=False, page=None, add_results_with_splits=False):
+# For how long KeysetPaginator remembers the number of rows and the keys of the last rows of the pages, in seconds
+KEYSET_CACHE_TIMEOUT = 10 * 60
+
+# Returns the ordering of the queryset with 'pk' at the end, so that it defines the order of rows uniquely,
+# or None if some ordering element is not a field name and so we can't compare rows by it.
+def get_keyset_ordering(queryset) -> Optional[List[str]]:
+	ordering = list(queryset.query.order_by) or (list(queryset.model._meta.ordering) if queryset.query.default_ordering else [])
+	if not ordering:
+		return None
+	if not all(isinstance(field, str) and (field != '?') for field in ordering):
+		return None
+	if not ({field.lstrip('-') for field in ordering} & {'pk', 'id'}):
+		ordering.append('pk')
+	return ordering
+
+# Returns the names of the ordering fields that can be NULL, also because of a nullable foreign key on the way to them.
+# Names we can't resolve (e.g. annotations) are considered nullable too.
+def get_nullable_ordering_fields(model, ordering: List[str]) -> Set[str]:
+	res = set()
+	for field in ordering:
+		name = field.lstrip('-')
+		if name == 'pk':
+			continue
+		cur_model = model
+		for part in name.split('__'):
+			try:
+				model_field = cur_model._meta.get_field(part)
+			except FieldDoesNotExist:
+				res.add(name)
+				break
+			if model_field.null:
+				res.add(name)
+				break
+			if not model_field.is_relation:
+				break
+			cur_model = model_field.related_model
+	return res
+
+# The condition for the rows that go after the row with given values of the ordering fields.
+# MySQL puts NULLs first in ascending order and last in descending order, and 'field < value' never matches them;
+# so for nullable fields in descending order we add the rows with NULL explicitly.
+# Returns None if some value is None: we don't seek inside the group of NULLs.
+def get_keyset_condition(ordering: List[str], values: Iterable[Any], nullable: Set[str]=frozenset()) -> Optional[Q]:
+	conditions = []
+	equal_prefix = {}
+	for field, value in zip(ordering, values):
+		if value is None:
+			return None
+		name = field.lstrip('-')
+		lookup = 'lt' if field.startswith('-') else 'gt'
+		if field.startswith('-') and (name in nullable):
+			conditions.append(Q(**equal_prefix) & (Q(**{f'{name}__{lookup}': value}) | Q(**{f'{name}__isnull': True})))
+		else:
+			conditions.append(Q(**equal_prefix, **{f'{name}__{lookup}': value}))
+		equal_prefix[name] = value
+	return functools.reduce(operator.or_, conditions)
+
+# Shows the same numbered pages as Paginator but doesn't make the DB skip all rows before the page when it can.
+# The number of rows is cached for a while. After showing a page, we remember the key of its last row, and the next page
+# is loaded with a condition on that key (a seek) instead of OFFSET. If there is no such key, we take the ids of the page
+# with OFFSET over the narrow list of ids only and then load the rows of the page by these ids.
+class KeysetPaginator(Paginator):
+	def __init__(self, queryset, per_page):
+		self.ordering = get_keyset_ordering(queryset)
+		if self.ordering:
+			queryset = queryset.order_by(*self.ordering)
+			self.nullable = get_nullable_ordering_fields(queryset.model, self.ordering)
+		super().__init__(queryset, per_page)
+		try:
+			self.cache_key = 'keyset_' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+		except EmptyResultSet: # E.g. for filter(pk__in=[]). Such queries are fast anyway.
+			self.cache_key = None
+
+	@cached_property
+	def count(self) -> int:
+		if self.cache_key is None:
+			return self.object_list.count()
+		return cache.get_or_set(f'{self.cache_key}_count', self.object_list.count, KEYSET_CACHE_TIMEOUT)
+
+	def page(self, number):
+		number = self.validate_number(number)
+		return self._get_page(self.get_rows(number), number, self)
+
+	def get_rows(self, number: int) -> list:
+		bottom = (number - 1) * self.per_page
+		condition = None
+		to_use_cache = self.ordering and self.cache_key
+		prev_key, cur_key = f'{self.cache_key}_last_{number - 1}', f'{self.cache_key}_last_{number}'
+		cached = cache.get_many([prev_key, cur_key]) if to_use_cache else {}
+		if prev_key in cached:
+			condition = get_keyset_condition(self.ordering, cached[prev_key], self.nullable)
+		if number == 1:
+			rows = list(self.object_list[:self.per_page])
+		elif condition is not None:
+			rows = list(self.object_list.filter(condition)[:self.per_page])
+		else:
+			ids = list(self.object_list.values_list('pk', flat=True)[bottom:bottom + self.per_page])
+			rows_by_id = {row.pk: row for row in self.object_list.filter(pk__in=ids)}
+			rows = [rows_by_id[row_id] for row_id in ids if row_id in rows_by_id]
+		if to_use_cache and rows:
+			last_values = self.object_list.filter(pk=rows[-1].pk).values_list(*[field.lstrip('-') for field in self.ordering]).first()
+			# Each write to the file cache lists its directory to cull it, so we don't write the same value on each view of the page.
+			if cached.get(cur_key) != last_values:
+				cache.set(cur_key, last_values, KEYSET_CACHE_TIMEOUT)
+		return rows
+
+def paginate_and_render(request, template, context, queryset, show_all=False, page=None, add_results_with_splits=False, keyset=False):
 	if show_all:
 		qs = list(queryset)
 		context['page_enum'] = list(zip(list(range(1, len(qs) + 1)), qs))
 	else:
-		paginator = Paginator(queryset, RECORDS_ON_PAGE)
+		paginator = KeysetPaginator(queryset, RECORDS_ON_PAGE) if keyset else Paginator(queryset, RECORDS_ON_PAGE)
 		if page is None:
 			page = get_page_num(request)
 		# context['page_number'] = (unicode(request.POST.lists()) + ' page: {}'.format(page)) if request.method == 'POST' else '@'
@@ -41,8 +155,9 @@ def paginate_and_render(request, template, context, queryset, show_all=False, pa
 			qs_page = paginator.page(paginator.num_pages)
 		first_index = (qs_page.number - 1) * RECORDS_ON_PAGE + 1
 		last_index = min(qs_page.number * RECORDS_ON_PAGE, paginator.count)
+		page_objects = list(qs_page)
 		context.update({
-			'page_enum': list(zip(list(range(first_index, last_index + 1)), qs_page)),
+			'page_enum': list(zip(list(range(first_index, last_index + 1)), page_objects)),
 			'page': qs_page,
 			'paginator': paginator,
 			'first_index': str(first_index),
@@ -55,7 +170,7 @@ def paginate_and_render(request, template, context, queryset, show_all=False, pa
 			'show_plus_two_page': (qs_page.number < paginator.num_pages - 1),
 		})
 		if add_results_with_splits:
-			context['results_with_splits'] = get_results_with_splits_ids(queryset[first_index - 1:last_index])
+			context['results_with_splits'] = get_result_ids_with_splits({result.id for result in page_objects})
 	return render(request, template, context)
 
 def user_edit_vars(user, series=None, club=None):
@@ -218,10 +333,7 @@ def get_dict_for_klb_participations_block(runner, is_admin):
 
 # If either fname or lname is given
 def filter_runners_by_one_word(runners, name):
-	runners_with_good_extra_names = set(models.Extra_name.objects.filter(
-		Q(lname__istartswith=name) | Q(fname__istartswith=name)).values_list('runner_id', flat=True)
-	)
-	return runners.filter(Q(lname__istartswith=name) | Q(fname__istartswith=name) | Q(pk__in=runners_with_good_extra_names))
+	return runners.filter(pk__in=models.Runner_search_name.matching(name).values('runner_id'))
 
 # Currently midname here is non-empty only if noth lname and fname are specified
 def filter_runners_by_name(runners, lname, fname, midname):
@@ -231,19 +343,7 @@ def filter_runners_by_name(runners, lname, fname, midname):
 		return filter_runners_by_one_word(runners, fname)
 	if not fname:
 		return filter_runners_by_one_word(runners, lname)
-
-	# So both lname and fname are set
-	extra_names = models.Extra_name.objects.filter(
-		Q(lname__istartswith=lname, fname__istartswith=fname) | Q(lname__istartswith=fname, fname__istartswith=lname))
-	if midname:
-		extra_names = extra_names.filter(Q(midname='') | Q(midname__istartswith=midname))
-	runners_with_good_extra_names = set(extra_names.values_list('runner_id', flat=True)
-	)
-	return runners.filter(
-		  Q(lname__istartswith=lname, fname__istartswith=fname, midname__istartswith=midname)
-		| Q(lname__istartswith=fname, fname__istartswith=lname, midname__istartswith=midname)
-		| Q(pk__in=runners_with_good_extra_names)
-	)
+	return runners.filter(pk__in=models.Runner_search_name.matching(lname, fname, midname).values('runner_id'))
 
 def add_related_to_events(events):
 	return events.select_related('series__city__region__country', 'city__region__country', 'series__country').prefetch_related(
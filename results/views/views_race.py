@@ -9,7 +9,7 @@ from django.http import Http404, QueryDict
 import datetime
 from typing import Any, List
 
-from results import models, models_klb, forms, results_util
+from results import models, models_klb, forms, page_cache, results_util
 from results.views import views_common
 from results.templatetags.results_extras import add_prefix
 from editor import parse_weekly_events, runner_stat
@@ -453,6 +453,7 @@ def constants_for_race_context(user, event):
 	context['RESULTS_SOME_OR_ALL_OFFICIAL'] = models.RESULTS_SOME_OR_ALL_OFFICIAL
 	return context
 
+@page_cache.cache_public_page('race', lambda race_id=None, **kwargs: [(page_cache.OBJECT_RACE, race_id)])
 def race_details(request, race_id=None, tab_editor=False, tab_unofficial=False, tab_add_to_club=False):
 	race = get_object_or_404(models.Race, pk=race_id)
 	event = race.event
@@ -548,7 +549,7 @@ def race_details(request, race_id=None, tab_editor=False, tab_unofficial=False,
 	context['show_link_to_add_race_rating'] = user.is_authenticated \
 		and user.result_set.filter(race=race).exists() and not user.group_set.filter(race=race, is_empty=False).exists()
 
-	return views_common.paginate_and_render(request, 'results/race_details.html', context, filtered_results, page=page, add_results_with_splits=True)
+	return views_common.paginate_and_render(request, 'results/race_details.html', context, filtered_results, page=page, add_results_with_splits=True, keyset=True)
 
 def event_klb_results(request, event_id=None):
 	event = get_object_or_404(models.Event, pk=event_id)
@@ -610,6 +611,7 @@ def calendar_content(event, races):
 			context['n_plans'] += items_count
 	return context
 
+@page_cache.cache_public_page('event', lambda event_id=None, **kwargs: [(page_cache.OBJECT_EVENT, event_id)])
 def event_details(request, event_id=None, beta=0):
 	event = get_object_or_404(models.Event, pk=event_id)
 	series = event.series
@@ -752,6 +754,73 @@ def protocols_wanted(request, events_type_code=forms.EVENT_TYPE_CODES[1], year=r
 	context['events'] = events
 	return render(request, 'results/protocols_wanted.html', context)
 
+# Returns the ordered queryset of events, races or results for the rating page and the name of the field it is ordered by.
+# distance must be given for ratings by best results.
+def get_rating_queryset(country_ids, distance, distance_id, year, rating_type):
+	if distance_id == results_util.DISTANCE_WHOLE_EVENTS:
+		events = models.Event.get_events_by_countries(year, country_ids).annotate(
+			n_participants_finished=Sum('race__n_participants_finished'),
+			n_participants_finished_male=Sum('race__n_participants_finished_male'),
+			n_participants_finished_women=Sum('race__n_participants_finished')-Sum('race__n_participants_finished_male')
+		)
+		if rating_type == forms.RATING_N_FINISHERS:
+			rating_value = 'n_participants_finished'
+		elif rating_type == forms.RATING_N_FINISHERS_MALE:
+			rating_value = 'n_participants_finished_male'
+		elif rating_type == forms.RATING_N_FINISHERS_FEMALE:
+			rating_value = 'n_participants_finished_women'
+		events = events.filter(**{f'{rating_value}__gt': 0})
+		return events.select_related('series__city__region__country', 'city__region__country').prefetch_related(
+			Prefetch('race_set',
+				queryset=models.Race.objects.select_related('distance').order_by(
+					'distance__distance_type', '-distance__length', 'precise_name')),
+		).order_by(f'-{rating_value}'), rating_value
+
+	races = models.Race.get_races_by_countries(year, country_ids)
+	if distance:
+		races = races.filter(distance=distance)
+	if rating_type in forms.RATING_TYPES_BY_FINISHERS:
+		if rating_type == forms.RATING_N_FINISHERS:
+			races = races.filter(n_participants_finished__gt=0).annotate(rating_value=F('n_participants_finished'))
+		elif rating_type == forms.RATING_N_FINISHERS_MALE:
+			races = races.filter(n_participants_finished_male__gt=0).annotate(rating_value=F('n_participants_finished_male'))
+		elif rating_type == forms.RATING_N_FINISHERS_FEMALE:
+			races = races.annotate(rating_value=F('n_participants_finished')-F('n_participants_finished_male')).filter(rating_value__gt=0)
+		return races.select_related(
+			'event__series__city__region__country', 'event__city__region__country').order_by('-rating_value'), 'rating_value'
+
+	result_ordering = '-result' if (distance.distance_type in models.TYPES_MINUTES) else 'result'
+	races = races.filter(Q(distance_real=None) | Q(distance_real__length__gt=distance.length), is_for_handicapped=False)
+	if rating_type == forms.RATING_BEST_MALE:
+		results = models.Result.objects.filter(
+			race__in=races, place_gender=1, gender=results_util.GENDER_MALE, status=models.STATUS_FINISHED)
+	elif rating_type == forms.RATING_BEST_FEMALE:
+		results = models.Result.objects.filter(
+			race__in=races, place_gender=1, gender=results_util.GENDER_FEMALE, status=models.STATUS_FINISHED)
+	return results.select_related(
+		'race__event__series__city__region__country', 'race__event__city__region__country').order_by(result_ordering), 'result'
+
+# The objects of a rating in the order stored in Rating_position, for Paginator.
+# Getting a slice loads only the positions of this slice, so any page is loaded equally fast.
+class RatingTableItems:
+	def __init__(self, table: models.Rating_table, queryset):
+		self.table = table
+		self.queryset = queryset
+	def count(self) -> int:
+		return self.table.n_entries
+	def __len__(self) -> int:
+		return self.table.n_entries
+	def __getitem__(self, key):
+		if not isinstance(key, slice):
+			return self[key:key + 1][0]
+		start = key.start or 0
+		stop = self.table.n_entries if (key.stop is None) else key.stop
+		ids = list(self.table.rating_position_set.filter(position__gt=start, position__lte=stop).order_by('position').values_list(
+			'object_id', flat=True))
+		# The objects that don't fit the rating anymore are skipped until the table is rebuilt.
+		objects = {obj.id: obj for obj in self.queryset.filter(pk__in=ids)}
+		return [objects[obj_id] for obj_id in ids if obj_id in objects]
+
 def rating(request, country_id=None, distance_code=None, year=None, rating_type_code=None, page=1):
 	if request.method == 'POST':
 		kwargs = {
@@ -811,49 +880,17 @@ def rating(request, country_id=None, distance_code=None, year=None, rating_type_
 
 	if distance_id == results_util.DISTANCE_WHOLE_EVENTS:
 		context['rating_by_whole_events'] = True
-		events = models.Event.get_events_by_countries(year, country_ids).annotate(
-			n_participants_finished=Sum('race__n_participants_finished'),
-			n_participants_finished_male=Sum('race__n_participants_finished_male'),
-			n_participants_finished_women=Sum('race__n_participants_finished')-Sum('race__n_participants_finished_male')
-		)
-		if rating_type == forms.RATING_N_FINISHERS:
-			rating_value = 'n_participants_finished'
-		elif rating_type == forms.RATING_N_FINISHERS_MALE:
-			rating_value = 'n_participants_finished_male'
-		elif rating_type == forms.RATING_N_FINISHERS_FEMALE:
-			rating_value = 'n_participants_finished_women'
-		events = events.filter(**{f'{rating_value}__gt': 0})
-		filtered_results = events.select_related('series__city__region__country', 'city__region__country').prefetch_related(
-			Prefetch('race_set',
-				queryset=models.Race.objects.select_related('distance').order_by(
-					'distance__distance_type', '-distance__length', 'precise_name')),
-		).order_by(f'-{rating_value}')
+	elif rating_type in forms.RATING_TYPES_BY_FINISHERS:
+		context['rating_by_n_finishers'] = True
 	else:
-		races = models.Race.get_races_by_countries(year, country_ids)
-		if distance:
-			races = races.filter(distance=distance)
-		if rating_type in forms.RATING_TYPES_BY_FINISHERS:
-			context['rating_by_n_finishers'] = True
-			if rating_type == forms.RATING_N_FINISHERS:
-				races = races.filter(n_participants_finished__gt=0).annotate(rating_value=F('n_participants_finished'))
-			elif rating_type == forms.RATING_N_FINISHERS_MALE:
-				races = races.filter(n_participants_finished_male__gt=0).annotate(rating_value=F('n_participants_finished_male'))
-			elif rating_type == forms.RATING_N_FINISHERS_FEMALE:
-				races = races.annotate(rating_value=F('n_participants_finished')-F('n_participants_finished_male')).filter(rating_value__gt=0)
-			filtered_results = races.select_related(
-				'event__series__city__region__country', 'event__city__region__country').order_by('-rating_value')
-		else:
-			result_ordering = '-result' if (distance.distance_type in models.TYPES_MINUTES) else 'result'
-			context['rating_by_best_result'] = True
-			races = races.filter(Q(distance_real=None) | Q(distance_real__length__gt=distance.length), is_for_handicapped=False)
-			if rating_type == forms.RATING_BEST_MALE:
-				results = models.Result.objects.filter(
-					race__in=races, place_gender=1, gender=results_util.GENDER_MALE, status=models.STATUS_FINISHED)
-			elif rating_type == forms.RATING_BEST_FEMALE:
-				results = models.Result.objects.filter(
-					race__in=races, place_gender=1, gender=results_util.GENDER_FEMALE, status=models.STATUS_FINISHED)
-			filtered_results = results.select_related(
-				'race__event__series__city__region__country', 'race__event__city__region__country').order_by(result_ordering)
+		context['rating_by_best_result'] = True
+
+	filtered_results, _ = get_rating_queryset(country_ids, distance, distance_id, year, rating_type)
+	# The tables are created by editor.rating_tables for a fixed set of ratings; others are calculated each time.
+	table = models.Rating_table.objects.filter(country_id=country.id if country else '', distance_id=distance_id,
+		year=results_util.int_safe(year), rating_type=rating_type).first()
+	if table and table.is_built():
+		filtered_results = RatingTableItems(table, filtered_results)
 	return views_common.paginate_and_render(request, 'results/rating.html', context, filtered_results, page=page)
 
 def get_logo_page(request, event_id=None, series_id=None, organizer_id=None):
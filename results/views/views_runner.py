@@ -3,10 +3,10 @@ from django.db.models import Q
 from django.shortcuts import get_object_or_404, render
 
 import datetime
-from collections import Counter
 
-from results import models, forms, results_util
+from results import models, forms, page_cache, results_util
 from . import views_common
+from editor import regions_visited
 
 @login_required
 def runners(request, lname='', fname=''):
@@ -102,12 +102,14 @@ def runners(request, lname='', fname=''):
 	context['fname'] = fname
 	context['cur_stat_year'] = results_util.CUR_YEAR_FOR_RUNNER_STATS
 	context['cur_year'] = datetime.date.today().year
-	return views_common.paginate_and_render(request, 'results/runners.html', context, runners)
+	return views_common.paginate_and_render(request, 'results/runners.html', context, runners, keyset=True)
 
 @login_required
 def runner_details_login_required(request):
 	pass
 
+# Pages of living runners are shown only to logged in users, so only pages of deceased ones get to the cache.
+@page_cache.cache_public_page('runner', lambda runner_id, **kwargs: [(page_cache.OBJECT_RUNNER, runner_id)])
 def runner_details(request, runner_id, series_id=None, show_full_page=False):
 	runner = get_object_or_404(models.Runner, pk=runner_id)
 	if (not runner.deathday) and (not request.user.is_authenticated):
@@ -166,18 +168,6 @@ def regions_for_runner(request, runner_id: int, country_id: str, distance_code:
 	context['page_title'] = runner.name() + ': ' + context['page_desc']
 	context['runner'] = runner
 
-	regions_dict = {region.id: region for region in country.region_set.all()}
-	regions = Counter()
-	results = runner.result_set.filter(
-		Q(race__event__city__region__country=country) | Q(race__event__city=None, race__event__series__city__region__country=country),
-		status=models.STATUS_FINISHED,
-	)
-	if distance:
-		results = results.filter(race__distance=distance)
-	context['total'] = 0
-	for event_region, series_region in results.values_list('race__event__city__region_id', 'race__event__series__city__region_id'):
-		region_id = event_region if event_region else series_region
-		regions[regions_dict[region_id]] += 1
-		context['total'] += 1
-	context['regions'] = sorted(regions.most_common(100), key=lambda x: x[0].name)
+	context['regions'] = regions_visited.regions_for_runner(runner, country, distance)
+	context['total'] = sum(count for _, count in context['regions'])
 	return render(request, 'results/regions_for_runner.html', context)
@@ -6,7 +6,7 @@ from collections import OrderedDict, Counter
 import datetime
 from typing import Any
 
-from results import models
+from results import models, page_cache
 from results.views import views_common, views_race
 from starrating.utils import show_rating
 
@@ -19,6 +19,7 @@ def get_prefetch_race_set():
 					'distance_real')
 			)
 
+@page_cache.cache_public_page('series', lambda series_id, **kwargs: [(page_cache.OBJECT_SERIES, series_id)])
 def series_details(request, series_id, tab=None):
 	series = get_object_or_404(models.Series, pk=series_id)
 	user = request.user
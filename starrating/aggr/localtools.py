@@ -520,6 +520,127 @@ def process_update_record(obj):
 				overall_qs.delete()
 
 
+VALUE_FIELDS = ('sum_int', 'sum_float', 'weight', 'user_count')
+UPDATE_RECORDS_PER_BATCH = 1000
+
+
+def add_deltas(deltas, parent_id, old_data, new_data, current_sum_field_name, parent_sum_field_name):
+	parent_deltas = deltas.setdefault(parent_id, {'user_count': 0, 'weight': 0, parent_sum_field_name: 0})
+	parent_deltas['user_count'] += new_data['user_count'] - old_data['user_count']
+	parent_deltas['weight'] += new_data['weight'] - old_data['weight']
+	parent_deltas[parent_sum_field_name] += new_data[current_sum_field_name] - old_data[current_sum_field_name]
+
+
+def add_deltas_to_upd_records(upd_model, deltas):
+	"""
+	Does the same as calc_overall_parent and calc_by_param_parent for many parent records at once.
+	deltas is a dict {parent id: {field name: delta}}. Missing _updated records are created from the main model,
+	as get_upd_record does.
+	"""
+	if not deltas:
+		return
+	existing = {obj.pk: obj for obj in upd_model.objects.filter(pk__in=list(deltas.keys()))}
+	new_records = [
+		upd_model(pk=row['pk'], **{field: row[field] for field in VALUE_FIELDS})
+		for row in get_base_model(upd_model).objects.filter(
+			pk__in=[pk for pk in deltas if pk not in existing]
+		).values('pk', *VALUE_FIELDS)
+	]
+	records = list(existing.values()) + new_records
+	assert len(records) == len(deltas)
+	for record in records:
+		for field, delta in list(deltas[record.pk].items()):
+			value = getattr(record, field)
+			setattr(record, field, delta if (value is None) else (value + delta))
+	upd_model.objects.bulk_create(new_records)
+	upd_model.objects.bulk_update(list(existing.values()), VALUE_FIELDS)
+
+
+def copy_from_updated(base_model, upd_model, ids):
+	sub_filter = upd_model.objects.filter(pk=OuterRef('pk'))
+	base_model.objects.all().filter(pk__in=ids).update(
+		**{field: Subquery(sub_filter.values(field)) for field in VALUE_FIELDS}
+	)
+
+
+def process_update_records(overall_updated_model, overall_ids):
+	"""
+	Does the same as process_update_record for all given ids of overall_updated_model, which must be of the same level:
+	- the deltas of all records are summed up for each parent and added to the parent _updated records with bulk queries;
+	- _updated records are copied to the main models and deleted with one query per model.
+	"""
+	level = level_of_model(overall_updated_model)
+	has_parent = (level + 1) in LEVEL_NO_TO_NAME
+	overall_model = get_base_model(overall_updated_model)
+	by_param_updated_model = get_dependent_model(overall_updated_model)
+	by_param_model = get_base_model(by_param_updated_model)
+	methods_spec = get_methods_specification()
+	parent_fields = ('parent_id', ) if has_parent else ()
+
+	with Flock_mutex(LOCK_FILE_FOR_RATED_TREE_MODIFICATIONS):
+		with transaction.atomic():
+			ov_new_data = queryset_to_dict(
+				overall_updated_model.objects.filter(pk__in=overall_ids).values('pk', 'to_delete', *VALUE_FIELDS),
+				'pk'
+			)
+			ov_ids = list(ov_new_data.keys())
+			ov_old_data = queryset_to_dict(
+				overall_model.objects.filter(pk__in=ov_ids).values('pk', 'method_id', *(VALUE_FIELDS + parent_fields)),
+				'pk'
+			)
+			bp_new_data = queryset_to_dict(
+				by_param_updated_model.objects.filter(id__overall_id__in=ov_ids).values('pk', *VALUE_FIELDS),
+				'pk'
+			)
+			bp_ids = list(bp_new_data.keys())
+			bp_old_data = queryset_to_dict(
+				by_param_model.objects.filter(pk__in=bp_ids).values('pk', 'overall_id', 'method_id', *(VALUE_FIELDS + parent_fields)),
+				'pk'
+			)
+			assert len(ov_old_data) == len(ov_new_data)
+			assert len(bp_old_data) == len(bp_new_data)
+
+			if has_parent:
+				ov_deltas = {}
+				for pk, old_data in list(ov_old_data.items()):
+					spec_this = methods_spec[old_data['method_id']][level]
+					spec_parent = methods_spec[old_data['method_id']][level + 1]
+					if spec_parent['overall_dir'] != 'child':
+						raise NotImplementedError
+					if spec_parent['overall_spec'] != METHOD_DIRECT_SUMM:
+						assert spec_parent['overall_spec'] == METHOD_REWEIGHTING
+						raise NotImplementedError
+					add_deltas(ov_deltas, old_data['parent_id'], old_data, ov_new_data[pk],
+						spec_this['overall_field'], spec_parent['overall_field'])
+
+				bp_deltas = {}
+				for pk, old_data in list(bp_old_data.items()):
+					spec_this = methods_spec[old_data['method_id']][level]
+					spec_parent = methods_spec[old_data['method_id']][level + 1]
+					if spec_parent['by_param_spec'] != METHOD_DIRECT_SUMM:
+						assert spec_parent['by_param_spec'] == METHOD_REWEIGHTING
+						raise NotImplementedError
+					add_deltas(bp_deltas, old_data['parent_id'], old_data, bp_new_data[pk],
+						spec_this['by_param_field'], spec_parent['by_param_field'])
+
+				overall_parent_model = overall_model._meta.get_field('parent').related_model
+				add_deltas_to_upd_records(get_upd_model(overall_parent_model), ov_deltas)
+				add_deltas_to_upd_records(get_upd_model(get_dependent_model(overall_parent_model)), bp_deltas)
+
+			copy_from_updated(overall_model, overall_updated_model, ov_ids)
+			copy_from_updated(by_param_model, by_param_updated_model, bp_ids)
+			overall_updated_model.objects.filter(pk__in=ov_ids).delete()
+			by_param_updated_model.objects.filter(pk__in=bp_ids).delete()
+
+			ov_ids_to_delete = set(pk for pk, new_data in list(ov_new_data.items()) if new_data['to_delete'])
+			if ov_ids_to_delete:
+				by_param_model.objects.filter(
+					pk__in=[pk for pk, old_data in list(bp_old_data.items()) if old_data['overall_id'] in ov_ids_to_delete]
+				).delete()
+				overall_model.objects.filter(pk__in=ov_ids_to_delete).delete()
+	return len(ov_ids)
+
+
 def process_updated_models(level, method_ids=(), log=None):
 	assert level in LEVELS_LIST
 	assert isinstance(method_ids, (list, tuple))
@@ -545,25 +666,16 @@ def process_updated_models(level, method_ids=(), log=None):
 	model_by_param_updated = get_model_by_name(base_name + '_by_param_updated')
 	model_by_param = get_model_by_name(base_name + '_by_param')
 
-	fields_for_select_related = ['id__method']
-	if level + 1 in LEVELS_LIST:
-		fields_for_select_related.append('id__parent')
-	updated_qs = model_overall_updated.objects.all().filter(
+	updated_ids = list(model_overall_updated.objects.all().filter(
 		id__method_id__in=method_ids
-	).select_related(*fields_for_select_related)
-
-	if log:
-		id_list = []
-		MAX_LIST_LENGTH = 100
+	).order_by('pk').values_list('pk', flat=True))
 
 	items_count = 0
-	for item in updated_qs:
-		process_update_record(item)
-		items_count += 1
-		if log:
-			if items_count <= MAX_LIST_LENGTH:
-				id_list.append(item.pk)
+	for i in range(0, len(updated_ids), UPDATE_RECORDS_PER_BATCH):
+		items_count += process_update_records(model_overall_updated, updated_ids[i:i + UPDATE_RECORDS_PER_BATCH])
 	if log:
+		MAX_LIST_LENGTH = 100
+		id_list = updated_ids[:MAX_LIST_LENGTH]
 		log.info(
 			'process_updated_models[{}] (level={}={}) result: items_count={}'.format(
 				pid,
@@ -578,8 +690,8 @@ def process_updated_models(level, method_ids=(), log=None):
 					LEVEL_NO_TO_NAME[level],
 					' '.join([str(x) for x in id_list]),
 					' ... {}'.format(
-						item.pk
-					) if len(id_list)==MAX_LIST_LENGTH and item.pk != id_list[-1] else ''
+						updated_ids[-1]
+					) if len(id_list)==MAX_LIST_LENGTH and updated_ids[-1] != id_list[-1] else ''
 				)
 			)
 	return items_count
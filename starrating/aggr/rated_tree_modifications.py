@@ -6,6 +6,7 @@ from starrating.models import Root_overall, Aggregate_abstract_model, Overall_ab
 from starrating.constants import RADIX
 from starrating.aggr.aggr_utils import get_upd_model, get_methods_specification, level_of_model, get_dependent_model, get_parent_object
 from starrating.aggr.localtools import mk_empty_aggr_records, get_upd_record
+from starrating.aggr.update_queue import enqueue
 from starrating.exceptions import UpdatedRecordExistsError
 
 
@@ -99,6 +100,8 @@ def move_node_into_new_tree_place(overall_node, new_parent):
 		set_zero_aggr_values(by_param_node)
 		by_param_node.save(force_update=True)
 
+	enqueue(level_of_model(type(overall_node)))
+
 
 def create_deletion_task(overall_node):
 	# for this node and it's by_param nodes
@@ -119,6 +122,7 @@ def create_deletion_task(overall_node):
 		by_param_upd_model(pk=x, **{f: 0 for f in fields}) for x in
 		by_param_model.objects.filter(overall=overall_node).values_list('id', flat=True)
 	])
+	enqueue(level_of_model(type(overall_node)))
 
 
 def make_temporary_clone(overall_node, delete_original):
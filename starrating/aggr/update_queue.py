@@ -0,0 +1,72 @@
+"""
+Durable queue of work for the updater.
+
+Code that leaves new data for the updater (new groups of marks, deletion tasks)
+adds an Update_task record in the same transaction and, after the commit, wakes the
+updater up with a datagram to UPDATER_SOCKET. If the updater is not running, the
+tasks just wait in the table, so the socket only saves the updater from polling.
+"""
+
+import os
+import select
+import socket
+
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from starrating.constants import UPDATER_SOCKET
+from starrating.models import Update_task
+
+
+def enqueue(level):
+	Update_task.objects.create(level=level)
+	transaction.on_commit(wake_updater)
+
+
+def wake_updater():
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+			sock.setblocking(False)
+			sock.sendto(b'1', UPDATER_SOCKET)
+	except OSError:
+		pass  # The updater is not running or is already woken up by many datagrams. It will see the task anyway.
+
+
+def get_metrics():
+	"""
+	Returns the number of tasks in the queue and the age of the oldest one in seconds.
+	"""
+	res = Update_task.objects.aggregate(depth=Count('id'), oldest=Min('created'))
+	lag = (timezone.now() - res['oldest']).total_seconds() if res['oldest'] else 0.
+	return res['depth'], lag
+
+
+class Wakeup_listener(object):
+	def __init__(self, path=UPDATER_SOCKET):
+		self.path = path
+		if os.path.exists(path):
+			os.remove(path)  # left by the previous run of the updater
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.sock.bind(path)
+		os.chmod(path, 0o666)  # web server processes may run under another user
+		self.sock.setblocking(False)
+
+	def wait(self, timeout):
+		"""
+		Returns True if somebody has woken us up during timeout seconds.
+		"""
+		readable, _, _ = select.select([self.sock], [], [], timeout)
+		return bool(readable)
+
+	def drain(self):
+		try:
+			while True:
+				self.sock.recv(16)
+		except BlockingIOError:
+			pass
+
+	def close(self):
+		self.sock.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)
@@ -6,14 +6,56 @@ import django.db.utils
 from django.db import connection
 
 from starrating.constants import PAUSE_BETWEEN_GROUP_NEW_CHECKS, DEFAULT_UPDATE_PAUSE, \
-	LOOP_COUNT_FOR_FORCE_CHECK, LEVELS_LIST, LEVEL_NO_TO_NAME, PAUSE_AFTER_MYSQL_ERROR
+	LOOP_COUNT_FOR_FORCE_CHECK, LEVELS_LIST, LEVEL_NO_TO_NAME, PAUSE_AFTER_MYSQL_ERROR, \
+	QUEUE_POLL_INTERVAL, QUEUE_COALESCE_DELAY, MAX_TASKS_PER_PASS
+from starrating.models import Update_task
 from starrating.aggr.aggr_utils import get_actual_methods
+from . import update_queue
 from .localtools import create_all_zero_records_for_new_groups, process_updated_models
 
 log = logging.getLogger('sr_updater')
 
 assert LOOP_COUNT_FOR_FORCE_CHECK > 1
 
+def process_from_level(methods, level):
+	pid = getpid()
+	if level == 0:
+		create_all_zero_records_for_new_groups(methods, log=log)
+	for lvl in LEVELS_LIST:
+		if lvl >= level:
+			log.debug('queue_worker[{}] level={}={}'.format(pid, lvl, LEVEL_NO_TO_NAME[lvl]))
+			process_updated_models(lvl, methods, log)
+
+
+def queue_worker(methods, poll_interval=QUEUE_POLL_INTERVAL, coalesce_delay=QUEUE_COALESCE_DELAY):
+	"""
+	Sleeps until somebody adds an Update_task (see update_queue) and then processes the levels
+	starting from the lowest one mentioned in the tasks. The tasks that come during coalesce_delay
+	after the wake-up are processed in the same pass.
+	"""
+	pid = getpid()
+	listener = update_queue.Wakeup_listener()
+	try:
+		# There may be work left by the previous run or by the code that doesn't use the queue.
+		updater2(methods, mode='one_pass')
+		while True:
+			tasks = list(Update_task.objects.order_by('id').values_list('id', 'level')[:MAX_TASKS_PER_PASS])
+			if not tasks:
+				if listener.wait(poll_interval):
+					sleep(coalesce_delay)
+				listener.drain()
+				continue
+			depth, lag = update_queue.get_metrics()
+			min_level = min(level for _, level in tasks)
+			log.info('queue_worker[{}]: queue depth={}, lag={:.1f} s, processing from level {}'.format(
+				pid, depth, lag, min_level))
+			process_from_level(methods, min_level)
+			# We delete only the tasks we have seen: others may have been committed while we were working.
+			Update_task.objects.filter(id__in=[task_id for task_id, _ in tasks]).delete()
+	finally:
+		listener.close()
+
+
 _OPERATION_MODES = ('loop', 'one_pass', 'one_level')
 def updater2(
 		methods=(),
@@ -40,6 +82,9 @@ def updater2(
 		methods = tuple(get_actual_methods())
 		log.debug('updater; actual methods: {}'.format(methods))
 
+	if mode == 'loop' and not only_one_group:
+		return queue_worker(methods)
+
 	must_be_new_data = create_all_zero_records_for_new_groups(methods, only_one_group, log)
 	if must_be_new_data:
 		if mode == 'one_level':
@@ -37,6 +37,11 @@ DEFAULT_UPDATE_PAUSE = 5
 LOOP_COUNT_FOR_FORCE_CHECK = 30
 PAUSE_AFTER_MYSQL_ERROR = 30
 
+#### For the queue worker in starrating.aggr.updater (see starrating.aggr.update_queue)
+QUEUE_POLL_INTERVAL = 60  # the queue is checked this often even if nobody wakes the worker up
+QUEUE_COALESCE_DELAY = 2  # after a wake-up, we wait so long for the rest of a burst of new marks
+MAX_TASKS_PER_PASS = 10000
+
 LEVELS_PAIRS = (
 	(1, 'User'),
 	(2, 'Race'),
@@ -80,3 +85,8 @@ LOCK_FILE_FOR_RATED_TREE_MODIFICATIONS = os.path.join(
 	settings.BASE_DIR,
 	'logs/lock_file',
 )
+
+UPDATER_SOCKET = os.path.join(
+	settings.BASE_DIR,
+	'logs/sr_updater.sock',
+)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from starrating.aggr import update_queue
+
+class Command(BaseCommand):
+	help = 'Prints the number of tasks in the updater queue and the age of the oldest one'
+
+	def handle(self, *args, **options):
+		depth, lag = update_queue.get_metrics()
+		print('depth={} lag={:.1f}'.format(depth, lag))
@@ -541,6 +541,15 @@ class Group_new(Newdata_abstract_model):
 	id = models.OneToOneField('starrating.Group', primary_key=True, on_delete=models.CASCADE, related_name='is_new', db_column='id')
 
 
+class Update_task(Newdata_abstract_model):
+	# The queue of work for the updater, see starrating.aggr.update_queue
+	level = models.SmallIntegerField(verbose_name='Уровень, с которого появились новые данные (0 — новые группы оценок)')
+	created = models.DateTimeField(verbose_name='Время постановки в очередь', auto_now_add=True, db_index=True)
+
+	class Meta:
+		verbose_name = 'Задание для updater-а: пересчитать агрегированные оценки начиная с данного уровня'
+
+
 '''
 class User_overall_new(Newdata_abstract_model):
 	master = models.OneToOneField(User_overall, primary_key=True, on_delete=models.CASCADE, related_name='is_new')
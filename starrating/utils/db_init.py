@@ -6,6 +6,7 @@ from tools.dj_sql_tools import sql_delete, Sql_command
 from starrating.aggr.globaltools import delete_aggregate_ratings, delete_sentinel_root_data, \
 	make_sentinel_root_data
 from results.models import Organizer, Series, FAKE_ORGANIZER_ID, FAKE_ORGANIZER_NAME
+from starrating.aggr.update_queue import enqueue
 
 ##################################################
 # Some development and debug tools for Sr-system #
@@ -190,6 +191,7 @@ def mark_all_groups_new():
 	"""
 
 	sql_cmnd = Sql_command(sql_str, 'starrating').run()
+	enqueue(0)
 
 
 def mk_fake_organizer():
@@ -4,6 +4,7 @@ import logging
 from ..models import Parameter, Group, Primary, Group_new, User_review
 from results import models
 from ..constants import MAX_RATING_VALUE, MIN_DISTANCE_FOR_RATE_NUTRITION, TIMEDELTA_FOR_ASK_TO_LEAVE_RATING
+from ..aggr.update_queue import enqueue
 
 from django.utils.timezone import now
 from datetime import timedelta
@@ -59,6 +60,7 @@ def leave_rating(race_id, user_id, action_user, marks, review, show_user_name, t
 		#log.info("end sleep")
 		if marks:
 			Group_new.objects.create(id=group)
+			enqueue(0)
 		if review:
 			User_review.objects.create(
 				group=group,
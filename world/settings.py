@@ -167,6 +167,8 @@ MAIN_PAGE = f'https://{MAIN_HOST}'
 MEDIA_URL = MAIN_PAGE + '/media/'
 INTERNAL_FILES_ROOT = '/var/local/django/private/' # Where Django can put files invisible for users
 
+RUNNER_STAT_WORKERS = 4 # How many processes update statistics of all runners
+
 STATIC_ROOT = '/var/local/django/static'
 STATIC_URL = 'static/'
 
@@ -436,7 +438,13 @@ CACHES = {
         'OPTIONS': {
             'MAX_ENTRIES': 1000
         }
-    }
+    },
+    # Is shared by all processes and is the second tier for results/page_cache.py. Needs memcached running on the same server.
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': '127.0.0.1:11211',
+        'TIMEOUT': 60 * 60 * 4,
+    },
 }
 
 SELECT2_JS = ['https://cdn.jsdelivr.net/npm/select2@4.1.0-rc.0/dist/js/select2.min.js']